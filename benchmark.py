@@ -0,0 +1,280 @@
+"""Benchmarks of htmlparser hot paths on synthetic pages
+
+Pages of several shapes are generated offline with a fixed seed, so runs
+are reproducible. For every shape and size the script measures time
+(best of several runs) and peak memory of tree building, get_text_nodes,
+get_similar_sense_texts, substract_tree and cross_tree. Trees for the
+binary operations are built from two pages of the same shape (same
+layout, other texts), as two pages of one site. Every operation runs in
+a fresh process, its input trees are built first, and the memory it
+takes over them is measured (the peak is reset on Linux).
+
+Results are saved as JSON, scaling exponents (slope of log(time) to
+log(size)) show superlinear behaviour: ~1 is linear, ~2 is quadratic.
+
+Usage:
+python benchmark.py                                # all shapes, default sizes
+python benchmark.py -s table,list -n 500,1000,2000 -o bench_output.txt
+python benchmark.py --compare old_bench_output.txt # ratios to previous results
+"""
+
+import gc
+import sys
+import json
+import time
+import random
+import resource
+from math import log
+from argparse import ArgumentParser
+from multiprocessing import Process, Queue
+from htmlparser import HTMLTextBlocksTree
+
+__WORDS = [u"alpha", u"beta", u"gamma", u"delta", u"lorem", u"ipsum", u"dolor",
+           u"sit", u"amet", u"\u043f\u0440\u0438\u0432\u0435\u0442", u"2013", u"news"]
+__INLINE_TAGS = ["a", "b", "i", "span", "em", "strong", "font"]
+
+
+def get_words(rand, count):
+    return u" ".join([rand.choice(__WORDS) for _ in xrange(count)])
+
+def deep_page(size, seed = 0):
+    """ blocks nested size levels deep, a text in every block """
+    rand = random.Random(seed)
+    opening = u"".join([u'<div class="level%d">%s' % (level % 7, get_words(rand, 3))
+                        for level in xrange(size)])
+    return u"<html><body>%s%s</body></html>" % (opening, u"</div>" * size)
+
+def table_page(size, seed = 0):
+    """ wide table: size rows of ten cells """
+    rand = random.Random(seed)
+    rows = []
+    for row in xrange(size):
+        cells = u"".join([u"<td>%s</td>" % get_words(rand, 2) for _ in xrange(10)])
+        rows.append(u'<tr class="%s">%s</tr>' % (row % 2 and "odd" or "even", cells))
+    return u"<html><body><table>%s</table></body></html>" % u"".join(rows)
+
+def list_page(size, seed = 0):
+    """ menu and content of size repeated list items """
+    rand = random.Random(seed)
+    menu = u"".join([u'<li class="menu"><a href="/section%d">section %d</a></li>' %
+                     (item, item) for item in xrange(20)])
+    items = u"".join([u'<li class="item"><a href="/item%d">%s</a> <span class="date">%s</span>'
+                      u'<p>%s</p></li>' % (item, get_words(rand, 4), get_words(rand, 1),
+                                           get_words(rand, 12))
+                      for item in xrange(size)])
+    return (u'<html><body><div class="menu"><ul>%s</ul></div>'
+            u'<div class="content"><ul>%s</ul></div></body></html>' % (menu, items))
+
+def inline_page(size, seed = 0):
+    """ size paragraphs of text with many inline elements (mark zones) """
+    rand = random.Random(seed)
+    paragraphs = []
+    for _ in xrange(size):
+        parts = []
+        for _ in xrange(8):
+            tag = rand.choice(__INLINE_TAGS)
+            attributes = tag == "a" and u' href="/p%d"' % rand.randint(0, 99) or u""
+            parts.append(u"%s <%s%s>%s</%s>" % (get_words(rand, 3), tag, attributes,
+                                                get_words(rand, 2), tag))
+        paragraphs.append(u"<p>%s</p>" % u" ".join(parts))
+    return u"<html><body><div>%s</div></body></html>" % u"".join(paragraphs)
+
+def mixed_page(size, seed = 0):
+    """ random mix of blocks, inline elements and texts of size blocks """
+    rand = random.Random(seed)
+    out = []
+    depth = 0
+    for _ in xrange(size):
+        action = rand.random()
+        if action < 0.4 and depth < 30:
+            out.append(u'<div class="%s">' % rand.choice(["a", "b", "a b", "c"]))
+            depth += 1
+        elif action < 0.6 and depth:
+            out.append(u"</div>")
+            depth -= 1
+        elif action < 0.8:
+            tag = rand.choice(__INLINE_TAGS)
+            out.append(u"<%s>%s</%s>" % (tag, get_words(rand, 2), tag))
+        else:
+            out.append(u"<p>%s</p>" % get_words(rand, 5))
+    out.append(u"</div>" * depth)
+    return u"<html><body>%s</body></html>" % u"".join(out)
+
+SHAPES = {"deep": deep_page,
+          "table": table_page,
+          "list": list_page,
+          "inline": inline_page,
+          "mixed": mixed_page}
+OPERATIONS = ["load", "get_text_nodes", "get_similar_sense_texts",
+              "substract_tree", "cross_tree"]
+
+
+def get_memory():
+    """ (current, peak) resident memory of the process in kilobytes, 
+    without /proc both are the peak one """
+    try:
+        with open("/proc/self/status") as status:
+            fields = dict([line.split(":", 1) for line in status if ":" in line])
+        return int(fields["VmRSS"].split()[0]), int(fields["VmHWM"].split()[0])
+    except (IOError, KeyError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak, peak
+
+def reset_peak_memory():
+    """ make the peak memory of the process equal to the current one 
+    (Linux only, elsewhere the peak never decreases) """
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except IOError:
+        pass
+
+def measure(function, repeats):
+    """ best time of repeats runs and the peak memory over the memory 
+    in use before them """
+    gc.collect()
+    reset_peak_memory()
+    memory, _ = get_memory()
+    best = None
+    for _ in xrange(repeats):
+        started = time.time()
+        function()
+        elapsed = time.time() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, max(0, get_memory()[1] - memory)
+
+def run_operation(shape, size, operation, repeats):
+    """ measurement of an operation on pages of one shape and size, 
+    its input trees are built before the measurement """
+    html = SHAPES[shape](size, seed = 0)
+    tree = HTMLTextBlocksTree(html)
+    if operation == "load":
+        function = lambda: HTMLTextBlocksTree(html)
+    elif operation == "get_text_nodes":
+        function = tree.get_text_nodes
+    elif operation == "get_similar_sense_texts":
+        function = tree.get_similar_sense_texts
+    else:
+        other_tree = HTMLTextBlocksTree(SHAPES[shape](size, seed = 1))
+        function = lambda: getattr(tree.copy(), operation)(other_tree)
+    seconds, memory = measure(function, repeats)
+    return {"shape": shape, "size": size, "operation": operation,
+            "nodes": len(tree), "html_length": len(html),
+            "seconds": seconds, "peak_memory_kb": memory}
+
+def run_case(shape, size, repeats):
+    """ measurements of all operations on pages of one shape and size """
+    return [run_operation(shape, size, operation, repeats) for operation in OPERATIONS]
+
+def __run_operation_process(queue, shape, size, operation, repeats):
+    try:
+        queue.put(run_operation(shape, size, operation, repeats))
+    except Exception as error:
+        queue.put("%s: %s" % (error.__class__.__name__, error))
+
+def run_case_isolated(shape, size, repeats):
+    """ run_case with every operation in a fresh process, so that its 
+    memory doesn't depend on the operations run before """
+    results = []
+    for operation in OPERATIONS:
+        queue = Queue()
+        process = Process(target = __run_operation_process, 
+                          args = (queue, shape, size, operation, repeats))
+        process.start()
+        result = queue.get()
+        process.join()
+        if not isinstance(result, dict):
+            raise RuntimeError("%s %d %s failed: %s" % (shape, size, operation, result))
+        results.append(result)
+    return results
+
+def get_scaling_exponent(points):
+    """ least squares slope of log(seconds) to log(size) """
+    points = [(log(size), log(max(seconds, 1e-6))) for size, seconds in points]
+    if len(points) < 2:
+        return None
+    mean_x = sum([x for x, _ in points]) / len(points)
+    mean_y = sum([y for _, y in points]) / len(points)
+    variance = sum([(x - mean_x) ** 2 for x, _ in points])
+    if not variance:
+        return None
+    return sum([(x - mean_x) * (y - mean_y) for x, y in points]) / variance
+
+def get_scaling(results):
+    """ {(shape, operation): exponent} """
+    curves = {}
+    for result in results:
+        key = (result["shape"], result["operation"])
+        curves.setdefault(key, []).append((result["size"], result["seconds"]))
+    return dict((key, get_scaling_exponent(points)) for key, points in curves.items())
+
+def format_report(results, previous = None):
+    """ table of times per size, scaling exponents and ratios to previous results """
+    sizes = sorted(set([result["size"] for result in results]))
+    scaling = get_scaling(results)
+    previous_seconds = {}
+    for result in previous or []:
+        previous_seconds[(result["shape"], result["operation"],
+                          result["size"])] = result["seconds"]
+    table = {}
+    for result in results:
+        table[(result["shape"], result["operation"], result["size"])] = result
+    lines = ["%-8s %-24s %s %8s" % ("shape", "operation",
+                                    " ".join(["%12s" % size for size in sizes]),
+                                    "exponent")]
+    for shape in sorted(set([result["shape"] for result in results])):
+        for operation in OPERATIONS:
+            cells = []
+            for size in sizes:
+                result = table.get((shape, operation, size))
+                if result is None:
+                    cells.append("%12s" % "-")
+                    continue
+                cell = "%.4f" % result["seconds"]
+                old_seconds = previous_seconds.get((shape, operation, size))
+                if old_seconds:
+                    cell += " x%.2f" % (result["seconds"] / old_seconds)
+                cells.append("%12s" % cell)
+            exponent = scaling.get((shape, operation))
+            mark = exponent is not None and exponent > 1.5 and " !" or ""
+            lines.append("%-8s %-24s %s %8s%s" % (shape, operation, " ".join(cells),
+                                                  exponent is None and "-" or
+                                                  "%.2f" % exponent, mark))
+    return "\n".join(lines) + "\n"
+
+
+def main(args = None):
+    parser = ArgumentParser(description = "benchmark htmlparser on synthetic pages")
+    parser.add_argument("-s", "--shapes", default = ",".join(sorted(SHAPES)),
+                        help = "comma separated shapes: %s" % ", ".join(sorted(SHAPES)))
+    parser.add_argument("-n", "--sizes", default = "250,500,1000,2000",
+                        help = "comma separated page sizes")
+    parser.add_argument("-r", "--repeats", type = int, default = 3)
+    parser.add_argument("-o", "--output", default = "bench_output.txt",
+                        help = "file to save JSON results to")
+    parser.add_argument("-c", "--compare", help = "JSON results of a previous revision")
+    options = parser.parse_args(args)
+    shapes = options.shapes.split(",")
+    for shape in shapes:
+        if not shape in SHAPES:
+            parser.error("unknown shape %s" % shape)
+    sizes = [int(size) for size in options.sizes.split(",")]
+    results = []
+    for shape in shapes:
+        for size in sizes:
+            sys.stderr.write("%s %d\n" % (shape, size))
+            results.extend(run_case_isolated(shape, size, options.repeats))
+    with open(options.output, "wb") as output:
+        json.dump({"python": sys.version.split()[0], "sizes": sizes,
+                   "repeats": options.repeats, "results": results}, output, indent = 1)
+    previous = None
+    if options.compare:
+        with open(options.compare, "rb") as previous_file:
+            previous = json.load(previous_file)["results"]
+    sys.stdout.write(format_report(results, previous))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
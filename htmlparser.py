@@ -22,6 +22,28 @@ from  HTMLTextBlocksTree import *
 url = "http://australianpolitics.com/united-states-of-america/president/list-of-presidents-of-the-united-states"
 tree = HTMLTextBlocksTree(url=url)
 
+- many pages from one site: a Fetcher reuses connections (keep-alive), 
+  decodes gzip/deflate, limits concurrency and requests per host:
+fetcher = Fetcher(max_connections=16, max_per_host=4, timeout=10, min_delay=0.1)
+for url, tree, error in fetcher.fetch_trees(urls):
+    ...
+
+- from a file object, socket or generator of html chunks (nodes are built
+  while chunks arrive, no intermediate lxml document is kept; the tree is the same 
+  as for the whole html, so, as in browsers, everything after an unclosed <script> 
+  or <style> is their content and it is skipped):
+tree = HTMLTextBlocksTree(stream=open("test.html"))
+or
+tree = HTMLTextBlocksTree()
+for chunk in chunks:
+    tree.feed(chunk)
+tree.close()
+
+- encoding of html bytes is sniffed once before parsing (byte order mark, 
+  Content-Type header, <meta charset>, statistics of the first bytes) and 
+  given to the parser, tree.encoding is the result; pass it, if it is known:
+tree = HTMLTextBlocksTree(filename="test.html", encoding="windows-1251")
+
 2) use tree:
 - to remove clutter (menu and other static content) from the page:
 You will need another tree built from page with same structure, to substract it:
@@ -29,32 +51,272 @@ You will need another tree built from page with same structure, to substract it:
 url_substract = "http://australianpolitics.com/constitution-aus"
 tree.substract_tree(HTMLTextBlocksTree(url=url_substract))
 
+or collect a template of the site from many of its pages once, save it, 
+and remove boilerplate from other pages without parsing a reference page:
+template = SiteTemplate()
+for page_url in site_urls:
+    template.add_tree(HTMLTextBlocksTree(url=page_url))
+template.save("site.template")
+tree.substract_template(SiteTemplate.load("site.template"))
+
 - to get text elements with similar sense:
 similar_sense_groups = tree.get_similar_sense_texts()
 
+- to get text elements with similar sense on many pages of a site (records: 
+prices of all products, authors of all posts), groups are merged by context 
+signatures without comparing pages pairwise, memory is bounded:
+grouper = CorpusGrouper(max_members=20, max_groups=100000)
+for page_url in site_urls:
+    grouper.add_tree(HTMLTextBlocksTree(url=page_url), page_url)
+for group in grouper.iter_groups(min_documents=10):
+    print group["documents_count"], group["members"]
+
 - to get all text nodes in normal form:
 text_nodes = tree.get_text_nodes()
 
 3) for various usage
 - tree implemented as an array of nodes (class Node), each node can be accessed through 
-its index (tree[node_index]). 
-- bad idea to iterate the tree as an array, since some nodes of the tree might be 
-unlinked (not be a part of it after manipulations with tree)
-- the right way to iterate the tree is to use iterate_DFS, that perform deep-first search iteration
+its index (tree[node_index]). Nodes are stored in compact columns, tree[node_index] 
+returns a lightweight view, changes of lists it returns (child_indices, style_classes, 
+mark_zones) are written to the tree, attributes of a mark zone are written, when the 
+list is assigned again. A node is a child of one node only: adding it to child_indices 
+of another node moves it there, repeated child indices raise ValueError.
+Texts of all nodes are kept in one UTF-8 buffer, node.text creates the string on access.
+- nodes removed by manipulations with tree stay in the array as tombstones, so 
+len(tree) counts them too; iterating the tree skips them (so positions of 
+enumerate(tree) are not node indices then, iter_dfs gives them), and tree.compact() 
+frees them, renumbering the rest of nodes; texts and mark zones assigned again are 
+written over the old ones, if they fit there, and compact() frees the rest
+- the right way to iterate the tree is to use iter_dfs, iter_bfs and iter_text_nodes 
+generators (or iterate_DFS with an actor), they walk the tree with an explicit stack, 
+so deeply nested pages are fine:
+for node_index in tree.iter_dfs(prune=lambda tree, node_index: tree[node_index].tag == "table"):
+    ...
+- tree.dump(out) writes the tree to a file-like object out, same text as str(tree)
+- to answer structural queries in O(1) or O(log(depth)), opt in to the structural 
+index (depths, Euler tour, positions among siblings, ancestors by binary lifting), it is 
+built once and again after the tree is changed; grouping takes positions among 
+siblings from it and skips common parents of deep paths with it:
+tree.index_structure()
+tree.get_depth(node_index), tree.get_sibling_position(node_index)
+tree.is_ancestor(ancestor_index, node_index), tree.get_common_ancestor(first_index, second_index)
+- to find nodes by tag, style class, depth or link domain, or by a CSS-like selector 
+(indexes are built on the first query and rebuilt after the tree is changed):
+tree.find_by_class("post")
+tree.find_by_link_domain("example.com")
+for node_index in tree.select("div.post > p"):
+    ...
+- to find slow phases and pathological pages, record time per phase and counters 
+(nodes created, path comparisons, alignment depth, ...), disabled by default:
+stats = HTMLTextBlocksTree.Stats(callback=lambda phase, seconds, stats: ...)
+tree = HTMLTextBlocksTree(html, stats=stats)
+tree.get_similar_sense_texts()
+print stats.times, stats.counters
+- to bound time and memory spent on hostile or pathological pages, set limits on 
+building and analysis; when one is hit, the tree degrades gracefully (it is 
+truncated, deep blocks are collapsed, grouping stops) and tree.limits_hit names it:
+limits = HTMLTextBlocksTree.Limits(max_nodes=100000, max_depth=200, max_text_bytes=2 ** 22,
+                                   max_zones_per_node=1000, max_seconds=5)
+tree = HTMLTextBlocksTree(html, limits=limits)
+tree.limits_hit
+- to cache a parsed tree (binary format, loading it is much faster than parsing):
+tree.save("page.tree")
+tree = HTMLTextBlocksTree.load("page.tree")
+- to update the tree of a recrawled page: unchanged subtrees (found by subtree hashes) 
+keep their node indices and text nodes counts, only changed parts are rebuilt, 
+and the diff of text nodes is returned:
+tree = HTMLTextBlocksTree(html)
+...
+diff = tree.update(recrawled_html)
+diff["added"], diff["removed"], diff["changed"]
+- to get features of text nodes for classifiers (depth, text and link lengths, 
+siblings, similar sense group, hashed tags and style classes of ancestors) as NumPy 
+matrices, for one tree or a batch of trees (requires numpy):
+features = HTMLTextBlocksTree.get_feature_matrices(trees)
+features["dense"], features["hashed_indices"], features["hashed_indptr"]
+- to skip parsing of duplicate pages, build trees through a cache (in memory and 
+optionally on disk), it returns copies, that can be changed independently:
+cache = ParseCache(max_trees=256, directory="trees", max_disk_bytes=2 ** 30)
+tree = cache.get_tree(html)
+tree_copy = tree.copy()
+
+4) batch parsing
+- parse many documents on a pool of worker processes:
+for result in parse_batch(iter_documents("pages/*.html"), 
+                          operations=("text_nodes", "similar_sense_texts"),
+                          template=SiteTemplate.load("site.template")):
+    print result["id"], result["error"] or result["text_nodes"]
+- to stream a record per text node (path, text, mark zones, group id) of many 
+documents in constant memory, trees are released as soon as their records are made:
+with open("records.jsonl", "wb") as out:
+    write_records(iter_records(iter_documents("dump.jsonl")), out, format="jsonl")
+- same from the command line, results (or records) are printed as JSON lines:
+python -m htmlparser pages/ -o text_nodes -t site.template -p 8 > results.jsonl
+cat documents.jsonl | python -m htmlparser - --unordered > results.jsonl
+python -m htmlparser pages/ --max-nodes 100000 --max-seconds 5 > results.jsonl
+python -m htmlparser dump.jsonl --records --format csv > records.csv
 
 
 """
 
 
 # -*- encoding: utf8 -*-
-from urllib2 import urlopen, URLError
+import os
+import re
+import sys
+import csv
+import json
+import time
+import zlib
+import codecs
+import socket
+import threading
+from httplib import HTTPConnection, HTTPSConnection, HTTPException, IncompleteRead
+from urlparse import urlsplit, urljoin
+from glob import glob
+from argparse import ArgumentParser
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+from urllib2 import URLError, HTTPError
 from copy import copy
+from collections import deque, OrderedDict
+from array import array
+from bisect import bisect_left, bisect_right
+from hashlib import md5
+from struct import pack, unpack, calcsize
 from lxml import etree
+try:
+    import numpy
+except ImportError:
+    numpy = None #feature matrices only
+
+__all__ = ['HTMLTextBlocksTree', 'SiteTemplate', 'CorpusGrouper', 'Fetcher', 'ParseCache',
+           'sniff_encoding', 'iter_documents', 'parse_batch', 'iter_records', 
+           'write_records']
+
+
+class _ParserTarget(object):
+    """lxml parser target, passes parsing events to the given callbacks"""
+    def __init__(self, start, end, data, comment, pi):
+        self.start = start
+        self.end = end
+        self.data = data
+        self.comment = comment
+        self.pi = pi
+    def close(self):
+        pass
+
+
+_BYTE_ORDER_MARKS = [(codecs.BOM_UTF32_LE, "utf-32le"), 
+                     (codecs.BOM_UTF32_BE, "utf-32be"), 
+                     (codecs.BOM_UTF8, "utf-8"), 
+                     (codecs.BOM_UTF16_LE, "utf-16le"), 
+                     (codecs.BOM_UTF16_BE, "utf-16be")]
+_META_CHARSET = re.compile(r"""<meta[^>]*?charset\s*=\s*["']?\s*([-\w.:]+)""", re.I)
+_HIGH_BYTES = re.compile(r"[\x80-\xff]")
+_MARKUP = re.compile(r"<[^>]*>")
+_CYRILLIC_ENCODINGS = ["windows-1251", "koi8-r"]
+_LATIN_ENCODING = "windows-1252"
+
+
+def _get_charset(content_type):
+    """ charset parameter of Content-Type header value or None """
+    if not content_type or not "charset=" in content_type.lower():
+        return None
+    charset = content_type[content_type.lower().index("charset=") + 8:]
+    return charset.split(";")[0].strip(" \"'") or None
 
-__all__ = ['HTMLTextBlocksTree']
+def _get_known_encoding(name):
+    """ lowercased name, if python knows the encoding, None otherwise """
+    if not name:
+        return None
+    try:
+        codecs.lookup(name)
+    except LookupError:
+        return None
+    return name.lower()
 
+def sniff_encoding(head, declared = None):
+    """ guess encoding of html by its first bytes, return 
+    (encoding or None if html is ascii, length of byte order mark)
 
-class HTMLTextBlocksTree(list):
+    byte order mark goes first, then declared encoding (HTTP header), 
+    then <meta charset> or <meta http-equiv> declaration, then statistics 
+    of the bytes: valid utf-8, cyrillic (windows-1251 or koi8-r), windows-1252
+    """
+    for mark, encoding in _BYTE_ORDER_MARKS:
+        if head.startswith(mark):
+            return encoding, len(mark)
+    encoding = _get_known_encoding(declared)
+    if encoding is None:
+        match = _META_CHARSET.search(head)
+        encoding = match and _get_known_encoding(match.group(1))
+    if encoding is not None:
+        return encoding, 0
+    high_bytes = len(_HIGH_BYTES.findall(head))
+    if not high_bytes:
+        return None, 0
+    try:
+        #the last character may be cut
+        codecs.getincrementaldecoder("utf-8")().decode(head)
+        return "utf-8", 0
+    except UnicodeDecodeError:
+        pass
+    #in cyrillic texts most of letters are high bytes and most of them are lowercase
+    head = _MARKUP.sub(" ", head)
+    high_bytes = len(_HIGH_BYTES.findall(head))
+    letters = sum([character.isalpha() for character in head.decode("latin-1")])
+    if high_bytes * 3 < letters:
+        return _LATIN_ENCODING, 0
+    best_encoding, best_lowercase = _LATIN_ENCODING, -1
+    for encoding in _CYRILLIC_ENCODINGS:
+        lowercase = sum([character.islower() for character 
+                         in head.decode(encoding, "replace") if ord(character) > 127])
+        if lowercase > best_lowercase:
+            best_encoding, best_lowercase = encoding, lowercase
+    return best_encoding, 0
+
+
+def _node_field(name):
+    """property of HTMLTextBlocksTree.Node: a view reads it from the tree columns,
+    a detached node keeps its own value"""
+    def get_value(node):
+        if node._values is None:
+            return node._get(node._index, name)
+        return node._values[name]
+    def set_value(node, value):
+        if node._values is None:
+            node._set(node._index, name, value)
+        else:
+            node._values[name] = value
+    return property(get_value, set_value)
+
+
+class _NodeList(list):
+    """list field of a node view, its changes are written to the tree"""
+    __slots__ = ("_write",)
+    def __init__(self, values, write):
+        list.__init__(self, values)
+        self._write = write
+    def __reduce__(self):
+        return list, (list(self),)
+
+def _write_through(name):
+    change = getattr(list, name)
+    def change_and_write(node_list, *args, **kwargs):
+        result = change(node_list, *args, **kwargs)
+        node_list._write(node_list)
+        return result
+    change_and_write.__name__ = name
+    return change_and_write
+
+for _name in ["append", "extend", "insert", "remove", "pop", "sort", "reverse", 
+              "__setitem__", "__delitem__", "__setslice__", "__delslice__", 
+              "__iadd__", "__imul__"]:
+    setattr(_NodeList, _name, _write_through(_name))
+
+
+class HTMLTextBlocksTree(object):
     class BadEncoding(Exception):
         def __init__(self, value):
             self.value = value
@@ -73,8 +335,74 @@ class HTMLTextBlocksTree(list):
             self.tag = not tag is None and tag or "";
             self.style_classes = not style_classes is None and style_classes or []
             self.link = not link is None and link or "";    
-    class Node:
-        """implement HTMLTextBlocksTree node features"""
+
+    class Stats(object):
+        """wall time per phase and counters of the work done with trees, 
+        one object can be shared by many trees to sum them up
+
+        phases: parse, count_texts, unlink_text_free_nodes, 
+        get_text_signatures, get_context_signatures, get_similar_sense_texts, 
+        matching, substract_tree, cross_tree, substract_template, 
+        subtree_hashes, update, features, index_structure
+        counters: nodes_created, mark_zones_split, path_comparisons, 
+        matched_nodes_hits, matched_nodes_misses, aligned_pairs, 
+        check_matching_depth (maximal alignment depth), subtrees_reused, 
+        limits_hit
+        """
+        def __init__(self, callback = None):
+            """ callback -- function callback(phase, seconds, stats), 
+            it is called at the end of every phase
+            """
+            self.callback = callback
+            self.times = {}
+            self.counters = {}
+
+        def add_time(self, phase, seconds):
+            self.times[phase] = self.times.get(phase, 0.0) + seconds
+            if self.callback is not None:
+                self.callback(phase, seconds, self)
+
+        def count(self, name, value = 1):
+            self.counters[name] = self.counters.get(name, 0) + value
+
+        def count_max(self, name, value):
+            if value > self.counters.get(name, 0):
+                self.counters[name] = value
+
+        def as_dict(self):
+            return {"times": dict(self.times), "counters": dict(self.counters)}
+
+    class Limits(object):
+        """budgets of building and analysis of trees, a tree hitting one of 
+        them degrades gracefully and adds its name to tree.limits_hit
+
+        max_nodes -- the rest of html is ignored (the tree is truncated)
+        max_depth -- deeper blocks are collapsed: their texts join the text 
+                     of the block at max_depth
+        max_text_bytes -- texts are cut, the rest of html is ignored
+        max_zones_per_node -- further inline elements of a text don't make 
+                              mark zones
+        max_seconds -- wall-clock deadline of every operation: building is 
+                       truncated, get_similar_sense_texts returns groups 
+                       found by then, subtrees not aligned by then are 
+                       unmatched in substract_tree and cross_tree
+        """
+        def __init__(self, max_nodes = None, max_depth = None, max_text_bytes = None, 
+                     max_zones_per_node = None, max_seconds = None):
+            self.max_nodes = max_nodes
+            self.max_depth = max_depth
+            self.max_text_bytes = max_text_bytes
+            self.max_zones_per_node = max_zones_per_node
+            self.max_seconds = max_seconds
+
+    class Node(object):
+        """implement HTMLTextBlocksTree node features
+        
+        The tree keeps nodes in columns and tree[node_index] is a lightweight 
+        view of them. A node created with the constructor is detached, 
+        tree.append(node) copies its values to the tree.
+        """
+        __slots__ = ("_index", "_get", "_set", "_values")
         def __init__(self, 
                      parent_index = -1, 
                      tag = None, 
@@ -82,67 +410,463 @@ class HTMLTextBlocksTree(list):
                      child_indices = None, 
                      text = None, 
                      mark_zones = None):
-            self.parent_index = parent_index
-            #block node properties
-            self.tag = not tag is None and tag or ""
-            self.style_classes = not style_classes is None and style_classes or []
-            self.child_indices = not child_indices is None and child_indices or []
-            #text node properties
-            self.text = not text is None and text or ""   
-            self.mark_zones = not mark_zones is None and mark_zones or []
-            self.text_nodes_count = 0
+            self._index = -1
+            self._get = self._set = None
+            self._values = {
+                "parent_index": parent_index,
+                #block node properties
+                "tag": not tag is None and tag or "",
+                "style_classes": not style_classes is None and style_classes or [],
+                "child_indices": not child_indices is None and child_indices or [],
+                #text node properties
+                "text": not text is None and text or "",
+                "mark_zones": not mark_zones is None and mark_zones or [],
+                "text_nodes_count": 0}
+        parent_index = _node_field("parent_index")
+        tag = _node_field("tag")
+        style_classes = _node_field("style_classes")
+        child_indices = _node_field("child_indices")
+        text = _node_field("text")
+        mark_zones = _node_field("mark_zones")
+        text_nodes_count = _node_field("text_nodes_count")
     
-    def __init__(self, text = None, filename = None, url = None):
+    def __init__(self, text = None, filename = None, url = None, stream = None,
+                 fetcher = None, stats = None, encoding = None, limits = None):
         """ tree constructor
         
-        Only one of three arguments should be specified:
+        Only one of four arguments should be specified:
         text -- build tree from html string
         filename -- build tree from html file
-        url -- fetch html page with url and build tree
+        url -- fetch html page with url and build tree, the body is parsed 
+               while it is downloaded
+        stream -- build tree from a file object or an iterable of html chunks,
+                  chunks are parsed as soon as they are read
+        fetcher -- Fetcher to fetch url with, a shared one by default
+        stats -- HTMLTextBlocksTree.Stats to record time and counters of 
+                 the work with the tree to (tree.stats, None to disable)
+        encoding -- encoding of html bytes, if it is known, otherwise it is 
+                    sniffed from the first bytes (tree.encoding)
+        limits -- HTMLTextBlocksTree.Limits on building and analysis of 
+                  the tree (tree.limits), names of limits hit are listed in 
+                  tree.limits_hit
+        
+        Without arguments an empty tree is created, feed() and close() 
+        build it from html chunks
         """
+        self.stats = stats
+        self.limits = limits
+        self.__structure_enabled = False
+        self.__reset()
         if text is None and not filename is None:
-            text = open(filename).read()
+            with open(filename, "rb") as html_file:
+                self.__load_stream(html_file, encoding = encoding)
         elif text is None and not url is None:
-            try:
-                request = urlopen(url)
-                text = request.read()
-                try:
-                    encoding = request.headers['content-type'].split('charset=')[-1]
-                    encoded = unicode(text, encoding)
-                    text = encoded
-                except:
-                    pass
-            except (ValueError, URLError) as error:
-                #print error
-                raise error
+            fetcher = fetcher or Fetcher.get_default()
+            headers = {}
+            self.__load_stream(fetcher.iter_body(url, headers), url, 
+                               encoding, headers)
+        elif text is None and not stream is None:
+            self.__load_stream(stream, encoding = encoding)
         if not text is None:
-            self.__load(text, url)
+            self.__load(text, url, encoding)
 
     def __str__(self, node_index = 0, indent = 0):
         """convert tree to string
         
         node_index -- print subtree, root element with index nodex_index
         """
-        if not len(self):
-            return "<p>empty tree</p>"        
-        if self[node_index].text:
-            return "%s%s\n" % (indent * " ",
-                               self[node_index].text.replace("\n", " "))
-        elif self[node_index].tag:            
-            out = "%s<%s>\n" % (indent * " ", self[node_index].tag)
-            for child_index in self[node_index].child_indices:
-                out +=  self.__str__(child_index, indent + 1)
-            out += "%s</%s>\n" % (indent * " ", self[node_index].tag)    
-            return out;
-        return "";
+        return "".join(self.__iter_dump_lines(node_index, indent))
+
+    def dump(self, out, node_index = 0, indent = 0):
+        """write the tree to a file-like object out line by line, 
+        same format as str(tree)
+        
+        node_index -- write subtree, root element with index nodex_index
+        """
+        for line in self.__iter_dump_lines(node_index, indent):
+            out.write(line)
+
+    def __len__(self):
+        return len(self.__parents)
+
+    def __getitem__(self, node_index):
+        """ lightweight view of the node with index node_index """
+        if isinstance(node_index, slice):
+            return [self.__view(index) for index 
+                    in xrange(*node_index.indices(len(self)))]
+        if node_index < 0:
+            node_index += len(self)
+        if not 0 <= node_index < len(self):
+            raise IndexError("node index out of range")
+        return self.__view(node_index)
+
+    def __iter__(self):
+        """ iterate over nodes, that are a part of the tree: 
+        removed nodes and their subtrees are skipped, so after removals 
+        positions of enumerate(tree) are not node indices, iter_dfs gives 
+        the indices (or compact the tree first)
+        """
+        live = self.__get_live_nodes()
+        for node_index in xrange(len(self)):
+            if live[node_index]:
+                yield self.__view(node_index)
+
+    def append(self, node):
+        """ add a node to the end of the tree, node's values are copied
+        
+        the node is not added to parent's child_indices, as before 
+        the structure of the tree is defined by child_indices only
+        """
+        self.__unshare()
+        if self.stats is not None:
+            self.stats.count("nodes_created")
+        node_index = self.__add_node(-1, 
+                                     self.__get_tag_id(node.tag), 
+                                     self.__get_classes_id(node.style_classes), 
+                                     node.text, 
+                                     node.mark_zones)
+        self.__parents[node_index] = node.parent_index
+        self.__text_counts[node_index] = node.text_nodes_count
+        self.__set_children(node_index, node.child_indices)
     
-    def substract_tree(self, tree):
-        """ substract from self nodes that match with nodes in the tree  """
-        self.__binary_operation(tree, substract = True)
+    def feed(self, data):
+        """ parse the next html chunk, nodes are added to the tree as soon as 
+        their content arrives (html after an unclosed script or style is 
+        their content, so it is skipped) 
+        
+        Feeding a closed tree starts building it from scratch.
+        """
+        if not self.__building:
+            self.__begin_build()
+        if self.__truncated:
+            return
+        if self.__parser is None:
+            if isinstance(data, unicode) and not self.__head:
+                self.__start_parser()
+            else:
+                #bytes are kept until there are enough of them to sniff encoding
+                self.__head.append(data)
+                self.__head_length += len(data)
+                if self.__head_length < self.__SNIFF_LENGTH:
+                    return
+                data = self.__start_parser()
+        self.__feed_parser(data)
+
+    def close(self):
+        """ finish the tree fed with feed(): flush the parser and 
+        unlink text free nodes
+        """
+        if not self.__building:
+            self.__begin_build()
+        if self.__parser is None:
+            self.__feed_parser(self.__start_parser())
+        if self.__leading_tail:
+            self.__leading = False
+            self.__feed_parser(self.__leading_tail)
+        parser = self.__parser
+        self.__parser = None
+        self.__building = False
+        started = self.__start_phase()
+        try:
+            #the parser fails to close without any html fed (empty document)
+            if self.__fed:
+                parser.close()
+            if self.__unstarted is not None:
+                self.__reparse_unstarted()
+        except UnicodeDecodeError:
+            raise self.BadEncoding("Wrong html encoding at %s" % (self.url));
+        finally:
+            self.__unstarted = None
+            self.__frames = []
+            self.__pending_text = []
+            self.__skip_depth = 0
+            self.__depth = 0
+            self.__end_phase("parse", started)
+        if self.stats is not None:
+            self.stats.count("nodes_created", len(self))
+        self.__count_texts_in_nodes(0)
+        self.__unlink_text_free_nodes()
+
+    def substract_tree(self, tree, budget = None):
+        """ substract from self nodes that match with nodes in the tree
+        
+        budget -- maximal number of subtree pairs to align, when it is spent
+                  only identical subtrees match
+        """
+        self.__binary_operation(tree, substract = True, budget = budget)
     
-    def cross_tree(self, tree):
-        """ leave only nodes that match with nodes in the tree """
-        self.__binary_operation(tree, cross = True)
+    def cross_tree(self, tree, budget = None):
+        """ leave only nodes that match with nodes in the tree 
+        
+        budget -- maximal number of subtree pairs to align, when it is spent
+                  only identical subtrees match
+        """
+        self.__binary_operation(tree, cross = True, budget = budget)
+
+    def substract_template(self, template):
+        """ remove text nodes, that are boilerplate according to the 
+        SiteTemplate, no reference page is needed 
+        """
+        self.__unshare()
+        started = self.__start_phase()
+        for node_index in template.get_boilerplate_nodes(self):
+            self.__remove_node(node_index)
+        self.__count_texts_in_nodes(0)
+        self.__unlink_text_free_nodes()
+        self.__end_phase("substract_template", started)
+
+    def compact(self):
+        """ free removed nodes: the nodes left are renumbered in 
+        deep-first order, root keeps index 0
+        
+        returns array, that maps old node indices to new ones 
+        (-1 for removed nodes)
+        """
+        mapping = array("i", [-1]) * len(self)
+        order = []
+        stack = len(self) and [0] or []
+        while stack:
+            node_index = stack.pop()
+            mapping[node_index] = len(order)
+            order.append(node_index)
+            stack.extend(reversed(self.__get_children(node_index)))
+        parents, tags, classes = self.__parents, self.__tags, self.__classes
+        text_counts = self.__text_counts
+        text_starts, text_lengths = self.__text_starts, self.__text_lengths
+        text_buffer = self.__text_buffer
+        first_zones, zone_counts = self.__first_zones, self.__zone_counts
+        zone_starts, zone_lengths = self.__zone_starts, self.__zone_lengths
+        zone_tags, zone_classes = self.__zone_tags, self.__zone_classes
+        zone_links = self.__zone_links
+        class_sets, links = self.__class_sets, self.__links
+        self.__init_columns()
+        for node_index in order:
+            parent_index = parents[node_index]
+            if parent_index > -1:
+                parent_index = mapping[parent_index]
+            new_index = self.__add_node(
+                            parent_index,
+                            tags[node_index],
+                            self.__get_classes_id(class_sets[classes[node_index]]),
+                            "",
+                            [])
+            self.__text_counts[new_index] = text_counts[node_index]
+            text_start = text_starts[node_index]
+            self.__text_starts[new_index] = len(self.__text_buffer)
+            self.__text_lengths[new_index] = text_lengths[node_index]
+            self.__text_buffer += text_buffer[text_start:text_start + text_lengths[node_index]]
+            first_zone = first_zones[node_index]
+            self.__first_zones[new_index] = len(self.__zone_starts)
+            self.__zone_counts[new_index] = zone_counts[node_index]
+            for zone_index in xrange(first_zone, first_zone + zone_counts[node_index]):
+                self.__zone_starts.append(zone_starts[zone_index])
+                self.__zone_lengths.append(zone_lengths[zone_index])
+                self.__zone_tags.append(zone_tags[zone_index])
+                self.__zone_classes.append(self.__get_classes_id(
+                                            class_sets[zone_classes[zone_index]]))
+                self.__zone_links.append(self.__get_link_id(
+                                            links[zone_links[zone_index]]))
+        return mapping
+
+    def copy(self):
+        """ cheap copy of the tree: columns are shared, until one of 
+        the trees is changed (copy on write)
+        """
+        tree = HTMLTextBlocksTree()
+        tree.__set_columns(self.__get_columns())
+        tree.__text_buffer = self.__text_buffer
+        tree.__class_sets = self.__class_sets
+        tree.__class_set_ids = self.__class_set_ids
+        tree.__links = self.__links
+        tree.__link_ids = self.__link_ids
+        tree.url = self.url
+        tree.encoding = self.encoding
+        tree.stats = self.stats
+        tree.limits = self.limits
+        tree.limits_hit = list(self.limits_hit)
+        tree.__structure_enabled = self.__structure_enabled
+        tree.__structure = self.__structure
+        tree.__shared = self.__shared = True
+        return tree
+
+    def update(self, html, url = None, encoding = None):
+        """ rebuild the tree from a new version of the page (recrawl), 
+        unchanged subtrees are reused with their node indices and text 
+        nodes counts, so results computed for them stay valid
+        
+        Subtrees of both versions are compared by hashes of their content, 
+        children of changed nodes are matched by hash, then by tag and style 
+        classes. Matched text nodes are changed in place, unmatched ones are 
+        removed (tombstones, tree.compact() frees them) or added.
+
+        returns {"added": [...], "removed": [...], "changed": [...]} 
+        -- indices of text nodes; removed ones keep their texts
+        """
+        new_tree = HTMLTextBlocksTree(html, url = self.url if url is None else url, 
+                                      encoding = encoding, limits = self.limits)
+        started = self.__start_phase()
+        self.__unshare()
+        diff = {"added": [], "removed": [], "changed": []}
+        hashes = self.__get_subtree_hashes()
+        new_hashes = new_tree.__get_subtree_hashes()
+        pairs = []
+        if not len(self):
+            self.__copy_subtree(new_tree, 0, -1)
+            diff["added"] = self.get_text_nodes()
+        elif hashes[0] != new_hashes[0]:
+            self.__drop_indexes()
+            pairs.append((0, 0))
+        changed_nodes = []
+        while pairs:
+            node_index, new_index = pairs.pop()
+            hashes[node_index] = new_hashes[new_index]
+            if new_tree.__text_lengths[new_index]:
+                self.__set_text(node_index, new_tree.__get_text_bytes(new_index))
+                self.__set_mark_zones(node_index, new_tree.__get_mark_zones(new_index))
+                diff["changed"].append(node_index)
+                continue
+            changed_nodes.append(node_index)
+            self.__tags[node_index] = new_tree.__tags[new_index]
+            self.__classes[node_index] = self.__get_classes_id(
+                                new_tree.__class_sets[new_tree.__classes[new_index]])
+            #unchanged children are found by hash, the rest by tag and classes
+            old_children = self.__get_children(node_index)
+            by_hash = {}
+            for child_index in old_children:
+                by_hash.setdefault(hashes[child_index], deque()).append(child_index)
+            new_children = new_tree.__get_children(new_index)
+            children = []
+            for new_child in new_children:
+                same = by_hash.get(new_hashes[new_child])
+                children.append(same and same.popleft() or None)
+            if self.stats is not None:
+                self.stats.count("subtrees_reused", len(children) - children.count(None))
+            reused = set(children)
+            by_key = {}
+            for child_index in old_children:
+                if not child_index in reused:
+                    by_key.setdefault(self.__get_node_key(child_index), 
+                                      deque()).append(child_index)
+            for position, new_child in enumerate(new_children):
+                if children[position] is not None:
+                    continue
+                similar = by_key.get(new_tree.__get_node_key(new_child))
+                if similar:
+                    children[position] = similar.popleft()
+                    pairs.append((children[position], new_child))
+                    continue
+                copied = self.__copy_subtree(new_tree, new_child, node_index)
+                hashes.extend([None] * (len(self) - len(hashes)))
+                for copied_index, new_copied_index in copied:
+                    hashes[copied_index] = new_hashes[new_copied_index]
+                    if self.__text_lengths[copied_index]:
+                        diff["added"].append(copied_index)
+                children[position] = copied[0][0]
+            for similar in by_key.itervalues():
+                for child_index in similar:
+                    diff["removed"].extend(self.iter_text_nodes(child_index))
+                    self.__remove_node(child_index)
+            self.__set_children(node_index, children)
+        #descendants follow their ancestors in changed_nodes
+        for node_index in reversed(changed_nodes):
+            self.__text_counts[node_index] = sum([self.__text_counts[child_index] for child_index 
+                                                  in self.__get_children(node_index)])
+        self.__subtree_hashes = len(hashes) == len(self) and hashes or None
+        self.encoding = new_tree.encoding
+        self.url = new_tree.url
+        self.limits_hit = new_tree.limits_hit
+        self.__end_phase("update", started)
+        return diff
+
+    @classmethod
+    def get_config_digest(cls):
+        """ digest of the parser configuration: trees built from the same 
+        html with the same configuration are equal """
+        config = repr([sorted(cls.__TAGS_TO_SKIP), sorted(cls.__INLINE_TAGS), 
+                       sorted(cls.__BLOCK_TAGS), cls.__LINK_TAGS, 
+                       cls.__LINK_ATTRIBUTES, cls.__TREE_ROOT_TAG, 
+                       cls.__FORMAT_VERSION])
+        return md5(config).hexdigest()
+
+    def save(self, filename):
+        """ save the tree to a binary file, load() reads it back
+
+        interned tags, style classes and links are stored once, node and 
+        mark zone columns as packed integers, texts as the UTF-8 text buffer
+        """
+        tables = json.dumps([self.url, self.__TAG_NAMES, self.__class_sets, self.__links])
+        sections = [tables] + [column.tostring() for column in self.__get_columns()]
+        sections.append(str(self.__text_buffer))
+        with open(filename, "wb") as tree_file:
+            tree_file.write(pack(self.__FORMAT_HEADER, self.__FORMAT_MAGIC, 
+                                 self.__FORMAT_VERSION, sys.byteorder == "little", 
+                                 array("i").itemsize, len(sections)))
+            for section in sections:
+                tree_file.write(pack("<Q", len(section)))
+                tree_file.write(section)
+
+    @classmethod
+    def load(cls, filename):
+        """ load the tree saved with save(), columns are copied from 
+        the file as they are, without parsing 
+
+        raises ValueError, if the file is not a saved tree or it is truncated
+        """
+        with open(filename, "rb") as tree_file:
+            data = tree_file.read()
+        offset = calcsize(cls.__FORMAT_HEADER)
+        if len(data) < offset:
+            raise ValueError("%s is not a saved tree" % filename)
+        magic, version, is_little, item_size, sections_count = \
+            unpack(cls.__FORMAT_HEADER, data[:offset])
+        if magic != cls.__FORMAT_MAGIC:
+            raise ValueError("%s is not a saved tree" % filename)
+        if version != cls.__FORMAT_VERSION or item_size != array("i").itemsize:
+            raise ValueError("unsupported tree format version %d in %s" % 
+                             (version, filename))
+        tree = cls()
+        columns = tree.__get_columns()
+        #tables, columns and the text buffer
+        if sections_count != len(columns) + 2:
+            raise ValueError("%s is corrupted" % filename)
+        sections = []
+        for _ in xrange(sections_count):
+            if offset + 8 > len(data):
+                raise ValueError("%s is truncated" % filename)
+            length = unpack("<Q", data[offset:offset + 8])[0]
+            if offset + 8 + length > len(data):
+                raise ValueError("%s is truncated" % filename)
+            sections.append(data[offset + 8:offset + 8 + length])
+            offset += 8 + length
+        if offset != len(data):
+            raise ValueError("%s is corrupted" % filename)
+        url, tag_names, class_sets, links = json.loads(sections[0])
+        for column, section in zip(columns, sections[1:]):
+            if len(section) % column.itemsize:
+                raise ValueError("%s is corrupted" % filename)
+            column.fromstring(section)
+            if is_little != (sys.byteorder == "little"):
+                column.byteswap()
+        tree.__text_buffer = bytearray(sections[-1])
+        #node columns, then mark zone columns
+        if (len(set([len(column) for column in columns[:12]])) != 1 or 
+                len(set([len(column) for column in columns[12:]])) != 1 or 
+                max([text_start + text_length for text_start, text_length in 
+                     zip(tree.__text_starts, tree.__text_lengths)] or [0]) > 
+                    len(tree.__text_buffer)):
+            raise ValueError("%s is corrupted" % filename)
+        #tag ids are shared by all trees of the process
+        tag_ids = [tree.__get_tag_id(tag) for tag in tag_names]
+        if tag_ids != range(len(tag_ids)):
+            for column in (tree.__tags, tree.__zone_tags):
+                column[:] = array("i", [tag_ids[tag_id] for tag_id in column])
+        tree.__class_sets = [tuple(style_classes) for style_classes in class_sets]
+        tree.__class_set_ids = dict((style_classes, classes_id) for classes_id, style_classes
+                                    in enumerate(tree.__class_sets))
+        tree.__links = links
+        tree.__link_ids = dict((link, link_id) for link_id, link in enumerate(links))
+        tree.url = url
+        return tree
     
 
     def iterate_DFS(self, node_index, actor):
@@ -151,97 +875,914 @@ class HTMLTextBlocksTree(list):
          actor have to be a function or an object with method "act" declared as:    
          def act(self, tree, node_index)
         """     
-        if hasattr(actor, '__call__'):
-            actor(self, node_index);
-        else:
-            actor.act(self, node_index)
-        for child_index in self[node_index].child_indices:
-            self.iterate_DFS(child_index, actor)
+        if not hasattr(actor, '__call__'):
+            actor = actor.act
+        for node_index in self.iter_dfs(node_index):
+            actor(self, node_index)
+
+    def iter_dfs(self, node_index = 0, prune = None):
+        """ yield node indices of node_index's subtree in deep-first order 
+        (parents before children, children in document order)
+        
+        prune -- function prune(tree, node_index), if it returns True, 
+        the node is yielded, but its subtree is skipped
+        """
+        if not len(self):
+            return
+        stack = [node_index]
+        while stack:
+            node_index = stack.pop()
+            yield node_index
+            if prune is None or not prune(self, node_index):
+                stack.extend(reversed(self.__get_children(node_index)))
+
+    def iter_bfs(self, node_index = 0, prune = None):
+        """ yield node indices of node_index's subtree level by level
+        
+        prune -- same as in iter_dfs
+        """
+        if not len(self):
+            return
+        queue = deque([node_index])
+        while queue:
+            node_index = queue.popleft()
+            yield node_index
+            if prune is None or not prune(self, node_index):
+                queue.extend(self.__get_children(node_index))
+
+    def iter_text_nodes(self, node_index = 0, prune = None):
+        """ yield indices of text nodes of node_index's subtree 
+        in document order
+        
+        prune -- same as in iter_dfs
+        """
+        text_lengths = self.__text_lengths
+        for node_index in self.iter_dfs(node_index, prune):
+            if text_lengths[node_index]:
+                yield node_index
 
     def get_text_nodes(self):
         """get indexes of text nodes"""
-        class TextBasket():
-            def __init__(self, array):
-                self.array = array
-            def act(self, tree, node_index):
-                if tree[node_index].text:
-                    self.array += [node_index]
-        text_elements = []
-        self.iterate_DFS(0, TextBasket(text_elements))
-        return text_elements
+        return list(self.iter_text_nodes())
+
+    def get_text_signatures(self):
+        """get {text node index: signature}, signature is a 64 bit hash of 
+        the node's text and tags and style classes of all its ancestors, 
+        so it is the same for the same text block on other pages of a site
+        """
+        started = self.__start_phase()
+        signatures = {}
+        digests = len(self) and {0: md5(self.__TAG_NAMES[self.__tags[0]]).digest()} or {}
+        stack = digests.keys()
+        while stack:
+            node_index = stack.pop()
+            digest = digests.pop(node_index)
+            for child_index in self.__get_children(node_index):
+                if self.__text_lengths[child_index]:
+                    text = self.__get_text_bytes(child_index)
+                    child_digest = md5(digest + "\0" + text).digest()
+                    signatures[child_index] = unpack("<q", child_digest[:8])[0]
+                else:
+                    classes = sorted(self.__class_sets[self.__classes[child_index]])
+                    name = u"%s.%s" % (self.__TAG_NAMES[self.__tags[child_index]],
+                                       ".".join(classes))
+                    digests[child_index] = md5(digest + name.encode("utf8")).digest()
+                    stack.append(child_index)
+        self.__end_phase("get_text_signatures", started)
+        return signatures
+
+    def iter_records(self, groups = True):
+        """ yield a record per text node in document order: dict with keys 
+        node, path (tags and style classes of ancestors, html/body/div.post), 
+        text, mark_zones (dicts with MarkZone fields) and group (index of 
+        the group of get_similar_sense_texts or None)
+
+        groups -- False not to group texts, True to group them, or groups 
+                  already found with get_similar_sense_texts
+        """
+        group_ids = {}
+        if groups is True:
+            groups = self.get_similar_sense_texts()
+        if groups:
+            for group_id, group in enumerate(groups):
+                for node_index in group:
+                    group_ids[node_index] = group_id
+        #paths of blocks are built once, they are shared by their texts
+        stack = [(child_index, u"") for child_index 
+                 in reversed(len(self) and self.__get_children(0) or [])]
+        while stack:
+            node_index, path = stack.pop()
+            if not self.__text_lengths[node_index]:
+                name = u".".join((self.__TAG_NAMES[self.__tags[node_index]],) + 
+                                 self.__class_sets[self.__classes[node_index]])
+                path = path and u"%s/%s" % (path, name) or name
+                stack.extend([(child_index, path) for child_index 
+                              in reversed(self.__get_children(node_index))])
+                continue
+            first_zone = self.__first_zones[node_index]
+            mark_zones = [{"start": self.__zone_starts[zone_index], 
+                           "length": self.__zone_lengths[zone_index], 
+                           "tag": self.__TAG_NAMES[self.__zone_tags[zone_index]], 
+                           "style_classes": list(self.__class_sets[
+                                                    self.__zone_classes[zone_index]]), 
+                           "link": self.__links[self.__zone_links[zone_index]]}
+                          for zone_index in xrange(first_zone, first_zone + 
+                                                   self.__zone_counts[node_index])]
+            yield {"node": node_index, 
+                   "path": path, 
+                   "text": self.__get_text(node_index), 
+                   "mark_zones": mark_zones, 
+                   "group": group_ids.get(node_index)}
+
+    def get_context_signatures(self):
+        """get {text node index: signature}, signature is a 64 bit hash of 
+        tags and style classes of the node's ancestors and of __CONTEXT_LENGTH 
+        siblings around every one of them; a run of siblings with the same 
+        tag and classes counts as one sibling, so texts of list items 
+        (records) at the same place have the same signature on all pages 
+        of a site, whatever their texts and positions in the list are
+        """
+        started = self.__start_phase()
+        signatures = {}
+        keys = {}
+        def get_key(node_index):
+            key = (self.__tags[node_index], self.__classes[node_index])
+            if not key in keys:
+                name = u"%s.%s" % (self.__TAG_NAMES[key[0]], 
+                                   ".".join(sorted(self.__class_sets[key[1]])))
+                keys[key] = name.encode("utf8")
+            return keys[key]
+        digests = len(self) and {0: md5(get_key(0)).digest()} or {}
+        stack = digests.keys()
+        while stack:
+            node_index = stack.pop()
+            digest = digests.pop(node_index)
+            children = self.__get_children(node_index)
+            run_keys = []
+            runs = []
+            for child_index in children:
+                child_key = get_key(child_index)
+                if not run_keys or run_keys[-1] != child_key:
+                    run_keys.append(child_key)
+                runs.append(len(run_keys) - 1)
+            for child_index, run in zip(children, runs):
+                context_start = max(0, run - self.__CONTEXT_LENGTH)
+                context = run_keys[context_start:run + self.__CONTEXT_LENGTH + 1]
+                child_digest = md5("%s%d\0%s" % (digest, run - context_start, 
+                                                 "\0".join(context))).digest()
+                if self.__text_lengths[child_index]:
+                    signatures[child_index] = unpack("<q", child_digest[:8])[0]
+                else:
+                    digests[child_index] = child_digest
+                    stack.append(child_index)
+        self.__end_phase("get_context_signatures", started)
+        return signatures
         
     def get_similar_sense_texts(self):
         """ get groups of text nodes with similar contexts, \
             therefore presumably with similar sense
+            
+            two paths match only when they have the same length, their nodes 
+            below the deepest common parent have the same sibling contexts and 
+            the nodes just below it are in one run of same siblings, so text 
+            nodes are indexed by the common parent and contexts below it, and 
+            exact path checks run only for nodes found in the range of the run
+            
+            paths start at the deepest common parent of the texts, which have 
+            a chance to be grouped, as nodes above it are shared by all of them
         """
-        text_elements = self.get_text_nodes()     
-        text_elements = [(self.__get_node_depth(node_index), node_index) for node_index in text_elements]        
-        text_elements.sort() # dont't match elements with different depth
+        started = self.__start_phase()
+        depths, signatures, dfs_order = self.__get_tag_paths()
+        text_elements = [(depths[node_index], node_index) 
+                         for node_index in self.get_text_nodes()]
+        # dont't match elements with different depth, texts of one depth 
+        # stay in document order, whatever their indices are
+        text_elements.sort(key = lambda element: element[0])
+        #nodes with different tag paths never match, texts alone in their 
+        #buckets are not indexed
+        buckets = {}
+        for depth, node_index in text_elements:
+            buckets.setdefault((depth, signatures[node_index]), []).append(node_index)
+        bucketed = set()
+        for bucket in buckets.itervalues():
+            if len(bucket) > 1:
+                bucketed.update(bucket)
+        text_elements = [(depth, node_index) for depth, node_index in text_elements 
+                         if node_index in bucketed]
+        paths = {}
+        counts = None
+        if bucketed:
+            counts = self.__count_in_subtrees(bucketed, dfs_order)
+            top_index = self.__get_common_parent(counts)
+            paths = dict([(node_index, self.__build_path(node_index, top_index)) 
+                          for node_index in bucketed])
+        orders = dict([(node_index, order) for order, (_, node_index) 
+                       in enumerate(text_elements)])
+        siblings = {}
+        windows = {}
+        candidates = self.__index_path_contexts(text_elements, paths, orders, 
+                                                counts, siblings, windows)
         groups = []
         used = set();        
         matched_nodes = {}
-        for index in xrange(len(text_elements)):
-            depth, node_index = text_elements[index]
+        path_comparisons = 0
+        deadline = self.__get_deadline()
+        for _, node_index in text_elements:
             if node_index in used:
                 continue;
+            if deadline is not None and time.time() > deadline:
+                self.__hit_limit("max_seconds")
+                break
+            path = paths[node_index]
+            order = orders[node_index]
             fellows_by_matched_len = {}
-            for compare_index in xrange(index + 1, len(text_elements)):
-                cmp_depth, cmp_node_index = text_elements[compare_index]
-                if cmp_depth != depth:
-                    break; # dont't match elements with different depth
-                if cmp_node_index in used:
-                    continue                
-                if self.__check_paths_equality(node_index, cmp_node_index, matched_nodes):
-                    matched_len = self.__get_matched_path_len(node_index, 
-                                                             cmp_node_index)
-                    fellows_by_matched_len.setdefault(matched_len, []).append(cmp_node_index)
+            for depth, key in self.__iter_path_contexts(path, counts, siblings, 
+                                                        windows):
+                positions, cmp_orders, cmp_node_indices = candidates[key]
+                if len(positions) < 2:
+                    continue
+                _, sibling_positions, _ = self.__get_siblings(path[depth - 1], siblings)
+                position = sibling_positions[path[depth]]
+                reach = self.__get_reach(path[depth], siblings)
+                for compare_index in xrange(bisect_right(positions, position), 
+                                            bisect_left(positions, reach)):
+                    cmp_node_index = cmp_node_indices[compare_index]
+                    if cmp_orders[compare_index] <= order or cmp_node_index in used:
+                        continue
+                    path_comparisons += 1
+                    if self.__check_paths_equality(path, paths[cmp_node_index], 
+                                                   matched_nodes, siblings):
+                        fellows_by_matched_len.setdefault(len(path) - depth, []).append(
+                                            (cmp_orders[compare_index], cmp_node_index))
             if fellows_by_matched_len:
                 fellows = [];
                 for group in fellows_by_matched_len.values():
                     if len(group) > len(fellows):
                         fellows = group
+                fellows = [fellow[1] for fellow in sorted(fellows)]
                 groups += [[node_index] + fellows]
-                used = used | set(fellows)
+                used.update(fellows)
+        if self.stats is not None:
+            self.stats.count("path_comparisons", path_comparisons)
+            self.stats.count("matched_nodes_misses", len(matched_nodes))
+            self.__end_phase("get_similar_sense_texts", started)
         return groups
 
+    def index_structure(self):
+        """ opt in to the structural index: depths, Euler tour times, 
+        positions among siblings and a binary lifting table of ancestors 
+        are built once (and again, when they are needed after the tree was 
+        changed); get_similar_sense_texts takes positions among siblings 
+        from it and skips common parents of long paths with it
+        """
+        self.__structure_enabled = True
+        self.__get_structure()
+
+    def get_depth(self, node_index):
+        """ number of ancestors of the node (root has depth 0), O(1) """
+        return self.__get_structure().depths[node_index]
+
+    def is_ancestor(self, ancestor_index, node_index):
+        """ ancestor_index is node_index or one of its ancestors, O(1) """
+        structure = self.__get_structure()
+        return (structure.entries[ancestor_index] <= structure.entries[node_index] and 
+                structure.exits[node_index] <= structure.exits[ancestor_index])
+
+    def get_common_ancestor(self, first_index, second_index):
+        """ the lowest common ancestor of two nodes, O(log(depth)) """
+        structure = self.__get_structure()
+        entries, exits = structure.entries, structure.exits
+        second_entry, second_exit = entries[second_index], exits[second_index]
+        if entries[first_index] <= second_entry and second_exit <= exits[first_index]:
+            return first_index
+        ancestors = structure.ancestors
+        for level in xrange(len(ancestors) - 1, -1, -1):
+            ancestor_index = ancestors[level][first_index]
+            if not (entries[ancestor_index] <= second_entry and 
+                    second_exit <= exits[ancestor_index]):
+                first_index = ancestor_index
+        return ancestors[0][first_index]
+
+    def get_sibling_position(self, node_index):
+        """ position of the node in child_indices of its parent, O(1) """
+        return self.__get_structure().positions[node_index]
+
+    FEATURES = ("depth", "text_length", "words_count", "link_length", "link_density", 
+                "mark_zones_count", "siblings_count", "sibling_position", 
+                "parent_text_nodes_count", "group", "group_size")
+
+    def get_features(self, hashed_dimension = 2 ** 18, similar_sense = True):
+        """ feature matrix of text nodes for classifiers (requires numpy), 
+        same as get_feature_matrices([tree]) """
+        return self.get_feature_matrices([self], hashed_dimension, similar_sense)
+
+    @classmethod
+    def get_feature_matrices(cls, trees, hashed_dimension = 2 ** 18, similar_sense = True):
+        """ features of text nodes of all trees in one pass over the columns 
+        (requires numpy), rows are text nodes in document order
+        
+        returns dict:
+        "documents", "nodes" -- position of the tree in trees and node index of rows
+        "dense" -- float matrix, a column per name in HTMLTextBlocksTree.FEATURES;
+                   group is the index of the node's group of similar sense 
+                   texts (-1 if none, or similar_sense is False)
+        "hashed_indices", "hashed_indptr" -- binary features hashed into 
+                   hashed_dimension columns (tags, style classes and tag 
+                   path of ancestors, tags and classes of mark zones), 
+                   rows in CSR form: scipy.sparse.csr_matrix((numpy.ones(
+                   len(indices)), indices, indptr), shape=(rows, hashed_dimension))
+        """
+        if numpy is None:
+            raise ImportError("numpy is required for feature matrices")
+        columns = {"documents": array("i"), "nodes": array("i"), "dense": array("d"), 
+                   "hashed_indices": array("i"), "hashed_indptr": array("i", [0])}
+        for document, tree in enumerate(trees):
+            tree.__collect_features(document, columns, hashed_dimension, similar_sense)
+        matrices = {}
+        for name in ("documents", "nodes", "hashed_indices", "hashed_indptr"):
+            matrices[name] = numpy.frombuffer(columns[name], dtype = numpy.intc).copy()
+        matrices["dense"] = numpy.frombuffer(columns["dense"], dtype = numpy.float64).reshape(
+                                            (len(columns["nodes"]), len(cls.FEATURES))).copy()
+        return matrices
+
+    def find_by_tag(self, tag):
+        """ indices of nodes with the tag in document order """
+        tag_id = self.__TAG_IDS.get(tag)
+        return list(self.__get_indexes().by_tag.get(tag_id, ()))
+
+    def find_by_class(self, style_class):
+        """ indices of nodes with the style class and of text nodes covered 
+        by inline elements with it in document order """
+        return list(self.__get_indexes().by_class.get(style_class, ()))
+
+    def find_by_depth(self, depth):
+        """ indices of nodes with depth ancestors (root has depth 0) """
+        return list(self.__get_indexes().by_depth.get(depth, ()))
+
+    def find_by_link_domain(self, domain):
+        """ (text node index, mark zone position) for links to the domain, 
+        relative links are resolved against tree.url """
+        return list(self.__get_indexes().by_link_domain.get(domain.lower(), ()))
+
+    def select(self, selector):
+        """ indices of nodes matching a CSS-like selector in document order
+
+        selector is a chain of compound selectors joined by " " (descendant)
+        or ">" (child): tag (or *), .class-es and attributes [href], [text] 
+        with =, *=, ^=, $= operators, e.g. div.post > p, ul.menu a[href*=news]
+
+        inline elements (a, b, span...) are not nodes of the tree, a compound 
+        selector with inline tag or [href] matches text nodes covered by 
+        such a mark zone, so it can be only the last one in the chain; 
+        a compound of style classes only matches such text nodes too
+
+        [text] is the text of a text node, blocks have no text of their own: 
+        li[text^=Price] is an error, li > [text^=Price] selects texts of 
+        list items starting with Price
+        """
+        compounds = self.__parse_selector(selector)
+        indexes = self.__get_indexes()
+        tag, classes, _, is_inline = compounds[-1][1]
+        if is_inline:
+            candidates = indexes.by_zone_tag.get(self.__TAG_IDS.get(tag), ())
+            if tag is None:
+                candidates = indexes.text_nodes
+        elif tag is not None:
+            candidates = indexes.by_tag.get(self.__TAG_IDS.get(tag), ())
+        elif classes:
+            candidates = min([indexes.by_class.get(style_class, ()) 
+                              for style_class in classes], key = len)
+        else:
+            candidates = indexes.nodes
+        return [node_index for node_index in candidates 
+                if self.__match_selector(node_index, compounds, len(compounds) - 1)]
+
     """ private methods further """
-    
+
+    class __Indexes(object):
+        """lazily built indexes of nodes, that are a part of the tree, 
+        lists of node indices are in document order
+        
+        by_tag, by_class, by_depth -- tag id, style class, depth to nodes, 
+                                      by_class has text nodes covered by 
+                                      mark zones with the style class too
+        by_zone_tag -- tag id of mark zones to text nodes, they cover
+        by_link_domain -- domain of link to (text node, zone position)
+        """
+        __slots__ = ("nodes", "text_nodes", "by_tag", "by_class", "by_depth", 
+                     "by_zone_tag", "by_link_domain")
+        def __init__(self):
+            self.nodes = []
+            self.text_nodes = []
+            self.by_tag = {}
+            self.by_class = {}
+            self.by_depth = {}
+            self.by_zone_tag = {}
+            self.by_link_domain = {}
+
+    def __get_indexes(self):
+        """ build indexes on the first query after the tree was changed """
+        if self.__indexes is not None:
+            return self.__indexes
+        indexes = self.__Indexes()
+        class_sets = self.__class_sets
+        zone_tags, zone_classes = self.__zone_tags, self.__zone_classes
+        zone_links, links = self.__zone_links, self.__links
+        domains = {}
+        stack = len(self) and [(0, 0)] or []
+        while stack:
+            node_index, depth = stack.pop()
+            indexes.nodes.append(node_index)
+            indexes.by_tag.setdefault(self.__tags[node_index], []).append(node_index)
+            for style_class in class_sets[self.__classes[node_index]]:
+                indexes.by_class.setdefault(style_class, []).append(node_index)
+            indexes.by_depth.setdefault(depth, []).append(node_index)
+            if self.__text_lengths[node_index]:
+                indexes.text_nodes.append(node_index)
+                first_zone = self.__first_zones[node_index]
+                for position in xrange(self.__zone_counts[node_index]):
+                    zone_index = first_zone + position
+                    by_zone_tag = indexes.by_zone_tag.setdefault(zone_tags[zone_index], [])
+                    if not by_zone_tag or by_zone_tag[-1] != node_index:
+                        by_zone_tag.append(node_index)
+                    for style_class in class_sets[zone_classes[zone_index]]:
+                        by_class = indexes.by_class.setdefault(style_class, [])
+                        if not by_class or by_class[-1] != node_index:
+                            by_class.append(node_index)
+                    link_id = zone_links[zone_index]
+                    if link_id:
+                        if not link_id in domains:
+                            link = urljoin(self.url or "", links[link_id])
+                            domains[link_id] = urlsplit(link).netloc.lower()
+                        indexes.by_link_domain.setdefault(domains[link_id], []).append(
+                                                                (node_index, position))
+            for child_index in reversed(self.__get_children(node_index)):
+                stack.append((child_index, depth + 1))
+        self.__indexes = indexes
+        return indexes
+
+    def __get_subtree_hashes(self):
+        """ list of md5 digests of subtrees (tags, style classes, texts and 
+        mark zones), built on the first call after the tree was changed """
+        if self.__subtree_hashes is not None:
+            return self.__subtree_hashes
+        started = self.__start_phase()
+        hashes = [None] * len(self)
+        tags, classes = self.__tags, self.__classes
+        text_starts, text_lengths = self.__text_starts, self.__text_lengths
+        first_zones, zone_counts = self.__first_zones, self.__zone_counts
+        first_children, next_siblings = self.__first_children, self.__next_siblings
+        removed = self.__removed
+        names = {}
+        get_name = lambda classes_id: " ".join(self.__class_sets[classes_id]).encode("utf8")
+        for node_index in reversed(list(self.iter_dfs())):
+            classes_id = classes[node_index]
+            if not classes_id in names:
+                names[classes_id] = get_name(classes_id)
+            digest = md5("%s\0%s\0" % (self.__TAG_NAMES[tags[node_index]], names[classes_id]))
+            if text_lengths[node_index]:
+                text_start = text_starts[node_index]
+                digest.update(self.__text_buffer[text_start:text_start + 
+                                                 text_lengths[node_index]])
+            first_zone = first_zones[node_index]
+            for zone_index in xrange(first_zone, first_zone + zone_counts[node_index]):
+                digest.update("\0%d %d %s %s " % (
+                                self.__zone_starts[zone_index], self.__zone_lengths[zone_index],
+                                self.__TAG_NAMES[self.__zone_tags[zone_index]],
+                                get_name(self.__zone_classes[zone_index])))
+                digest.update(self.__links[self.__zone_links[zone_index]].encode("utf8"))
+            child_index = first_children[node_index]
+            while child_index != -1:
+                if not removed[child_index]:
+                    digest.update(hashes[child_index])
+                child_index = next_siblings[child_index]
+            hashes[node_index] = digest.digest()
+        self.__subtree_hashes = hashes
+        self.__end_phase("subtree_hashes", started)
+        return hashes
+
+    def __collect_features(self, document, columns, hashed_dimension, similar_sense):
+        """ append rows of text nodes to columns of get_feature_matrices """
+        started = self.__start_phase()
+        groups = {}
+        if similar_sense:
+            for group_id, group in enumerate(self.get_similar_sense_texts()):
+                for node_index in group:
+                    groups[node_index] = (group_id, len(group))
+        get_hash = lambda token: (zlib.crc32(token.encode("utf8")) & 0xffffffff) % hashed_dimension
+        tag_names, class_sets = self.__TAG_NAMES, self.__class_sets
+        #hashed features of ancestors and mark zones by (tag id, classes id)
+        tokens_cache = {}
+        def get_tokens(tag_id, classes_id, prefix):
+            tokens = tokens_cache.get((prefix, tag_id, classes_id))
+            if tokens is None:
+                tag = tag_names[tag_id]
+                tokens = [u"%s:%s" % (prefix, tag)]
+                for style_class in class_sets[classes_id]:
+                    tokens += [u"%s.:%s" % (prefix, style_class), 
+                               u"%s:%s.%s" % (prefix, tag, style_class)]
+                tokens = tokens_cache[(prefix, tag_id, classes_id)] = \
+                                                    tuple([get_hash(token) for token in tokens])
+            return tokens
+        dense, hashed_indices = columns["dense"], columns["hashed_indices"]
+        text_lengths, text_counts = self.__text_lengths, self.__text_counts
+        #node, depth, path hash, hashed features of ancestors, siblings, position
+        stack = len(self) and [(0, 0, 0, (), 1, 0)] or []
+        while stack:
+            node_index, depth, path_hash, path_tokens, siblings, position = stack.pop()
+            parent_index = self.__parents[node_index]
+            if not text_lengths[node_index]:
+                path_hash = zlib.crc32(tag_names[self.__tags[node_index]], path_hash)
+                path_tokens += get_tokens(self.__tags[node_index], 
+                                          self.__classes[node_index], u"t")
+                children = self.__get_children(node_index)
+                for child_position in xrange(len(children) - 1, -1, -1):
+                    stack.append((children[child_position], depth + 1, path_hash, 
+                                  path_tokens, len(children), child_position))
+                continue
+            text = self.__get_text(node_index)
+            link_length = 0
+            tokens = set(path_tokens)
+            tokens.add(get_hash(u"p:%d" % path_hash))
+            first_zone = self.__first_zones[node_index]
+            zones_count = self.__zone_counts[node_index]
+            for zone_index in xrange(first_zone, first_zone + zones_count):
+                if self.__zone_links[zone_index]:
+                    link_length += self.__zone_lengths[zone_index]
+                tokens.update(get_tokens(self.__zone_tags[zone_index], 
+                                         self.__zone_classes[zone_index], u"z"))
+            group_id, group_size = groups.get(node_index, (-1, 0))
+            columns["documents"].append(document)
+            columns["nodes"].append(node_index)
+            dense.extend((depth, len(text), len(text.split()), link_length, 
+                          float(link_length) / max(len(text), 1), zones_count, 
+                          siblings - 1, position, 
+                          parent_index > -1 and text_counts[parent_index] or 0, 
+                          group_id, group_size))
+            hashed_indices.extend(sorted(tokens))
+            columns["hashed_indptr"].append(len(hashed_indices))
+        self.__end_phase("features", started)
+
+    def __get_node_key(self, node_index):
+        """ nodes of two versions of a page with the same key are 
+        the same element with changed content """
+        return self.__tags[node_index], self.__class_sets[self.__classes[node_index]]
+
+    def __copy_subtree(self, tree, node_index, parent_index):
+        """ append node_index's subtree of another tree as the last child 
+        of parent_index, returns [(new index, index in the tree)] in 
+        deep-first order """
+        copied = []
+        mapping = {}
+        for source_index in tree.iter_dfs(node_index):
+            source_parent = tree.__parents[source_index]
+            new_index = self.__add_node(
+                            mapping.get(source_parent, parent_index),
+                            tree.__tags[source_index],
+                            self.__get_classes_id(tree.__class_sets[tree.__classes[source_index]]),
+                            tree.__get_text_bytes(source_index),
+                            tree.__get_mark_zones(source_index))
+            self.__text_counts[new_index] = tree.__text_counts[source_index]
+            mapping[source_index] = new_index
+            copied.append((new_index, source_index))
+        return copied
+
+    __SELECTOR_PARTS = re.compile(r"\s*(>)\s*|\s+")
+    __COMPOUND = re.compile(r"^([\w-]+|\*)?((?:\.[\w-]+)*)((?:\[[^\]]*\])*)$")
+    __ATTRIBUTE = re.compile(r"""\[\s*(href|text)\s*(?:([*^$]?=)\s*(["']?)(.*?)\3\s*)?\]""")
+    #parsed selectors, least recently used ones are dropped
+    __SELECTORS = OrderedDict()
+    __SELECTORS_LOCK = threading.Lock()
+    __MAX_SELECTORS = 1024
+
+    def __parse_selector(self, selector):
+        """ list of (combinator, (tag, classes, attributes, is_inline)), 
+        combinator of the first compound is None """
+        with self.__SELECTORS_LOCK:
+            compounds = self.__SELECTORS.pop(selector, None)
+            if compounds is not None:
+                self.__SELECTORS[selector] = compounds
+                return compounds
+        compounds = []
+        combinator = None
+        for part in self.__SELECTOR_PARTS.split(selector.strip()):
+            if not part:
+                continue
+            if part == ">":
+                if combinator is not None or not compounds:
+                    raise ValueError("bad selector %r" % selector)
+                combinator = ">"
+                continue
+            match = self.__COMPOUND.match(part)
+            if match is None:
+                raise ValueError("bad selector %r" % selector)
+            tag, classes, attributes = match.groups()
+            tag = tag != "*" and tag and tag.lower() or None
+            attributes = self.__ATTRIBUTE.findall(attributes)
+            attributes = [(name, operator, value) 
+                          for name, operator, _, value in attributes]
+            is_inline = (tag in self.__INLINE_TAGS or 
+                         "href" in [name for name, _, _ in attributes])
+            if compounds and compounds[-1][1][3]:
+                raise ValueError("inline element can only be the last in %r" % selector)
+            if tag is not None and not is_inline and "text" in [name for name, _, _ 
+                                                                in attributes]:
+                raise ValueError("blocks have no text of their own, select their "
+                                 "text nodes: %s > [text...] in %r" % (tag, selector))
+            compounds.append((compounds and (combinator or " ") or None, 
+                              (tag, tuple(classes.split(".")[1:]), attributes, is_inline)))
+            combinator = None
+        if not compounds or combinator is not None:
+            raise ValueError("bad selector %r" % selector)
+        with self.__SELECTORS_LOCK:
+            self.__SELECTORS[selector] = compounds
+            while len(self.__SELECTORS) > self.__MAX_SELECTORS:
+                self.__SELECTORS.popitem(last = False)
+        return compounds
+
+    def __match_selector(self, node_index, compounds, position):
+        """ node_index matches compounds[position], its ancestors match 
+        the rest of the chain """
+        if not self.__match_compound(node_index, compounds[position][1]):
+            return False
+        if not position:
+            return True
+        combinator = compounds[position][0]
+        parent_index = self.__parents[node_index]
+        while parent_index > -1:
+            if self.__match_selector(parent_index, compounds, position - 1):
+                return True
+            if combinator == ">":
+                return False
+            parent_index = self.__parents[parent_index]
+        return False
+
+    def __match_compound(self, node_index, compound):
+        tag, classes, attributes, is_inline = compound
+        for name, operator, value in attributes:
+            if name == "text" and not self.__match_attribute(
+                                        self.__get_text(node_index), operator, value):
+                return False
+        if not is_inline:
+            if tag is not None and self.__TAG_NAMES[self.__tags[node_index]] != tag:
+                return False
+            node_classes = self.__class_sets[self.__classes[node_index]]
+            if not [style_class for style_class in classes 
+                    if not style_class in node_classes]:
+                return True
+            if tag is not None or not self.__text_lengths[node_index]:
+                return False
+            #.class matches a text node covered by an inline element with it
+        #text node covered by a mark zone of the inline element
+        first_zone = self.__first_zones[node_index]
+        for zone_index in xrange(first_zone, first_zone + self.__zone_counts[node_index]):
+            if tag is not None and self.__TAG_NAMES[self.__zone_tags[zone_index]] != tag:
+                continue
+            zone_classes = self.__class_sets[self.__zone_classes[zone_index]]
+            if [style_class for style_class in classes if not style_class in zone_classes]:
+                continue
+            link = self.__links[self.__zone_links[zone_index]]
+            if [name for name, operator, value in attributes if name == "href" and 
+                    not (link and self.__match_attribute(link, operator, value))]:
+                continue
+            return True
+        return False
+
+    def __match_attribute(self, text, operator, value):
+        if not operator:
+            return bool(text)
+        if operator == "=":
+            return text == value
+        if operator == "*=":
+            return value in text
+        if operator == "^=":
+            return text.startswith(value)
+        return text.endswith(value)
+
+
+    class __Structure(object):
+        """structural index of nodes, that are a part of the tree
+
+        depths -- number of ancestors, -1 for removed nodes
+        entries, exits -- Euler tour times of entering and leaving the node, 
+                          a node is an ancestor of another one, if its 
+                          interval contains the other's one
+        positions -- position among children of the parent
+        ancestors -- ancestors[level][node] is the ancestor 2 ** level 
+                     levels up (root for the higher ones)
+        """
+        __slots__ = ("depths", "entries", "exits", "positions", "ancestors")
+
+    def __get_structure(self):
+        """ build the structural index on the first call after the tree 
+        was changed """
+        if self.__structure is not None:
+            return self.__structure
+        started = self.__start_phase()
+        structure = self.__Structure()
+        nodes_count = len(self)
+        depths = structure.depths = array("i", [-1]) * nodes_count
+        entries = structure.entries = array("i", [-1]) * nodes_count
+        exits = structure.exits = array("i", [-1]) * nodes_count
+        positions = structure.positions = array("i", [0]) * nodes_count
+        parents = array("i", [0]) * nodes_count
+        time_counter = 0
+        max_depth = 0
+        #node and its depth, exits are marked with negative depths
+        stack = nodes_count and [(0, 0)] or []
+        while stack:
+            node_index, depth = stack.pop()
+            if depth < 0:
+                exits[node_index] = time_counter
+                time_counter += 1
+                continue
+            depths[node_index] = depth
+            entries[node_index] = time_counter
+            time_counter += 1
+            if depth > max_depth:
+                max_depth = depth
+            stack.append((node_index, -1))
+            children = self.__get_children(node_index)
+            for position, child_index in enumerate(children):
+                positions[child_index] = position
+                parents[child_index] = node_index
+            stack.extend([(child_index, depth + 1) for child_index in reversed(children)])
+        ancestors = structure.ancestors = [parents]
+        for _ in xrange(1, max(max_depth.bit_length(), 1)):
+            lower = ancestors[-1]
+            ancestors.append(array("i", [lower[ancestor_index] for ancestor_index in lower]))
+        self.__structure = structure
+        self.__end_phase("index_structure", started)
+        return structure
+
     def __get_node_depth(self, node_index):
         """length of the node path"""
+        if self.__structure_enabled:
+            return self.get_depth(node_index) + 1
+        parents = self.__parents
         depth = 1;
-        while self[node_index].parent_index > -1:
+        while parents[node_index] > -1:
             depth += 1;
-            node_index = self[node_index].parent_index;
+            node_index = parents[node_index];
         return depth;
     
-    def __build_path(self, node_index):
-        """ all node's ancestors starting from root """
+    def __build_path(self, node_index, top_index = 0):
+        """ node's ancestors starting from top_index (root by default) """
+        parents = self.__parents
         path = [node_index];
-        while self[node_index].parent_index > -1:
-            path += [self[node_index].parent_index]
-            node_index = self[node_index].parent_index
+        while node_index != top_index:
+            node_index = parents[node_index]
+            path.append(node_index)
         path.reverse()
         return path
+
+    def __get_tag_paths(self):
+        """ depths and hashes of tag paths of nodes and nodes in depth first 
+        order, the hash of a node is built of its parent's one and its tag, 
+        so paths themselves are not built """
+        nodes_count = len(self)
+        depths = array("i", [-1]) * nodes_count
+        signatures = [None] * nodes_count
+        order = []
+        if not nodes_count:
+            return depths, signatures, order
+        depths[0] = 0
+        signatures[0] = hash(self.__tags[0])
+        stack = [0]
+        while stack:
+            node_index = stack.pop()
+            order.append(node_index)
+            for child_index in self.__get_children(node_index):
+                depths[child_index] = depths[node_index] + 1
+                signatures[child_index] = hash((signatures[node_index], 
+                                                self.__tags[child_index]))
+                stack.append(child_index)
+        return depths, signatures, order
+
+    def __count_in_subtrees(self, node_indices, order):
+        """ numbers of nodes of node_indices in subtrees of all nodes, 
+        order is a depth first order of nodes """
+        counts = array("i", [0]) * len(self)
+        for node_index in node_indices:
+            counts[node_index] = 1
+        parents = self.__parents
+        for node_index in reversed(order):
+            if parents[node_index] > -1:
+                counts[parents[node_index]] += counts[node_index]
+        return counts
+
+    def __get_common_parent(self, counts):
+        """ the deepest node, subtree of which has all counted nodes """
+        top_index = 0
+        while counts[top_index] > 1:
+            for child_index in self.__get_children(top_index):
+                if counts[child_index] == counts[top_index]:
+                    top_index = child_index
+                    break
+            else:
+                break
+        return top_index
+
+    def __get_siblings(self, parent_index, siblings):
+        """ children of parent_index, their positions and connection reaches,
+        cached in siblings 
+        """
+        cached = siblings.get(parent_index)
+        if cached is None:
+            children = self.__get_children(parent_index)
+            if self.__structure_enabled:
+                positions = self.__get_structure().positions
+            else:
+                positions = dict([(child_index, position) for position, child_index 
+                                  in enumerate(children)])
+            cached = siblings[parent_index] = (children, positions, {})
+        return cached
     
-    def __check_connection(self, first_index, second_index):
+    def __check_connection(self, first_index, second_index, siblings):
         """ check if first_index and second_index elements are childs \
             of the same node and all siblings between them have same tag
             
             actually it checks if the first and the second are elements of list 
             of same type objects
         """
-        siblings = self[self[first_index].parent_index].child_indices
-        start = siblings.index(first_index) + 1
-        end = siblings.index(second_index) + 1
-        for index in xrange(start, end):            
-            if not self.__check_tag_match(self[first_index], self[siblings[index]]):
-                return False
-        return True
+        _, positions, _ = self.__get_siblings(self.__parents[first_index], siblings)
+        if positions[second_index] < positions[first_index]:
+            first_index, second_index = second_index, first_index
+        return positions[second_index] < self.__get_reach(first_index, siblings)
+
+    def __get_reach(self, first_index, siblings):
+        """ position of the first sibling after first_index that doesn't match it, 
+        siblings with the same tag and classes in the run have the same reach """
+        children, positions, reaches = self.__get_siblings(self.__parents[first_index], 
+                                                           siblings)
+        reach = reaches.get(first_index)
+        if reach is None:
+            reach = positions[first_index] + 1
+            while (reach < len(children) and 
+                   self.__check_tag_match(first_index, children[reach])):
+                reach += 1
+            key = (self.__tags[first_index], self.__classes[first_index])
+            for position in xrange(positions[first_index], reach):
+                child_index = children[position]
+                if (self.__tags[child_index], self.__classes[child_index]) == key:
+                    reaches[child_index] = reach
+        return reach
+
+    def __iter_path_contexts(self, path, counts, siblings, windows):
+        """ yield (depth, key) for every depth of the path below its start, 
+        key is the node at depth - 1, the tag at depth and a hash of the path 
+        length and tags of sibling contexts of the path nodes deeper than depth: 
+        paths, that diverge at depth, match only if their keys there are the same
+        
+        counts are numbers of grouped texts in subtrees, depths, where the 
+        parent has no grouped texts besides ones below the node, are skipped: 
+        no path diverges there; windows caches hashes of sibling contexts of nodes
+        """
+        context = hash((len(path), self.__tags[path[-1]]))
+        for depth in xrange(len(path) - 1, 0, -1):
+            node_index = path[depth]
+            if counts[node_index] < counts[path[depth - 1]]:
+                yield depth, (path[depth - 1], self.__tags[node_index], context)
+            window = windows.get(node_index)
+            if window is None:
+                children, positions, _ = self.__get_siblings(path[depth - 1], siblings)
+                position = positions[node_index]
+                context_start = max(0, position - self.__CONTEXT_LENGTH)
+                window = windows[node_index] = hash((position - context_start, 
+                                tuple([self.__tags[child_index] for child_index in 
+                                       children[context_start:position + 
+                                                self.__CONTEXT_LENGTH + 1]])))
+            context = hash((context, window))
+
+    def __index_path_contexts(self, text_elements, paths, orders, counts, 
+                              siblings, windows):
+        """ {key of __iter_path_contexts: (positions of path nodes at the depth 
+        among their siblings, orders of text nodes, text nodes)} sorted by 
+        positions """
+        entries = {}
+        for _, node_index in text_elements:
+            path = paths[node_index]
+            for depth, key in self.__iter_path_contexts(path, counts, siblings, 
+                                                        windows):
+                _, positions, _ = self.__get_siblings(path[depth - 1], siblings)
+                entries.setdefault(key, []).append((positions[path[depth]], 
+                                                    orders[node_index], node_index))
+        candidates = {}
+        for key, key_entries in entries.iteritems():
+            key_entries.sort()
+            candidates[key] = [list(column) for column in zip(*key_entries)]
+        return candidates
     
-    def __get_matched_path_len(self, first, second):
+    def __is_long_path(self, path):
+        """ common parents of long paths are found with the structural 
+        index, short ones are faster to compare level by level """
+        return self.__structure_enabled and len(path) > self.__SHORT_PATH_LENGTH
+
+    def __get_matched_path_len(self, first_path, second_path):
         """return length of unmatched part of paths"""
-        first_path = self.__build_path(first)
-        second_path = self.__build_path(second)
+        if self.__is_long_path(first_path):
+            common_index = self.get_common_ancestor(first_path[-1], second_path[-1])
+            return len(first_path) - self.get_depth(common_index) - 1
         common_len = 0
         for first_index, second_index in zip(first_path, second_path):
             if first_index == second_index:
@@ -250,22 +1791,31 @@ class HTMLTextBlocksTree(list):
                 return len(first_path) - common_len
         return 0
     
-    def __check_paths_equality(self, first, second, matched_nodes):
-        """ check paths equality with respect to their context"""
-        if not self.__check_tag_match(self[first], self[second]):
+    def __check_paths_equality(self, first_path, second_path, matched_nodes, siblings):
+        """ check paths equality with respect to their context
+        
+        matched_nodes caches the result for every compared pair of path nodes
+        """
+        if not self.__check_tag_match(first_path[-1], second_path[-1]):
             return False
-        first_path = self.__build_path(first)
-        second_path = self.__build_path(second)
         if len(first_path) != len(second_path):
             return False
         equal = True
-        for depth in xrange(1, len(first_path)):
+        first_depth = 1
+        if self.__is_long_path(first_path):
+            #common parents are skipped at once, paths may start below root
+            first_depth = (self.get_depth(self.get_common_ancestor(first_path[-1], 
+                                                                   second_path[-1])) - 
+                           self.get_depth(first_path[0]) + 1)
+        for depth in xrange(first_depth, len(first_path)):
             #common parents
             if first_path[depth] == second_path[depth]:
                 continue;
             key = (min(first_path[depth], second_path[depth]), 
                    max(first_path[depth], second_path[depth]))
-            if matched_nodes.has_key(key):
+            if key in matched_nodes:
+                if self.stats is not None:
+                    self.stats.count("matched_nodes_hits")
                 equal = matched_nodes[key];
                 if not equal:
                     break
@@ -273,31 +1823,36 @@ class HTMLTextBlocksTree(list):
             
             if first_path[depth - 1] == second_path[depth - 1]:
                 #siblings, is it a range of same elements
-                equal = self.__check_connection(first_path[depth], second_path[depth])
+                equal = self.__check_connection(first_path[depth], second_path[depth],
+                                                siblings)
             else:
-                first_siblings = self[first_path[depth - 1]].child_indices
-                first_pos = first_siblings.index(first_path[depth])
-                first_siblings_compare = first_siblings[max(0, first_pos - self.__CONTEXT_LENGTH) :
+                first_siblings, first_positions, _ = self.__get_siblings(
+                                                    first_path[depth - 1], siblings)
+                first_pos = first_positions[first_path[depth]]
+                first_start = max(0, first_pos - self.__CONTEXT_LENGTH)
+                first_siblings_compare = first_siblings[first_start :
                                                         first_pos + self.__CONTEXT_LENGTH + 1]                
-                second_siblings = self[second_path[depth - 1]].child_indices
-                second_pos = second_siblings.index(second_path[depth])
-                second_siblings_compare = second_siblings[max(0, second_pos - self.__CONTEXT_LENGTH) :
+                second_siblings, second_positions, _ = self.__get_siblings(
+                                                    second_path[depth - 1], siblings)
+                second_pos = second_positions[second_path[depth]]
+                second_start = max(0, second_pos - self.__CONTEXT_LENGTH)
+                second_siblings_compare = second_siblings[second_start :
                                                         second_pos + self.__CONTEXT_LENGTH + 1]
                 
-                first_pos_in_compare = first_siblings_compare.index(first_path[depth])
-                second_pos_in_compare = second_siblings_compare.index(second_path[depth])                             
+                first_pos_in_compare = first_pos - first_start
+                second_pos_in_compare = second_pos - second_start
                 if (len(second_siblings_compare) != len(first_siblings_compare) or
                         first_pos_in_compare != second_pos_in_compare):
                     equal = False;
                 else:
                     for first_sibling, second_sibling in zip(first_siblings_compare, 
                                                              second_siblings_compare):
-                        if not self.__check_tag_match(self[first_sibling], 
-                                                      self[second_sibling]):
+                        if not self.__check_tag_match(first_sibling, 
+                                                      second_sibling):
                             equal = False
                             break
+            matched_nodes[key] = equal
             if not equal:
-                matched_nodes[key] = False
                 break
         return equal
 
@@ -305,96 +1860,376 @@ class HTMLTextBlocksTree(list):
     #private methods
     
         
-    def __binary_operation(self, tree, substract = False, cross = False):
+    def __binary_operation(self, tree, substract = False, cross = False, 
+                           budget = None):
         """ trees substraction or crossing """
-        _, matching = self.__check_matching(tree, 0, 0)
+        self.__unshare()
+        started = self.__start_phase()
+        matching = self.__get_matching(tree, budget)
         if substract:
             for node_index, texts_matched in matching:
-                total_texts = self[node_index].text_nodes_count
-                matched = float(texts_matched) / total_texts >= self.__MIN_PART_FOR_MATCH
+                total_texts = self.__text_counts[node_index]
+                #nodes without texts (root of an empty page) are never matched
+                matched = (total_texts and 
+                           float(texts_matched) / total_texts >= self.__MIN_PART_FOR_MATCH)
                 to_remove = substract and matched
-                node = self[node_index]
-                if to_remove and node.parent_index > -1:
-                    self[node.parent_index].child_indices.remove(node_index)
+                if to_remove and self.__parents[node_index] > -1:
+                    self.__remove_node(node_index)
         elif cross:
             matched_nodes = set([node_index for node_index, texts_matched in matching 
                                  if texts_matched])
-            for node_index, node in enumerate(self):
+            for node_index in xrange(len(self)):
                 to_remove = not node_index in matched_nodes
-                if (to_remove and node.parent_index > -1 and 
-                        node_index in self[node.parent_index].child_indices):
-                    self[node.parent_index].child_indices.remove(node_index)                
+                if to_remove and self.__parents[node_index] > -1:
+                    self.__remove_node(node_index)
         self.__count_texts_in_nodes(0)
         self.__unlink_text_free_nodes()          
+        self.__end_phase(substract and "substract_tree" or "cross_tree", started)
+
+    class __Alignment(object):
+        """state of the trees alignment
+        
+        self_ids, tree_ids -- ids of identical subtrees, shared by both trees
+        self_counts, tree_counts -- numbers of text nodes in subtrees, that 
+                                    have a text starting with them or a prefix 
+                                    of them in the other tree, they bound 
+                                    the number of matched texts
+        repeated -- ids of subtrees, that occur more than once in a tree
+        memo -- (self subtree id, tree subtree id) -> (matched texts, 
+                aligned children positions or None for identical subtrees), 
+                pairs without matched texts are kept only for repeated ids
+        budget -- number of subtree pairs that still can be aligned
+        deadline -- time the alignment has to be finished by, then 
+                    the budget is spent
+        max_depth -- maximal depth of alignment
+        """
+        __slots__ = ("self_ids", "tree_ids", "self_counts", "tree_counts", 
+                     "repeated", "memo", "budget", "deadline", "max_depth")
+        def __init__(self, self_ids, tree_ids, self_counts, tree_counts, 
+                     budget, deadline = None):
+            self.self_ids = self_ids
+            self.tree_ids = tree_ids
+            self.self_counts = self_counts
+            self.tree_counts = tree_counts
+            self.repeated = set()
+            for ids in (self_ids, tree_ids):
+                seen = set()
+                for subtree_id in ids.itervalues():
+                    if subtree_id in seen:
+                        self.repeated.add(subtree_id)
+                    seen.add(subtree_id)
+            self.memo = {}
+            self.budget = budget
+            self.deadline = deadline
+            self.max_depth = 0
+
+    __NOT_MATCHED = (0, ())
+
+    def __get_subtree_ids(self, subtree_ids):
+        """ give the same id to identical subtrees (tags, classes and texts),
+        subtree_ids maps subtree keys to ids and can be shared between trees
+        """
+        ids = {}
+        for node_index in reversed(list(self.iter_dfs())):
+            key = (self.__tags[node_index], 
+                   self.__class_sets[self.__classes[node_index]],
+                   self.__get_text_bytes(node_index),
+                   tuple([ids[child_index] for child_index 
+                          in self.__get_children(node_index)]))
+            ids[node_index] = subtree_ids.setdefault(key, len(subtree_ids))
+        return ids
+
+    def __get_texts(self):
+        return set([self.__get_text_bytes(node_index) 
+                    for node_index in self.iter_text_nodes()])
+
+    def __get_prefix_matched_texts(self, tree):
+        """ (texts of self, texts of the tree), that have a text starting 
+        with them or a prefix of them in the other tree
+        
+        in sorted texts a text follows its prefixes, so chains of prefixes 
+        are kept in a stack
+        """
+        owners = dict.fromkeys(self.__get_texts(), 1)
+        for text in tree.__get_texts():
+            owners[text] = owners.get(text, 0) | 2
+        matched = ([], [], [])
+        #[text, owners, owners of its prefixes, owners of texts starting with it]
+        stack = []
+        def close_text():
+            text, text_owners, prefix_owners, extension_owners = stack.pop()
+            around = prefix_owners | extension_owners | (text_owners == 3 and 3)
+            if text_owners & 1 and around & 2:
+                matched[1].append(text)
+            if text_owners & 2 and around & 1:
+                matched[2].append(text)
+            if stack:
+                stack[-1][3] |= text_owners | extension_owners
+        for text in sorted(owners):
+            while stack and not text.startswith(stack[-1][0]):
+                close_text()
+            prefix_owners = stack and stack[-1][1] | stack[-1][2] or 0
+            stack.append([text, owners[text], prefix_owners, 0])
+        while stack:
+            close_text()
+        return set(matched[1]), set(matched[2])
+
+    def __count_texts_in(self, texts):
+        """ {node index: number of text nodes of its subtree with texts in texts} """
+        counts = {}
+        for node_index in reversed(list(self.iter_dfs())):
+            if self.__text_lengths[node_index]:
+                counts[node_index] = self.__get_text_bytes(node_index) in texts and 1 or 0
+            else:
+                counts[node_index] = sum([counts[child_index] for child_index 
+                                          in self.__get_children(node_index)])
+        return counts
+
+    def __get_matching(self, tree, budget = None):
+        """ align self with the tree, get list of (node_index, texts_matched) 
+        for aligned nodes of self in deep-first order
+        """
+        if not len(self) or not len(tree):
+            return []
+        started = self.__start_phase()
+        subtree_ids = {}
+        self_texts, tree_texts = self.__get_prefix_matched_texts(tree)
+        alignment = self.__Alignment(self.__get_subtree_ids(subtree_ids),
+                                     tree.__get_subtree_ids(subtree_ids),
+                                     self.__count_texts_in(self_texts), 
+                                     tree.__count_texts_in(tree_texts),
+                                     budget, self.__get_deadline())
+        self.__check_matching(tree, 0, 0, alignment)
+        matching = []
+        stack = [(0, 0)]
+        while stack:
+            node_index, tree_node_index = stack.pop()
+            if self.__text_lengths[node_index]:
+                matching.append((node_index, 
+                                 self.__check_matching(tree, node_index, 
+                                                       tree_node_index, alignment)))
+                continue
+            key = (alignment.self_ids[node_index], alignment.tree_ids[tree_node_index])
+            total_matched, aligned = alignment.memo.get(key, self.__NOT_MATCHED)
+            if aligned is None:
+                #identical subtrees match completely
+                identical = [node_index]
+                while identical:
+                    node_index = identical.pop()
+                    matching.append((node_index, self.__text_counts[node_index]))
+                    identical.extend(reversed(self.__get_children(node_index)))
+                continue
+            matching.append((node_index, total_matched))
+            self_childs = self.__get_children(node_index)
+            tree_childs = tree.__get_children(tree_node_index)
+            for self_pos, tree_pos in reversed(aligned):
+                stack.append((self_childs[self_pos], tree_childs[tree_pos]))
+        if self.stats is not None:
+            self.stats.count("aligned_pairs", len(alignment.memo))
+            self.stats.count_max("check_matching_depth", alignment.max_depth)
+            self.__end_phase("matching", started)
+        return matching
     
-    def __check_tag_match(self, first_node, second_node):
-        """ check if nodes' tags are same and style classes cross"""
-        if first_node.tag != second_node.tag:
+    def __check_tag_match(self, first_index, second_index, tree = None):
+        """ check if nodes' tags are same and style classes cross
+        
+        second_index is a node of the tree (self by default)
+        """
+        if tree is None:
+            tree = self
+        #tag ids are shared by all trees
+        if self.__tags[first_index] != tree.__tags[second_index]:
             return False;        
+        first_classes = self.__class_sets[self.__classes[first_index]]
+        second_classes = tree.__class_sets[tree.__classes[second_index]]
         #one node of two has one classId or both don't have classes
-        if len(first_node.style_classes) + len(second_node.style_classes) < 2:
+        if len(first_classes) + len(second_classes) < 2:
             return True
-        have_style_cross = (set(first_node.style_classes) & set(second_node.style_classes) 
+        if first_classes is second_classes:
+            return True
+        have_style_cross = (set(first_classes) & set(second_classes) 
                             and True or False) 
         return have_style_cross;           
     
-    def __check_matching(self, tree, node_index, tree_node_index):
-        """ check if the subtree of self and the subtree of tree match  """
-        self_node = self[node_index];
-        tree_node = tree[tree_node_index];
-        if self_node.text:
-            matched = (tree_node.text and 
-                       (self_node.text.startswith(tree_node.text) or
-                        tree_node.text.startswith(self_node.text)));
+    def __check_matching(self, tree, node_index, tree_node_index, alignment):
+        """ check if the subtree of self and the subtree of tree match, 
+        return number of matched text nodes
+        
+        subtrees are aligned with an explicit stack of __iter_matching 
+        generators, so deeply nested pages are fine: a generator yields 
+        pairs of children to match and gets numbers of their matched texts, 
+        the last value it yields is its own result
+        """
+        matched = self.__get_known_matching(tree, node_index, tree_node_index, 
+                                            alignment)
+        if matched is not None:
+            return matched
+        stack = [self.__iter_matching(tree, node_index, tree_node_index, alignment)]
+        matched = None
+        while True:
+            request = stack[-1].send(matched)
+            if not isinstance(request, tuple):
+                #the pair is aligned, return its result to the outer one
+                stack.pop()
+                matched = request
+                if not stack:
+                    return matched
+                continue
+            matched = self.__get_known_matching(tree, request[0], request[1], 
+                                                alignment)
+            if matched is None:
+                stack.append(self.__iter_matching(tree, request[0], request[1], 
+                                                  alignment))
+                if len(stack) > alignment.max_depth:
+                    alignment.max_depth = len(stack)
+
+    def __get_known_matching(self, tree, node_index, tree_node_index, alignment):
+        """ number of matched text nodes of texts, identical subtrees and 
+        memoized pairs, None for pairs to align """
+        if self.__text_lengths[node_index]:
+            #utf-8 keeps prefixes, so texts are compared as bytes
+            self_text = self.__get_text_bytes(node_index)
+            tree_text = tree.__get_text_bytes(tree_node_index)
+            matched = (tree_text and 
+                       (self_text.startswith(tree_text) or
+                        tree_text.startswith(self_text)));
             if matched:
-                return (1, [(node_index, 1)]);
+                return 1;
             else:
-                return (0, [(node_index, 0)]);
+                return 0;
+        key = (alignment.self_ids[node_index], alignment.tree_ids[tree_node_index])
+        if key in alignment.memo:
+            return alignment.memo[key][0]
+        if key[0] == key[1]:
+            alignment.memo[key] = (self.__text_counts[node_index], None)
+            return self.__text_counts[node_index]
+        return None
+
+    def __iter_matching(self, tree, node_index, tree_node_index, alignment):
+        """ align children of a pair of subtrees, see __check_matching
+        
+        each child of self is aligned with the best matching child of the tree, 
+        that follows the previous aligned one; results are memoized by 
+        subtree ids, pairs that can't beat the best match found are pruned
+        """
+        key = (alignment.self_ids[node_index], alignment.tree_ids[tree_node_index])
+        if alignment.deadline is not None and time.time() > alignment.deadline:
+            self.__hit_limit("max_seconds")
+            alignment.deadline = None
+            alignment.budget = 0
+        if alignment.budget is not None:
+            if alignment.budget <= 0:
+                alignment.memo[key] = self.__NOT_MATCHED
+                yield 0
+                return
+            alignment.budget -= 1
         total_matched = 0
-        sub_tree_matching = []
-        self_childs = self_node.child_indices
-        tree_childs = tree_node.child_indices
+        aligned = []
+        self_childs = self.__get_children(node_index)
+        tree_childs = tree.__get_children(tree_node_index)
+        self_counts = alignment.self_counts
+        tree_counts = alignment.tree_counts
         start_pos = 0
-        for child_index in self_childs:
-            self_child = self[child_index]
+        identical = None
+        for self_pos, child_index in enumerate(self_childs):
             best_match_pos = -1
             best_matched = 0;
-            best_matching = [];
+            # matched texts can't exceed texts of any of two subtrees, 
+            # that have prefix matched texts in the other tree
+            most_matched = self_counts[child_index]
+            if alignment.budget is not None and alignment.budget <= 0:
+                #budget is spent, only identical subtrees are matched
+                if identical is None:
+                    identical = {}
+                    for tree_childs_pos, tree_child_index in enumerate(tree_childs):
+                        identical.setdefault(alignment.tree_ids[tree_child_index], 
+                                             []).append(tree_childs_pos)
+                positions = identical.get(alignment.self_ids[child_index], [])
+                position = bisect_left(positions, start_pos)
+                if position < len(positions):
+                    best_match_pos = positions[position]
+                    best_matched = yield (child_index, tree_childs[best_match_pos])
+                most_matched = best_matched
             for tree_childs_pos in xrange(start_pos, len(tree_childs)):
+                if best_matched >= most_matched:
+                    break
                 tree_child_index = tree_childs[tree_childs_pos]
-                tree_child = tree[tree_child_index]
-                if self.__check_tag_match(self_child, tree_child):
-                    matched, matching = self.__check_matching(tree, 
-                                                              child_index, 
-                                                              tree_child_index)
+                if min(most_matched, tree_counts[tree_child_index]) <= best_matched:
+                    continue
+                if self.__check_tag_match(child_index, tree_child_index, tree):
+                    matched = yield (child_index, tree_child_index)
                     if matched > best_matched:
                         best_match_pos = tree_childs_pos
                         best_matched = matched
-                        best_matching = matching
             if best_match_pos > -1:
                 start_pos = best_match_pos + 1
                 total_matched += best_matched
-                sub_tree_matching += best_matching
-        return (total_matched, [(node_index, total_matched)] + sub_tree_matching)
+                aligned.append((self_pos, best_match_pos))
+        if total_matched:
+            alignment.memo[key] = (total_matched, aligned)
+        elif key[0] in alignment.repeated or key[1] in alignment.repeated:
+            alignment.memo[key] = self.__NOT_MATCHED
+        yield total_matched
     
     def __count_texts_in_nodes(self, node_index):
         """ count number of text nodes in node_index's subtree"""
-        is_text = self[node_index].text and True or False
-        if is_text:
-            self[node_index].text_nodes_count = 1
-        else:
-            self[node_index].text_nodes_count = 0
-            for child_index in self[node_index].child_indices:            
-                self[node_index].text_nodes_count += self.__count_texts_in_nodes(child_index)
-        return self[node_index].text_nodes_count        
+        if not len(self):
+            return 0
+        started = self.__start_phase()
+        text_lengths = self.__text_lengths
+        text_counts = self.__text_counts
+        is_text = lambda tree, node_index: text_lengths[node_index] and True or False
+        #children are counted before parents in reversed deep-first order
+        for node_index in reversed(list(self.iter_dfs(node_index, is_text))):
+            if text_lengths[node_index]:
+                text_counts[node_index] = 1
+            else:
+                text_counts[node_index] = sum([text_counts[child_index] for child_index 
+                                               in self.__get_children(node_index)])
+        self.__end_phase("count_texts", started)
+        return text_counts[node_index]
+
+    def __iter_dump_lines(self, node_index = 0, indent = 0):
+        """ lines of the tree dump, opening tag is paired with 
+        the closing one on the stack """
+        if not len(self):
+            yield "<p>empty tree</p>"
+            return
+        stack = [(node_index, indent, False)]
+        while stack:
+            node_index, indent, is_closing = stack.pop()
+            tag = self.__TAG_NAMES[self.__tags[node_index]]
+            if is_closing:
+                yield "%s</%s>\n" % (indent * " ", tag)
+            elif self.__text_lengths[node_index]:
+                yield "%s%s\n" % (indent * " ",
+                                   self.__get_text(node_index).replace("\n", " "))
+            elif tag:
+                yield "%s<%s>\n" % (indent * " ", tag)
+                stack.append((node_index, indent, True))
+                for child_index in reversed(self.__get_children(node_index)):
+                    stack.append((child_index, indent + 1, False))
 
  
     __CONTEXT_LENGTH = 2 #for paths matching
+    __SHORT_PATH_LENGTH = 48 #for paths matching with the structural index
     __MIN_PART_FOR_MATCH = 0.9  #for subtree matching   
     __LINK_TAGS = ["a"]
     __LINK_ATTRIBUTES = ["href"]
     __TREE_ROOT_TAG = "root"   
-    __LIBXML_HTML_PARSER = etree.HTMLParser()
+    #tag names are interned once for all trees, "" is the tag of text nodes
+    __TAG_NAMES = [""]
+    __TAG_IDS = {"": 0}
+    __STREAM_CHUNK_SIZE = 64 * 1024 #for feeding files and sockets to the parser
+    __SNIFF_LENGTH = 4 * 1024 #bytes to sniff html encoding by
+    #whitespace, doctype, comments, processing instructions and end tags
+    __LEADING_MARKUP = re.compile(r"(?:\s+|<!--.*?-->|<![^>]*>|<\?[^>]*>|</[^>]*>)*", re.S)
+    __END_TAG = re.compile(r"</[^>]*>")
+    #binary format: magic, version, byte order, int size, number of sections
+    __FORMAT_HEADER = "<4sIBBI"
+    __FORMAT_MAGIC = "HTBT"
+    __FORMAT_VERSION = 2
+    __TOP_FRAME, __BLOCK_FRAME, __INLINE_FRAME, __COLLAPSED_FRAME = range(4)
     __TAGS_TO_SKIP = set(["script", "none", "meta", "link", "iframe", 
                        "style", "object", "noscript"])
     __INLINE_TAGS = set(["a", "abbr", "acronym", "b", "basefont", "bdo", "big", 
@@ -411,40 +2246,243 @@ class HTMLTextBlocksTree(list):
                         "script", "style", "table", "tbody", "td", "tfoot", 
                         "th", "thead", "title", "tr", "ul"]);    
 
-    def __load(self, html_text, url = None):
-        lxml_root = etree.fromstring(html_text, self.__LIBXML_HTML_PARSER)
-        self.__reset()
-        if not url is None:
-            self.url = url;        
-        root = HTMLTextBlocksTree.Node(tag = self.__TREE_ROOT_TAG)
-        self.append(root)
-        self.__translate_tree([lxml_root], 0)
-        self.__count_texts_in_nodes(0)
-        self.__unlink_text_free_nodes()
+    def __load(self, html_text, url = None, encoding = None):
+        self.__begin_build(url, encoding)
+        self.feed(html_text)
+        self.close()
+
+    def __load_stream(self, stream, url = None, encoding = None, http_headers = None):
+        """ feed chunks from a file object or from an iterable to the parser 
+        
+        http_headers -- dict of response headers, it may be filled while 
+                        chunks are read, Content-Type charset is used in 
+                        encoding sniffing
+        """
+        self.__begin_build(url, encoding, http_headers)
+        chunks = stream
+        if hasattr(stream, "read"):
+            chunks = iter(lambda: stream.read(self.__STREAM_CHUNK_SIZE), "")
+        for chunk in chunks:
+            self.feed(chunk)
+            if self.__truncated:
+                break
+        self.close()
 
     def __reset(self):
-        self[:] = []
+        self.__init_columns()
         self.url = "";
+        self.encoding = None
+        self.__building = False
+        self.__parser = None
+        self.__head = []
+        self.__head_length = 0
+        self.__fed = False
+        #no element or text was fed to the parser yet
+        self.__leading = True
+        self.__leading_tail = ""
+        #html fed to the parser before its first element, None after it
+        self.__unstarted = []
+        #accumulated text: start in the text buffer and length in characters
+        self.__text_start = 0
+        self.__text_length = 0
+        self.__declared_encoding = None
+        self.__http_headers = {}
+        self.__frames = []
+        self.__skip_depth = 0
+        self.__pending_text = []
+        #open block elements
+        self.__depth = 0
+        self.limits_hit = []
+        self.__truncated = False
+        self.__deadline = None
+
+    def __get_columns(self):
+        """ packed columns in the order of the binary format """
+        return [self.__parents, self.__tags, self.__classes, 
+                self.__first_children, self.__last_children, self.__next_siblings, 
+                self.__text_counts, self.__removed, 
+                self.__text_starts, self.__text_lengths, 
+                self.__first_zones, self.__zone_counts, 
+                self.__zone_starts, self.__zone_lengths, self.__zone_tags, 
+                self.__zone_classes, self.__zone_links]
+
+    def __set_columns(self, columns):
+        (self.__parents, self.__tags, self.__classes, 
+         self.__first_children, self.__last_children, self.__next_siblings, 
+         self.__text_counts, self.__removed, 
+         self.__text_starts, self.__text_lengths, 
+         self.__first_zones, self.__zone_counts, 
+         self.__zone_starts, self.__zone_lengths, self.__zone_tags, 
+         self.__zone_classes, self.__zone_links) = columns
+
+    def __init_columns(self):
+        #node columns
+        self.__parents = array("i")
+        self.__tags = array("i")
+        self.__classes = array("i")
+        self.__first_children = array("i")
+        self.__last_children = array("i")
+        self.__next_siblings = array("i")
+        self.__text_counts = array("i")
+        self.__removed = array("b")
+        #texts of all nodes are UTF-8 slices of one buffer
+        self.__text_starts = array("i")
+        self.__text_lengths = array("i")
+        self.__text_buffer = bytearray()
+        self.__first_zones = array("i")
+        self.__zone_counts = array("i")
+        #mark zone columns
+        self.__zone_starts = array("i")
+        self.__zone_lengths = array("i")
+        self.__zone_tags = array("i")
+        self.__zone_classes = array("i")
+        self.__zone_links = array("i")
+        #sets of style classes and links, interned per tree
+        self.__class_sets = [()]
+        self.__class_set_ids = {(): 0}
+        self.__links = [""]
+        self.__link_ids = {"": 0}
+        #columns and tables are shared with copies of the tree
+        self.__shared = False
+        self.__drop_indexes()
+
+    def __drop_indexes(self):
+        """ indexes, hashes and the structural index are built again, 
+        when they are needed after the tree was changed """
+        self.__indexes = None
+        self.__subtree_hashes = None
+        self.__structure = None
+
+    def __unshare(self):
+        """ copy columns and tables shared with other trees 
+        before the tree is changed """
+        if not self.__shared:
+            return
+        self.__set_columns([array(column.typecode, column) 
+                            for column in self.__get_columns()])
+        self.__text_buffer = bytearray(self.__text_buffer)
+        self.__class_sets = list(self.__class_sets)
+        self.__class_set_ids = dict(self.__class_set_ids)
+        self.__links = list(self.__links)
+        self.__link_ids = dict(self.__link_ids)
+        self.__shared = False
+
+    def __begin_build(self, url = None, encoding = None, http_headers = None):
+        """ prepare an empty tree, the parser is created, when the encoding 
+        of html is known """
+        url = getattr(self, "url", "") if url is None else url
+        self.__reset()
+        self.url = url
+        self.__building = True
+        self.__declared_encoding = encoding
+        if http_headers is not None:
+            self.__http_headers = http_headers
+        self.__deadline = self.__get_deadline()
+        self.__add_node(-1, self.__get_tag_id(self.__TREE_ROOT_TAG), 0, "", [])
+        # the top frame only accepts the document root element
+        self.__frames = [self.__BuildFrame(self.__TOP_FRAME, 0)]
+
+    def __start_parser(self):
+        """ sniff encoding of buffered bytes, create an event-driven lxml 
+        parser for it, return the buffered html to feed to the parser """
+        head = "".join(self.__head)
+        self.__head = []
+        encoding = None
+        if head and not isinstance(head, unicode):
+            declared = (self.__declared_encoding or 
+                        _get_charset(self.__http_headers.get("content-type")))
+            encoding, mark_length = sniff_encoding(head, declared)
+            head = head[mark_length:]
+        self.__parser, self.encoding = self.__create_parser(encoding)
+        return head
+
+    def __create_parser(self, encoding):
+        """ event-driven lxml parser of html in the encoding, 
+        return (parser, encoding it was created with) """
+        target = _ParserTarget(start = self.__start_element, 
+                               end = self.__end_element,
+                               data = self.__text_data,
+                               comment = self.__comment,
+                               pi = self.__processing_instruction)
+        try:
+            return etree.HTMLParser(target = target, encoding = encoding), encoding
+        except LookupError:
+            #libxml2 doesn't know this name of the encoding, try python's one
+            encoding = encoding and codecs.lookup(encoding).name
+            try:
+                return etree.HTMLParser(target = target, encoding = encoding), encoding
+            except LookupError:
+                return etree.HTMLParser(target = target), None
+
+    def __reparse_unstarted(self):
+        """ libxml2 push parser may end without any element for html, that 
+        lxml.html parses ("<!DOCTYPE html>\nhello"), parse the html as a whole """
+        html = "".join(self.__unstarted)
+        self.__unstarted = None
+        if not html.strip():
+            return
+        try:
+            etree.fromstring(html, self.__create_parser(self.encoding)[0])
+        except etree.XMLSyntaxError:
+            pass
+
+    def __strip_leading_end_tags(self, data):
+        """ libxml2 push parser stops emitting events after an end tag, that 
+        goes before any element or text ("</b>hello<p>x</p>"), so such tags 
+        are dropped (lxml.html ignores them too); a tag cut by the end of 
+        the chunk is kept until the next one """
+        data = self.__leading_tail + data
+        self.__leading_tail = data[:0]
+        leading = self.__LEADING_MARKUP.match(data).end()
+        rest = data[leading:]
+        if rest[:1] == "<" and not ">" in rest:
+            self.__leading_tail = rest
+            rest = rest[:0]
+        elif rest:
+            self.__leading = False
+        return self.__END_TAG.sub("", data[:leading]) + rest
 
-    def __get_tag_name(self, lxml_node):        
-        tag = (isinstance(lxml_node.tag, basestring) 
-               and lxml_node.tag.lower() or "none")
+    def __feed_parser(self, data):
+        if self.__leading:
+            data = self.__strip_leading_end_tags(data)
+        if not data:
+            return
+        self.__fed = True
+        if self.__unstarted is not None:
+            self.__unstarted.append(data)
+        started = self.__start_phase()
+        try:
+            if self.limits is not None:
+                #events after the tree was truncated are not worth parsing
+                for start in xrange(0, len(data), self.__STREAM_CHUNK_SIZE):
+                    self.__parser.feed(data[start:start + self.__STREAM_CHUNK_SIZE])
+                    if self.__truncated:
+                        break
+            else:
+                self.__parser.feed(data)
+        except UnicodeDecodeError:
+            raise self.BadEncoding("Wrong html encoding at %s" % (self.url));
+        finally:
+            self.__end_phase("parse", started)
+
+    def __get_tag_name(self, tag):        
+        tag = (isinstance(tag, basestring) and tag.lower() or "none")
         #remove annoying namespace
         tag = tag[0] == "{" and tag[tag.find("}") + 1 :] or tag;
         return tag;
     
-    def __get_classes(self, lxml_node):
+    def __get_classes(self, attributes):
         """<tagname class="class1 class2 class3">...</tag>"""
-        child_classes = lxml_node.get("class") or ""
+        child_classes = attributes.get("class") or ""
         child_classes = ([name.strip() for name in 
                          child_classes.strip().split(" ") if name.strip()])
         return child_classes;
     
-    def __get_link_url(self, lxml_node, node_tag):
+    def __get_link_url(self, attributes, node_tag):
         if not node_tag in self.__LINK_TAGS:
             return "";
         for link_attribute in self.__LINK_ATTRIBUTES:
-            value = lxml_node.get(link_attribute) or "";
+            value = attributes.get(link_attribute) or "";
             if value:
                 return value;
         return "";
@@ -460,6 +2498,8 @@ class HTMLTextBlocksTree(list):
         for_node = []
         for zone in mark_zones:
             if zone.length == -1:
+                if self.stats is not None:
+                    self.stats.count("mark_zones_split")
                 zone_copy = copy(zone);
                 zone_copy.start = 0;
                 for_following_usage += [zone_copy];
@@ -467,100 +2507,1260 @@ class HTMLTextBlocksTree(list):
             if zone.length: #don't use empty zones
                 for_node += [zone];
         return (for_node, for_following_usage)
+
+    class __BuildFrame(object):
+        """state of an element, which is open while the tree is being built
+
+        parent_index -- node, that receives text nodes found inside the element
+        mark_zones -- zones covering the text accumulated since the last 
+                      text node was cut (unfinished zones have length -1)
+        broken -- the rest of the element's content is ignored
+        outer_zones_count -- number of zones of the outer element, when this 
+                             inline element started (its zone is appended 
+                             to the same list)
+        
+        the accumulated text itself is the tail of the tree's text buffer,
+        inline elements continue the text of the outer element and every 
+        block element starts a new one, so one text is accumulated at a time
+        """
+        __slots__ = ("kind", "parent_index", "mark_zones", "broken", 
+                     "outer_zones_count")
+        def __init__(self, kind, parent_index, mark_zones = None, 
+                     outer_zones_count = 0):
+            self.kind = kind
+            self.parent_index = parent_index
+            self.mark_zones = not mark_zones is None and mark_zones or []
+            self.broken = False
+            self.outer_zones_count = outer_zones_count
+
+    def __add_text_node(self, parent_index, mark_zones, zones_length):
+        """ cut accumulated text into a text node, unfinished mark zones 
+        are closed at zones_length and returned to be used by the followers 
+        """
+        for_node, for_followers = self.__split_mark_zones(mark_zones, zones_length)
+        node_index = self.__add_node(parent_index, 0, 0, "", for_node)
+        self.__text_starts[node_index] = self.__text_start
+        self.__text_lengths[node_index] = len(self.__text_buffer) - self.__text_start
+        self.__text_start = len(self.__text_buffer)
+        self.__text_length = 0
+        return for_followers
+
+    def __apply_pending_text(self):
+        """ append text collected by data events to the innermost open element:
+        it is either element's own text or the tail of its last closed child
+        """
+        if not self.__pending_text:
+            return
+        text = "".join(self.__pending_text).strip()
+        self.__pending_text = []
+        if text and self.limits is not None and self.limits.max_text_bytes is not None:
+            text = self.__cut_text(text)
+        if text:
+            if self.__text_length:
+                self.__text_buffer += " "
+                self.__text_length += 1
+            self.__text_buffer += isinstance(text, unicode) and text.encode("utf8") or text
+            self.__text_length += len(text)
+
+    def __cut_text(self, text):
+        """ cut the text to bytes left for texts by limits.max_text_bytes """
+        left = self.limits.max_text_bytes - len(self.__text_buffer)
+        data = isinstance(text, unicode) and text.encode("utf8") or text
+        if len(data) < left:
+            return text
+        self.__hit_limit("max_text_bytes")
+        self.__truncated = True
+        return data[:max(0, left)].decode("utf8", "ignore").strip()
+
+    def __check_build_limits(self):
+        """ truncate the tree, when it has grown too big or the time is over """
+        limits = self.limits
+        if limits.max_nodes is not None and len(self.__parents) >= limits.max_nodes:
+            self.__hit_limit("max_nodes")
+        elif self.__deadline is not None and time.time() > self.__deadline:
+            self.__hit_limit("max_seconds")
+        else:
+            return False
+        self.__truncated = True
+        return True
+
+    def __is_ignored(self):
+        """ events inside skipped elements, after broken content and after 
+        the tree was truncated are ignored """
+        return self.__skip_depth or self.__frames[-1].broken or self.__truncated
+
+    def __start_element(self, tag, attributes):
+        """ convert etree events to THTMLTextBlocksTree: element opened """
+        self.__leading = False
+        self.__unstarted = None
+        self.__apply_pending_text()
+        if self.__is_ignored() or (self.limits is not None and 
+                                   self.__check_build_limits()):
+            self.__skip_depth += 1
+            return
+        tag = self.__get_tag_name(tag)
+        frame = self.__frames[-1]
+        is_block = tag in self.__BLOCK_TAGS
+        to_skip = tag in self.__TAGS_TO_SKIP
+        if self.limits is not None and not to_skip and self.__is_collapsed(is_block, frame):
+            self.__frames.append(self.__BuildFrame(self.__COLLAPSED_FRAME, 
+                                                   frame.parent_index,
+                                                   frame.mark_zones))
+            return
+        if self.__text_length and (is_block or to_skip):
+            frame.mark_zones = self.__add_text_node(frame.parent_index,
+                                                    frame.mark_zones,
+                                                    self.__text_length)
+        if is_block and not to_skip:
+            classes = self.__get_classes(attributes)
+            node_index = self.__add_node(frame.parent_index, 
+                                         self.__get_tag_id(tag), 
+                                         self.__get_classes_id(classes), 
+                                         "", [])
+            self.__frames.append(self.__BuildFrame(self.__BLOCK_FRAME, 
+                                                   node_index,
+                                                   mark_zones = frame.mark_zones))
+            self.__depth += 1
+        elif not to_skip:
+            #inline node, features of which we distribute in mark_zones
+            mark_add = HTMLTextBlocksTree.MarkZone(
+                                start = self.__text_length,
+                                length = -1,
+                                tag = tag, 
+                                style_classes = self.__get_classes(attributes), 
+                                link = self.__get_link_url(attributes, tag))
+            outer_zones_count = len(frame.mark_zones)
+            frame.mark_zones.append(mark_add)
+            self.__frames.append(self.__BuildFrame(self.__INLINE_FRAME, 
+                                                   frame.parent_index,
+                                                   frame.mark_zones,
+                                                   outer_zones_count))
+        else:
+            self.__skip_depth += 1
+
+    def __is_collapsed(self, is_block, frame):
+        """ element doesn't make a block or a mark zone, as it is deeper 
+        than limits.max_depth or the text has too many mark zones """
+        if is_block:
+            if (self.limits.max_depth is not None and 
+                    self.__depth >= self.limits.max_depth):
+                self.__hit_limit("max_depth")
+                return True
+        elif (self.limits.max_zones_per_node is not None and 
+                len(frame.mark_zones) >= self.limits.max_zones_per_node):
+            self.__hit_limit("max_zones_per_node")
+            return True
+        return False
+
+    def __end_element(self, tag):
+        """ convert etree events to THTMLTextBlocksTree: element closed """
+        self.__apply_pending_text()
+        if self.__skip_depth:
+            self.__skip_depth -= 1
+            return
+        if len(self.__frames) < 2:
+            return
+        frame = self.__frames.pop()
+        outer = self.__frames[-1]
+        if frame.kind == self.__COLLAPSED_FRAME:
+            outer.mark_zones = frame.mark_zones
+        elif frame.kind == self.__BLOCK_FRAME:
+            self.__depth -= 1
+            if self.__text_length:
+                #make it a child of the block element, zones are closed at 
+                #the length of the outer text, that was cut when the block started
+                outer.mark_zones = self.__add_text_node(frame.parent_index, 
+                                                        frame.mark_zones,
+                                                        0)
+            else:
+                outer.mark_zones = frame.mark_zones
+        else:
+            # close the zone, which was created by this node
+            mark_zones = frame.mark_zones
+            add_len = 1
+            for zone_index in xrange(len(mark_zones) - 1, -1, -1):
+                if mark_zones[zone_index].length == -1:
+                    mark_zones[zone_index].length = (self.__text_length -
+                                                     mark_zones[zone_index].start);
+                    add_len -= 1;
+                    if not add_len:
+                        break;
+            if add_len:
+                outer.broken = True
+                del outer.mark_zones[frame.outer_zones_count:]
+            else:
+                outer.mark_zones = mark_zones
+        if outer.kind == self.__TOP_FRAME:
+            outer.broken = True
+
+    def __text_data(self, data):
+        """ convert etree events to THTMLTextBlocksTree: text arrived
+        
+        text may come in several pieces, so it is joined on the next element event
+        """
+        if not self.__is_ignored() and self.__frames[-1].kind != self.__TOP_FRAME:
+            self.__pending_text.append(data)
+
+    def __comment(self, text):
+        """ comments are skipped elements, but they cut text nodes as well """
+        self.__apply_pending_text()
+        if not self.__is_ignored() and self.__frames[-1].kind != self.__TOP_FRAME:
+            self.__start_element(None, {})
+            self.__end_element(None)
+
+    def __processing_instruction(self, target, data):
+        self.__comment(data)
     
-    def __translate_tree(self, lxml_nodes, parent_index, 
-                         text_before = "", mark_zones = []):
-        """ convert etree to THTMLTextBlocksTree"""     
-        for lxml_node in lxml_nodes:
-            if lxml_node is None:
-                continue;
-            tag = self.__get_tag_name(lxml_node)
-            child_classes = self.__get_classes(lxml_node)
-            # not wrapped text that occurs before child-nodes: 
-            # <parent>text <child1>...</child1>...</parent>
+    def __unlink_text_free_nodes(self):
+        """ unlink all subtrees without text nodes """
+        self.__drop_indexes()
+        started = self.__start_phase()
+        parents = self.__parents
+        text_counts = self.__text_counts
+        for node_index in xrange(len(self)):
+            if parents[node_index] > -1 and not text_counts[node_index]:
+                self.__removed[node_index] = 1
+        self.__end_phase("unlink_text_free_nodes", started)
+
+    def __get_deadline(self):
+        """ time an operation has to be finished by, None if it is unlimited """
+        if self.limits is None or self.limits.max_seconds is None:
+            return None
+        return time.time() + self.limits.max_seconds
+
+    def __hit_limit(self, name):
+        if not name in self.limits_hit:
+            self.limits_hit.append(name)
+            if self.stats is not None:
+                self.stats.count("limits_hit")
+
+    def __start_phase(self):
+        """ start time of a phase, None if stats are disabled """
+        if self.stats is None:
+            return None
+        return time.time()
+
+    def __end_phase(self, phase, started):
+        if started is not None and self.stats is not None:
+            self.stats.add_time(phase, time.time() - started)
+
+    """ node storage: nodes are rows of array columns, children are linked 
+    lists (first child, next sibling), tags, style classes and links 
+    are interned. Removed nodes are marked with a tombstone and skipped
+    in lists of children until the tree is compacted """
+
+    def __get_tag_id(self, tag):
+        tag_id = self.__TAG_IDS.get(tag)
+        if tag_id is None:
+            tag_id = len(self.__TAG_NAMES)
+            self.__TAG_NAMES.append(tag)
+            self.__TAG_IDS[tag] = tag_id
+        return tag_id
+
+    def __get_classes_id(self, style_classes):
+        style_classes = tuple(style_classes)
+        classes_id = self.__class_set_ids.get(style_classes)
+        if classes_id is None:
+            classes_id = len(self.__class_sets)
+            self.__class_sets.append(style_classes)
+            self.__class_set_ids[style_classes] = classes_id
+        return classes_id
+
+    def __get_link_id(self, link):
+        link_id = self.__link_ids.get(link)
+        if link_id is None:
+            link_id = len(self.__links)
+            self.__links.append(link)
+            self.__link_ids[link] = link_id
+        return link_id
+
+    def __add_node(self, parent_index, tag_id, classes_id, text, mark_zones):
+        """ append a row to node columns and make it the last child of parent """
+        self.__drop_indexes()
+        node_index = len(self.__parents)
+        self.__parents.append(parent_index)
+        self.__tags.append(tag_id)
+        self.__classes.append(classes_id)
+        self.__first_children.append(-1)
+        self.__last_children.append(-1)
+        self.__next_siblings.append(-1)
+        self.__text_counts.append(0)
+        self.__removed.append(0)
+        self.__text_starts.append(len(self.__text_buffer))
+        self.__text_lengths.append(0)
+        if text:
+            self.__set_text(node_index, text)
+        self.__first_zones.append(0)
+        self.__zone_counts.append(0)
+        if mark_zones:
+            self.__set_mark_zones(node_index, mark_zones)
+        if parent_index > -1:
+            self.__link_child(parent_index, node_index)
+        return node_index
+
+    def __link_child(self, parent_index, node_index):
+        """ make the node the last child of parent, it is linked in one 
+        list of siblings only, the parent_index is set to parent """
+        self.__parents[node_index] = parent_index
+        last_index = self.__last_children[parent_index]
+        if last_index == -1:
+            self.__first_children[parent_index] = node_index
+        else:
+            self.__next_siblings[last_index] = node_index
+        self.__last_children[parent_index] = node_index
+        self.__next_siblings[node_index] = -1
+
+    def __remove_node(self, node_index):
+        """ unlink node (and its subtree) from the tree in O(1) """
+        self.__drop_indexes()
+        self.__removed[node_index] = 1
+
+    def __get_live_nodes(self):
+        """ tombstone-free mask of nodes reachable from the root """
+        live = array("b", [0]) * len(self)
+        stack = len(self) and [0] or []
+        while stack:
+            node_index = stack.pop()
+            live[node_index] = 1
+            stack.extend(self.__get_children(node_index))
+        return live
+
+    def __get_children(self, node_index):
+        children = []
+        next_siblings = self.__next_siblings
+        removed = self.__removed
+        child_index = self.__first_children[node_index]
+        while child_index != -1:
+            if not removed[child_index]:
+                children.append(child_index)
+            child_index = next_siblings[child_index]
+        return children
+
+    def __unlink_child(self, node_index):
+        """ take the node out of the list of siblings of its parent """
+        parent_index = self.__parents[node_index]
+        if parent_index < 0:
+            return
+        previous_index = -1
+        child_index = self.__first_children[parent_index]
+        while child_index != -1 and child_index != node_index:
+            previous_index = child_index
+            child_index = self.__next_siblings[child_index]
+        if child_index == -1:
+            return
+        next_index = self.__next_siblings[node_index]
+        if previous_index == -1:
+            self.__first_children[parent_index] = next_index
+        else:
+            self.__next_siblings[previous_index] = next_index
+        if self.__last_children[parent_index] == node_index:
+            self.__last_children[parent_index] = previous_index
+        self.__next_siblings[node_index] = -1
+
+    def __set_children(self, node_index, child_indices):
+        """ children of another node are moved to this one """
+        for child_index in child_indices:
+            if not 0 <= child_index < len(self):
+                raise IndexError("child index out of range")
+        if len(set(child_indices)) != len(child_indices):
+            raise ValueError("child index is repeated")
+        self.__drop_indexes()
+        linked = set()
+        child_index = self.__first_children[node_index]
+        while child_index != -1:
+            linked.add(child_index)
+            child_index = self.__next_siblings[child_index]
+        for child_index in child_indices:
+            if not child_index in linked:
+                self.__unlink_child(child_index)
+        self.__first_children[node_index] = -1
+        self.__last_children[node_index] = -1
+        for child_index in child_indices:
+            self.__link_child(node_index, child_index)
+
+    def __get_text(self, node_index):
+        if not self.__text_lengths[node_index]:
+            return ""
+        return self.__get_text_bytes(node_index).decode("utf8")
+
+    def __get_text_bytes(self, node_index):
+        text_start = self.__text_starts[node_index]
+        return str(self.__text_buffer[text_start:text_start + 
+                                      self.__text_lengths[node_index]])
+
+    def __set_text(self, node_index, text):
+        """ new text overwrites the old one, if it fits there, otherwise 
+        it is appended to the buffer and the old one is left there until 
+        the tree is compacted """
+        if isinstance(text, unicode):
+            text = text.encode("utf8")
+        text_start = self.__text_starts[node_index]
+        if len(text) <= self.__text_lengths[node_index]:
+            self.__text_buffer[text_start:text_start + len(text)] = text
+        else:
+            self.__text_starts[node_index] = len(self.__text_buffer)
+            self.__text_buffer += text
+        self.__text_lengths[node_index] = len(text)
+
+    def __get_mark_zones(self, node_index):
+        first_zone = self.__first_zones[node_index]
+        return [HTMLTextBlocksTree.MarkZone(
+                        start = self.__zone_starts[zone_index],
+                        length = self.__zone_lengths[zone_index],
+                        tag = self.__TAG_NAMES[self.__zone_tags[zone_index]],
+                        style_classes = list(self.__class_sets[
+                                                self.__zone_classes[zone_index]]),
+                        link = self.__links[self.__zone_links[zone_index]])
+                for zone_index in xrange(first_zone, 
+                                         first_zone + self.__zone_counts[node_index])]
+
+    def __set_mark_zones(self, node_index, mark_zones):
+        """ zones of a node are consecutive rows of mark zone columns: 
+        new zones overwrite the old rows, if they fit there (or the rows are 
+        the last ones), otherwise they are appended and the old rows are left 
+        there until the tree is compacted """
+        columns = (self.__zone_starts, self.__zone_lengths, self.__zone_tags, 
+                   self.__zone_classes, self.__zone_links)
+        first_zone = self.__first_zones[node_index]
+        zone_count = self.__zone_counts[node_index]
+        if first_zone + zone_count == len(self.__zone_starts):
+            for column in columns:
+                del column[first_zone:]
+        elif len(mark_zones) > zone_count:
+            first_zone = len(self.__zone_starts)
+        self.__first_zones[node_index] = first_zone
+        self.__zone_counts[node_index] = len(mark_zones)
+        rows = [(zone.start, zone.length, self.__get_tag_id(zone.tag), 
+                 self.__get_classes_id(zone.style_classes), 
+                 self.__get_link_id(zone.link)) for zone in mark_zones]
+        for column, values in zip(columns, zip(*rows)):
+            column[first_zone:first_zone + len(values)] = array("i", values)
+
+    def __view(self, node_index):
+        node = HTMLTextBlocksTree.Node.__new__(HTMLTextBlocksTree.Node)
+        node._index = node_index
+        node._get = self.__get_node_field
+        node._set = self.__set_node_field
+        node._values = None
+        return node
+
+    def __get_node_field(self, node_index, name):
+        if name == "parent_index":
+            return self.__parents[node_index]
+        elif name == "tag":
+            return self.__TAG_NAMES[self.__tags[node_index]]
+        elif name == "text":
+            return self.__get_text(node_index)
+        elif name == "text_nodes_count":
+            return self.__text_counts[node_index]
+        write = lambda values: self.__set_node_field(node_index, name, values)
+        if name == "style_classes":
+            return _NodeList(self.__class_sets[self.__classes[node_index]], write)
+        elif name == "child_indices":
+            return _NodeList(self.__get_children(node_index), write)
+        elif name == "mark_zones":
+            return _NodeList(self.__get_mark_zones(node_index), write)
+        raise AttributeError(name)
+
+    def __set_node_field(self, node_index, name, value):
+        self.__unshare()
+        self.__drop_indexes()
+        if name == "parent_index":
+            self.__parents[node_index] = value
+        elif name == "tag":
+            self.__tags[node_index] = self.__get_tag_id(value)
+        elif name == "style_classes":
+            self.__classes[node_index] = self.__get_classes_id(value)
+        elif name == "child_indices":
+            self.__set_children(node_index, value)
+        elif name == "text":
+            self.__set_text(node_index, value)
+        elif name == "mark_zones":
+            self.__set_mark_zones(node_index, value)
+        elif name == "text_nodes_count":
+            self.__text_counts[node_index] = value
+        else:
+            raise AttributeError(name)
+
+
+class SiteTemplate(object):
+    """statistics of text blocks recurring on pages of one site
+
+    The template is built incrementally from many pages with add_tree(). 
+    It keeps the number of pages every text block signature 
+    (see HTMLTextBlocksTree.get_text_signatures) was seen on. A block is 
+    boilerplate, if it occurs on at least min_part of pages (and at least 
+    on two of them).
+
+    template = SiteTemplate()
+    for page in pages:
+        template.add_tree(HTMLTextBlocksTree(page))
+    template.save("site.template")
+    tree.substract_template(SiteTemplate.load("site.template"))
+    """
+    __FORMAT_HEADER = "htmlparser-site-template 1"
+
+    def __init__(self, min_part = 0.5, max_signatures = None):
+        """ 
+        min_part -- part of pages a block has to occur on to be boilerplate
+        max_signatures -- bound of the template size, when it is exceeded 
+                          signatures seen only once on earlier pages are 
+                          forgotten, blocks of the last page are kept
+        """
+        self.min_part = min_part
+        self.max_signatures = max_signatures
+        self.pages_count = 0
+        self.frequencies = {}
+
+    def add_tree(self, tree):
+        """ count text blocks of one more page """
+        frequencies = self.frequencies
+        signatures = set(tree.get_text_signatures().itervalues())
+        for signature in signatures:
+            frequencies[signature] = frequencies.get(signature, 0) + 1
+        self.pages_count += 1
+        if (self.max_signatures is not None and 
+                len(frequencies) > self.max_signatures):
+            for signature, count in frequencies.items():
+                if count < 2 and not signature in signatures:
+                    del frequencies[signature]
+
+    def is_boilerplate(self, signature):
+        return self.frequencies.get(signature, 0) >= self.__get_min_count()
+
+    def get_boilerplate_nodes(self, tree):
+        """ indices of text nodes of the tree, that are boilerplate """
+        min_count = self.__get_min_count()
+        frequencies = self.frequencies
+        return [node_index for node_index, signature 
+                in tree.get_text_signatures().iteritems() 
+                if frequencies.get(signature, 0) >= min_count]
+
+    def save(self, filename):
+        with open(filename, "wb") as template_file:
+            template_file.write("%s\n%d %r\n" % (self.__FORMAT_HEADER, 
+                                                 self.pages_count, 
+                                                 self.min_part))
+            for signature, count in self.frequencies.iteritems():
+                template_file.write("%d %d\n" % (signature, count))
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, "rb") as template_file:
+            if template_file.readline().strip() != cls.__FORMAT_HEADER:
+                raise ValueError("%s is not a site template" % filename)
+            pages_count, min_part = template_file.readline().split()
+            template = cls(min_part = float(min_part))
+            template.pages_count = int(pages_count)
+            for line in template_file:
+                signature, count = line.split()
+                template.frequencies[int(signature)] = int(count)
+        return template
+
+    def __get_min_count(self):
+        return max(2, self.min_part * self.pages_count)
+
+
+class CorpusGrouper(object):
+    """groups of text nodes with the same context on many pages of a site, 
+    e.g. prices of all products or authors of all posts
+
+    Text nodes are indexed by their context signatures (see 
+    HTMLTextBlocksTree.get_context_signatures), so equivalent groups of 
+    all pages are merged without comparing pages pairwise, and the cost 
+    is linear in the number of text nodes. Trees are added one by one and 
+    can be dropped after it: a group keeps counters and its first 
+    max_members members only.
+
+    grouper = CorpusGrouper()
+    for url in urls:
+        grouper.add_tree(HTMLTextBlocksTree(url=url), url)
+    for group in grouper.iter_groups(min_documents=10):
+        print group["documents_count"], group["members"]
+    """
+
+    def __init__(self, max_members = 20, max_groups = None):
+        """ 
+        max_members -- (document id, node index, text) kept per group
+        max_groups -- bound of the number of groups, when a new group 
+                      doesn't fit, groups seen on one earlier document only 
+                      are forgotten (groups of the current one are kept)
+        """
+        self.max_members = max_members
+        self.max_groups = max_groups
+        self.documents_count = 0
+        #signature: [nodes count, documents count, last document, members]
+        self.groups = {}
+
+    def add_tree(self, tree, document_id = None):
+        """ index text nodes of one more page, document_id (number of 
+        the tree by default) identifies it in members of groups """
+        document = self.documents_count
+        if document_id is None:
+            document_id = document
+        signatures = tree.get_context_signatures()
+        groups = self.groups
+        #groups of earlier documents don't change here, one eviction is enough
+        evicted = False
+        for node_index in tree.iter_text_nodes():
+            signature = signatures[node_index]
+            group = groups.get(signature)
+            if group is None:
+                if (not evicted and self.max_groups is not None and 
+                        len(groups) >= self.max_groups):
+                    self.__evict_groups(document)
+                    evicted = True
+                group = groups[signature] = [0, 0, -1, []]
+            group[0] += 1
+            if group[2] != document:
+                group[1] += 1
+                group[2] = document
+            if len(group[3]) < self.max_members:
+                group[3].append((document_id, node_index, tree[node_index].text))
+        self.documents_count += 1
+
+    def iter_groups(self, min_documents = 2, min_nodes = 1):
+        """ yield groups found on at least min_documents pages, most frequent 
+        first, as dicts with keys signature, documents_count, nodes_count 
+        and members -- [(document id, node index, text)] """
+        found = [(group[1], group[0], signature) 
+                 for signature, group in self.groups.iteritems() 
+                 if group[1] >= min_documents and group[0] >= min_nodes]
+        found.sort(reverse = True)
+        for documents_count, nodes_count, signature in found:
+            group = self.groups.get(signature)
+            if group is None:
+                continue
+            yield {"signature": signature, 
+                   "documents_count": documents_count, 
+                   "nodes_count": nodes_count, 
+                   "members": list(group[3])}
+
+    def __evict_groups(self, document):
+        """ forget groups seen on one document only, except the current one """
+        for signature, group in self.groups.items():
+            if group[1] < 2 and group[2] != document:
+                del self.groups[signature]
+
+
+class Fetcher(object):
+    """fetches html pages over persistent HTTP connections
+
+    Idle connections are kept in a pool per host and reused (keep-alive), 
+    gzip and deflate bodies are decompressed on the fly, bytes are decoded 
+    by the parser (Content-Type charset is a hint for it). Not more than 
+    max_connections requests run at once and not more than max_per_host 
+    of them go to one host, requests to one host start at least min_delay 
+    seconds one after another. A fetcher is safe to share between threads.
+
+    fetcher = Fetcher(max_connections = 16, max_per_host = 4)
+    for url, tree, error in fetcher.fetch_trees(urls):
+        ...
+    """
+    __CHUNK_SIZE = 64 * 1024
+    __MAX_REDIRECTS = 5
+    __REDIRECT_STATUSES = set([301, 302, 303, 307, 308])
+    __default = None
+
+    def __init__(self, max_connections = 8, max_per_host = 2, timeout = 30, 
+                 min_delay = 0.0, headers = None):
+        """
+        timeout -- seconds to wait for connection and for every read
+        headers -- dict of extra request headers
+        """
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.min_delay = min_delay
+        self.headers = {"User-Agent": "htmlparser", 
+                        "Accept-Encoding": "gzip, deflate"}
+        self.headers.update(headers or {})
+        self.__slots = threading.BoundedSemaphore(max_connections)
+        self.__lock = threading.Lock()
+        self.__hosts = {}
+
+    @classmethod
+    def get_default(cls):
+        """ fetcher shared by trees built with url and no fetcher """
+        if cls.__default is None:
+            cls.__default = cls()
+        return cls.__default
+
+    def iter_body(self, url, headers = None):
+        """ fetch url, yield chunks of the decompressed body as soon as 
+        they arrive 
+        
+        headers -- dict, that is filled with response headers 
+                   (lowercase names) before the first chunk is yielded
+
+        network and protocol errors are raised as URLError (HTTPError 
+        for error statuses), like urllib2.urlopen does
+        """
+        for redirect in xrange(self.__MAX_REDIRECTS + 1):
+            scheme, host, path, query, _ = urlsplit(url)
+            if not scheme in ("http", "https") or not host:
+                raise ValueError("unsupported url %s" % url)
+            if query:
+                path += "?" + query
+            host_key = (scheme, host.lower())
+            with self.__get_host(host_key).slots:
+                #requests to other hosts run, while this one waits for its turn
+                self.__wait_turn(host_key)
+                with self.__slots:
+                    try:
+                        connection, response = self.__request(host_key, path or "/")
+                        if response.status in self.__REDIRECT_STATUSES and \
+                                response.getheader("location"):
+                            response.read()
+                            self.__release(host_key, connection, response)
+                            url = urljoin(url, response.getheader("location"))
+                            continue
+                        if response.status >= 400:
+                            response.read()
+                            self.__release(host_key, connection, response)
+                            raise HTTPError(url, response.status, response.reason, 
+                                            response.msg, None)
+                    except (HTTPException, socket.error) as error:
+                        raise URLError(error)
+                    if headers is not None:
+                        headers.update(response.getheaders())
+                    for chunk in self.__iter_decoded(host_key, connection, response):
+                        yield chunk
+                    return
+        raise URLError("too many redirects at %s" % url)
+
+    def fetch_tree(self, url):
+        return HTMLTextBlocksTree(url = url, fetcher = self)
+
+    def fetch_trees(self, urls, ordered = True):
+        """ fetch and build trees for urls concurrently, yield 
+        (url, tree, error) tuples, tree is None if fetching failed 
+        
+        ordered -- yield in the order of urls, otherwise as soon as ready
+        """
+        def fetch(url):
             try:
-                text = (isinstance(lxml_node.text, basestring) 
-                        and lxml_node.text.strip() or "")
-            except UnicodeDecodeError:
-                raise self.BadEncoding("Wrong html encoding at %s" % (self.url));
-            link = self.__get_link_url(lxml_node, tag)          
-            is_block = tag in self.__BLOCK_TAGS
-            to_skip = tag in self.__TAGS_TO_SKIP
-            
-            if text_before and (is_block or to_skip):
-                for_node, for_followers = \
-                        self.__split_mark_zones(mark_zones, len(text_before))
-                child_node = self.Node(text = text_before, 
-                                       parent_index = parent_index,
-                                       mark_zones = for_node)
-                self.append(child_node)
-                self[parent_index].child_indices.append(len(self) - 1)
-                text_before = ""
-                mark_zones = for_followers;              
-            if is_block and not to_skip:
-                child_node = self.Node(tag = tag, 
-                                       style_classes = child_classes,
-                                       parent_index = parent_index)
-                self.append(child_node)
-                node_index = len(self) - 1
-                self[parent_index].child_indices.append(node_index)
-                text_left, mark_zones = self.__translate_tree(lxml_node, 
-                                                                node_index, 
-                                                                text, 
-                                                                mark_zones)
-                if text_left:
-                    #make it a child of the block element
-                    for_node, for_followers = self.__split_mark_zones(
-                                                    mark_zones, len(text_before));                    
-                    child_node = HTMLTextBlocksTree.Node(text = text_left, 
-                                            parent_index = node_index,
-                                            mark_zones = for_node)
-                    self.append(child_node)
-                    self[node_index].child_indices.append(len(self) - 1)
-                    mark_zones = for_followers                      
-            elif not to_skip: 
-                #inline node, features of which we distribute in mark_zones
-                mark_add = ([HTMLTextBlocksTree.MarkZone(
-                                                start = len(text_before),
-                                                length = -1,
-                                                tag = tag, 
-                                                style_classes = child_classes, 
-                                                link = link)])
-                add_len = len(mark_add)
-                text_before = " ".join([text_before, text]).strip();
-                text_before, subtree_mark_zones = self.__translate_tree(lxml_node, 
-                                                    parent_index, 
-                                                    text_before, 
-                                                    mark_zones + mark_add)
-                # close the zones, which were created by this node
-                for zone_index in xrange(len(subtree_mark_zones) - 1, -1, -1):
-                    if subtree_mark_zones[zone_index].length == -1:
-                        subtree_mark_zones[zone_index].length = (len(text_before) -
-                                   subtree_mark_zones[zone_index].start);
-                        add_len -= 1;
-                        if not add_len:
-                            break;
-                if add_len:
-                    break;
-                mark_zones = subtree_mark_zones;                   
-            # not wrapped text that occurs after child-node: 
-            # <parent><child1>...</child1> text_after ... </parent>   
+                return url, self.fetch_tree(url), None
+            except (ValueError, URLError, HTMLTextBlocksTree.BadEncoding) as error:
+                return url, None, error
+        pool = ThreadPool(self.max_connections)
+        try:
+            if ordered:
+                results = pool.imap(fetch, urls)
+            else:
+                results = pool.imap_unordered(fetch, urls)
+            for result in results:
+                yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def close(self):
+        """ close idle connections """
+        with self.__lock:
+            hosts = self.__hosts.values()
+        for host in hosts:
+            while host.idle:
+                host.idle.pop().close()
+
+    class __Host(object):
+        """ state of one host: idle connections and politeness slots """
+        __slots__ = ("idle", "slots", "next_start")
+
+        def __init__(self, max_per_host):
+            self.idle = []
+            self.slots = threading.BoundedSemaphore(max_per_host)
+            self.next_start = 0.0
+
+    def __get_host(self, host_key):
+        with self.__lock:
+            host = self.__hosts.get(host_key)
+            if host is None:
+                host = self.__hosts[host_key] = self.__Host(self.max_per_host)
+            return host
+
+    def __wait_turn(self, host_key):
+        host = self.__get_host(host_key)
+        with self.__lock:
+            start = max(time.time(), host.next_start)
+            host.next_start = start + self.min_delay
+        if start > time.time():
+            time.sleep(start - time.time())
+
+    def __request(self, host_key, path):
+        """ send request over an idle connection, or a new one if 
+        there is none or the server has closed it """
+        host = self.__get_host(host_key)
+        with self.__lock:
+            connection = host.idle and host.idle.pop() or None
+        if connection is not None:
+            try:
+                connection.request("GET", path, headers = self.headers)
+                return connection, connection.getresponse()
+            except (HTTPException, socket.error):
+                connection.close()
+        scheme, netloc = host_key
+        connection_class = scheme == "https" and HTTPSConnection or HTTPConnection
+        connection = connection_class(netloc, timeout = self.timeout)
+        try:
+            connection.request("GET", path, headers = self.headers)
+            return connection, connection.getresponse()
+        except:
+            connection.close()
+            raise
+
+    def __release(self, host_key, connection, response):
+        """ return connection of the completely read response to the pool """
+        if response.will_close:
+            connection.close()
+            return
+        host = self.__get_host(host_key)
+        with self.__lock:
+            host.idle.append(connection)
+
+    def __iter_decoded(self, host_key, connection, response):
+        content_encoding = (response.getheader("content-encoding") or "").lower()
+        decompressor = None
+        if content_encoding == "gzip":
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif content_encoding == "deflate":
+            decompressor = zlib.decompressobj()
+        completed = False
+        try:
+            while True:
+                try:
+                    chunk = response.read(self.__CHUNK_SIZE)
+                except (HTTPException, socket.error) as error:
+                    raise URLError(error)
+                if not chunk:
+                    #connection closed before Content-Length bytes were read
+                    if response.length:
+                        raise URLError(IncompleteRead("", response.length))
+                    break
+                if decompressor is not None:
+                    try:
+                        chunk = decompressor.decompress(chunk)
+                    except zlib.error:
+                        if content_encoding != "deflate":
+                            raise
+                        #some servers send raw deflate data without zlib header
+                        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                        chunk = decompressor.decompress(chunk)
+                if chunk:
+                    yield chunk
+            tail = decompressor is not None and decompressor.flush() or ""
+            if tail:
+                yield tail
+            completed = True
+        finally:
+            if completed:
+                self.__release(host_key, connection, response)
+            else:
+                connection.close()
+
+
+class ParseCache(object):
+    """cache of parsed trees keyed by a hash of html and parser configuration
+
+    Recently used trees are kept in memory, trees evicted from memory are 
+    kept in a directory (optional), both tiers are bounded. get_tree() 
+    returns copy on write copies of cached trees, so changing one of them 
+    (substract_tree, for example) doesn't change others.
+
+    cache = ParseCache(max_trees = 256, directory = "trees", max_disk_bytes = 2 ** 30)
+    tree = cache.get_tree(html)
+    print cache.get_stats()
+    """
+    __FILE_SUFFIX = ".tree"
+
+    def __init__(self, max_trees = 128, directory = None, max_disk_bytes = None):
+        """
+        max_trees -- number of trees kept in memory
+        directory -- directory for the disk tier, None to keep trees in memory only
+        max_disk_bytes -- bound of the disk tier size, least recently used 
+                          trees are removed when it is exceeded
+        """
+        self.max_trees = max_trees
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.write_errors = 0
+        self.__trees = OrderedDict()
+        self.__files = OrderedDict()
+        self.__disk_bytes = 0
+        self.__lock = threading.Lock()
+        self.__config_digest = HTMLTextBlocksTree.get_config_digest()
+        if directory is not None:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.__scan_directory()
+
+    def get_tree(self, html, url = None):
+        """ tree of html string, parsed only if it is not in the cache """
+        key = self.get_key(html)
+        with self.__lock:
+            tree = self.__trees.pop(key, None)
+            if tree is not None:
+                self.__trees[key] = tree
+                self.hits += 1
+        if tree is None:
+            tree = self.__load_file(key)
+            if tree is not None:
+                self.disk_hits += 1
+            else:
+                self.misses += 1
+                tree = HTMLTextBlocksTree(html, url = url)
+                self.__save_file(key, tree)
+            self.__remember(key, tree)
+        tree = tree.copy()
+        tree.url = url
+        return tree
+
+    def get_key(self, html):
+        """ hex digest of html and the parser configuration """
+        if isinstance(html, unicode):
+            html = "u" + html.encode("utf8")
+        else:
+            html = "b" + html
+        return md5(self.__config_digest + html).hexdigest()
+
+    def get_stats(self):
+        requests = self.hits + self.disk_hits + self.misses
+        return {"hits": self.hits, 
+                "disk_hits": self.disk_hits, 
+                "misses": self.misses, 
+                "write_errors": self.write_errors, 
+                "hit_rate": requests and float(self.hits + self.disk_hits) / requests or 0.0, 
+                "trees_in_memory": len(self.__trees), 
+                "trees_on_disk": len(self.__files), 
+                "disk_bytes": self.__disk_bytes}
+
+    def clear(self):
+        """ drop all cached trees, in memory and on disk """
+        with self.__lock:
+            self.__trees.clear()
+            while self.__files:
+                self.__remove_file(self.__files.keys()[0])
+
+    def __remember(self, key, tree):
+        with self.__lock:
+            self.__trees[key] = tree
+            while len(self.__trees) > self.max_trees:
+                self.__trees.popitem(last = False)
+
+    def __get_filename(self, key):
+        return os.path.join(self.directory, key + self.__FILE_SUFFIX)
+
+    def __scan_directory(self):
+        """ pick up trees left by previous runs, oldest first """
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(self.__FILE_SUFFIX):
+                stat = os.stat(os.path.join(self.directory, name))
+                files.append((stat.st_mtime, name[:-len(self.__FILE_SUFFIX)], stat.st_size))
+        for _, key, size in sorted(files):
+            self.__files[key] = size
+            self.__disk_bytes += size
+
+    def __load_file(self, key):
+        if self.directory is None:
+            return None
+        with self.__lock:
+            size = self.__files.pop(key, None)
+            if size is None:
+                return None
+            self.__files[key] = size
+        filename = self.__get_filename(key)
+        try:
+            tree = HTMLTextBlocksTree.load(filename)
+            os.utime(filename, None)
+        except Exception:
+            #a damaged or foreign file is a miss, it is replaced by a new one
+            with self.__lock:
+                self.__remove_file(key)
+            return None
+        return tree
+
+    def __save_file(self, key, tree):
+        if self.directory is None:
+            return
+        filename = self.__get_filename(key)
+        temporary_filename = "%s.%d.%d" % (filename, os.getpid(), 
+                                           threading.current_thread().ident)
+        try:
+            tree.save(temporary_filename)
+            os.rename(temporary_filename, filename)
+        except EnvironmentError:
+            #the tree is still cached in memory, a full or read only disk 
+            #only makes the disk tier useless
+            with self.__lock:
+                self.write_errors += 1
             try:
-                text_after = (isinstance(lxml_node.tail, basestring) 
-                              and lxml_node.tail.strip() or "");
-            except UnicodeDecodeError:
-                raise self.BadEncoding("Wrong html encoding at %s" % (self.url));
-            text_before = " ".join([text_before, text_after]).strip();
-        return (text_before, mark_zones);
+                os.remove(temporary_filename)
+            except OSError:
+                pass
+            return
+        with self.__lock:
+            self.__disk_bytes -= self.__files.pop(key, 0)
+            self.__files[key] = os.path.getsize(filename)
+            self.__disk_bytes += self.__files[key]
+            while (self.max_disk_bytes is not None and len(self.__files) > 1 and 
+                   self.__disk_bytes > self.max_disk_bytes):
+                self.__remove_file(self.__files.keys()[0])
+
+    def __remove_file(self, key):
+        self.__disk_bytes -= self.__files.pop(key, 0)
+        try:
+            os.remove(self.__get_filename(key))
+        except OSError:
+            pass
+
+
+"""batch parsing: documents are dicts with key "html", "filename" or "url" 
+and an optional "id", results are dicts {"id": ..., "error": ..., 
+<operation>: ...} in the order of documents (or as they are ready)
+"""
+OPERATIONS = ("text_nodes", "similar_sense_texts", "records", "stats")
+RECORD_FIELDS = ("document", "node", "group", "path", "text", "mark_zones", "error")
+
+
+def iter_documents(source):
+    """ documents of a directory (all files in it), a glob pattern or 
+    a JSONL file ("-" is stdin), every line of it is a document dict
+    """
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            filename = os.path.join(source, name)
+            if os.path.isfile(filename):
+                yield {"id": filename, "filename": filename}
+    elif source == "-" or source.endswith(".jsonl"):
+        lines = source == "-" and sys.stdin or open(source, "rb")
+        for line_number, line in enumerate(lines):
+            if line.strip():
+                document = json.loads(line)
+                document.setdefault("id", line_number)
+                yield document
+    else:
+        for filename in sorted(glob(source)):
+            yield {"id": filename, "filename": filename}
+
+
+_worker_settings = {}
+
+def _init_worker(operations, template, limits = None, groups = False):
+    _worker_settings["operations"] = operations
+    _worker_settings["template"] = template
+    _worker_settings["limits"] = limits
+    _worker_settings["groups"] = groups
+
+def _parse_document(document):
+    """ build the tree of one document and run operations on it, 
+    failures are reported in the result instead of being raised
+    """
+    result = {"id": document.get("id"), "error": None}
+    operations = _worker_settings.get("operations", ())
+    stats = "stats" in operations and HTMLTextBlocksTree.Stats() or None
+    limits = _worker_settings.get("limits")
+    tree = None
+    try:
+        if "html" in document:
+            tree = HTMLTextBlocksTree(document["html"], url = document.get("url"), 
+                                      stats = stats, limits = limits)
+        elif "filename" in document:
+            tree = HTMLTextBlocksTree(filename = document["filename"], stats = stats, 
+                                      limits = limits)
+        else:
+            tree = HTMLTextBlocksTree(url = document["url"], stats = stats, 
+                                      limits = limits)
+        if _worker_settings.get("template") is not None:
+            tree.substract_template(_worker_settings["template"])
+        #records and similar_sense_texts share the groups
+        groups = (("similar_sense_texts" in operations or 
+                   "records" in operations and _worker_settings.get("groups")) and 
+                  tree.get_similar_sense_texts())
+        for operation in operations:
+            if operation == "text_nodes":
+                result[operation] = [tree[node_index].text for node_index 
+                                     in tree.get_text_nodes()]
+            elif operation == "similar_sense_texts":
+                result[operation] = [[tree[node_index].text for node_index in group] 
+                                     for group in groups]
+            elif operation == "records":
+                result[operation] = list(tree.iter_records(groups))
+    except HTMLTextBlocksTree.BadEncoding as error:
+        result["error"] = "BadEncoding: %s" % error
+    except Exception as error:
+        result["error"] = "%s: %s" % (error.__class__.__name__, error)
+    if stats is not None:
+        result["stats"] = stats.as_dict()
+    if limits is not None:
+        result["limits_hit"] = tree is not None and tree.limits_hit or []
+    return result
+
+def parse_batch(documents, operations = ("text_nodes",), template = None, 
+                processes = None, chunksize = 16, ordered = True, limits = None, 
+                max_pending = None, groups = False):
+    """ parse documents on a pool of worker processes, yield results
     
-    def __unlink_text_free_nodes(self):
-        """ unlink all subtrees without text nodes """
-        for node_index, node in enumerate(self):
-            if (node.parent_index > -1 and 
-                    node_index in self[node.parent_index].child_indices and 
-                    not node.text_nodes_count):
-                self[node.parent_index].child_indices.remove(node_index)  
+    operations -- names from OPERATIONS to run on every tree
+    template -- SiteTemplate to substract from every tree before operations
+    processes -- number of workers (cpu count by default), 
+                 1 parses documents in this process
+    chunksize -- number of documents sent to a worker at once
+    ordered -- yield results in the order of documents, 
+               otherwise as soon as they are ready
+    limits -- HTMLTextBlocksTree.Limits of every tree, names of limits hit 
+              are in result["limits_hit"]
+    max_pending -- number of documents read ahead of the results yielded 
+                   (4 chunks per worker by default), so that a long source 
+                   is processed in constant memory
+    groups -- group texts of records with get_similar_sense_texts (they are 
+              grouped anyway, when similar_sense_texts is in operations)
+    """
+    for operation in operations:
+        if not operation in OPERATIONS:
+            raise ValueError("unknown operation %r" % operation)
+    if processes == 1:
+        _init_worker(operations, template, limits, groups)
+        for document in documents:
+            yield _parse_document(document)
+        return
+    if max_pending is None:
+        max_pending = 4 * chunksize * (processes or cpu_count())
+    #the pool reads documents in a thread of its own, as fast as it can
+    pending = threading.Semaphore(max(max_pending, chunksize))
+    stopped = []
+    def iter_pending():
+        for document in documents:
+            pending.acquire()
+            if stopped:
+                return
+            yield document
+    pool = Pool(processes, _init_worker, (operations, template, limits, groups))
+    try:
+        if ordered:
+            results = pool.imap(_parse_document, iter_pending(), chunksize)
+        else:
+            results = pool.imap_unordered(_parse_document, iter_pending(), chunksize)
+        for result in results:
+            pending.release()
+            yield result
+        pool.close()
+    finally:
+        stopped.append(True)
+        pending.release()
+        pool.terminate()
+        pool.join()
+
+
+def iter_records(documents, template = None, processes = None, chunksize = 16, 
+                 ordered = True, limits = None, groups = True):
+    """ yield a record per text node of documents (see 
+    HTMLTextBlocksTree.iter_records) with the document id in "document", 
+    trees are released as soon as their records are made; a failed 
+    document gives one record with "error"
+
+    groups -- group texts of every document with get_similar_sense_texts
+    """
+    #only group ids of records are sent back, not texts of groups
+    for result in parse_batch(documents, ("records",), template, processes, 
+                              chunksize, ordered, limits, groups = groups):
+        if result["error"]:
+            yield {"document": result["id"], "error": result["error"]}
+            continue
+        for record in result["records"]:
+            record["document"] = result["id"]
+            yield record
+
+def write_records(records, out, format = "jsonl"):
+    """ write records to a file-like object as JSON lines or CSV rows 
+    (RECORD_FIELDS columns, mark zones as JSON), returns number of records
+    """
+    if not format in ("jsonl", "csv"):
+        raise ValueError("unknown format %r" % format)
+    count = 0
+    if format == "csv":
+        writer = csv.writer(out)
+        writer.writerow(RECORD_FIELDS)
+    for record in records:
+        if format == "jsonl":
+            out.write(json.dumps(record) + "\n")
+        else:
+            row = []
+            for field in RECORD_FIELDS:
+                value = record.get(field)
+                if field == "mark_zones":
+                    value = json.dumps(value or [])
+                elif value is None:
+                    value = ""
+                row.append(isinstance(value, unicode) and value.encode("utf8") or value)
+            writer.writerow(row)
+        count += 1
+    return count
 
 
+def main(args = None):
+    """ python -m htmlparser [options] source > results.jsonl """
+    parser = ArgumentParser(prog = "python -m htmlparser", 
+                            description = "parse html documents in parallel, "
+                                          "print results as JSON lines")
+    parser.add_argument("source", 
+                        help = "directory, glob pattern or JSONL file (- for stdin)")
+    parser.add_argument("-o", "--operation", action = "append", choices = OPERATIONS,
+                        help = "operation to run on every tree (text_nodes by default)")
+    parser.add_argument("-t", "--template", help = "site template to substract")
+    parser.add_argument("-p", "--processes", type = int, default = None)
+    parser.add_argument("-c", "--chunksize", type = int, default = 16)
+    parser.add_argument("-u", "--unordered", action = "store_true",
+                        help = "print results as soon as they are ready")
+    for name in ("max_nodes", "max_depth", "max_text_bytes", "max_zones_per_node"):
+        parser.add_argument("--" + name.replace("_", "-"), type = int, 
+                            help = "limit of every tree, see HTMLTextBlocksTree.Limits")
+    parser.add_argument("--max-seconds", type = float, 
+                        help = "deadline of every operation on a tree")
+    parser.add_argument("-r", "--records", action = "store_true",
+                        help = "print a record per text node instead of a result "
+                               "per document")
+    parser.add_argument("-f", "--format", choices = ("jsonl", "csv"), default = "jsonl",
+                        help = "format of records")
+    parser.add_argument("--no-groups", action = "store_true",
+                        help = "don't group texts of records with similar sense")
+    options = parser.parse_args(args)
+    template = options.template and SiteTemplate.load(options.template) or None
+    limits = None
+    if [name for name in ("max_nodes", "max_depth", "max_text_bytes", 
+                          "max_zones_per_node", "max_seconds") 
+            if getattr(options, name) is not None]:
+        limits = HTMLTextBlocksTree.Limits(options.max_nodes, options.max_depth, 
+                                           options.max_text_bytes, 
+                                           options.max_zones_per_node, 
+                                           options.max_seconds)
+    if options.records:
+        failed = []
+        def count_failed(records):
+            for record in records:
+                if record.get("error"):
+                    failed.append(record["document"])
+                yield record
+        write_records(count_failed(iter_records(iter_documents(options.source), template, 
+                                                options.processes, options.chunksize, 
+                                                not options.unordered, limits, 
+                                                not options.no_groups)), 
+                      sys.stdout, options.format)
+        return failed and 1 or 0
+    failed = 0
+    for result in parse_batch(iter_documents(options.source), 
+                              options.operation or ("text_nodes",), template,
+                              options.processes, options.chunksize, 
+                              not options.unordered, limits):
+        if result["error"]:
+            failed += 1
+        sys.stdout.write(json.dumps(result) + "\n")
+    return failed and 1 or 0
 
 
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,166 @@
+# -*- encoding: utf8 -*-
+import gzip
+import time
+import zlib
+import socket
+import threading
+from StringIO import StringIO
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from urllib2 import HTTPError, URLError
+
+import pytest
+
+from htmlparser import HTMLTextBlocksTree, Fetcher
+
+
+PAGE = u"<html><body><p>hello</p><p>привет</p></body></html>"
+
+
+def get_gzip(data):
+    out = StringIO()
+    with gzip.GzipFile(fileobj = out, mode = "wb") as gzip_file:
+        gzip_file.write(data)
+    return out.getvalue()
+
+
+#path -> (status, headers, body)
+RESPONSES = {
+    "/page": (200, {"Content-Type": "text/html; charset=utf-8"}, PAGE.encode("utf8")),
+    "/gzip": (200, {"Content-Encoding": "gzip"}, get_gzip(PAGE.encode("utf8"))),
+    "/deflate": (200, {"Content-Encoding": "deflate"}, zlib.compress(PAGE.encode("utf8"))),
+    "/raw-deflate": (200, {"Content-Encoding": "deflate"},
+                     zlib.compress(PAGE.encode("utf8"))[2:-4]),
+    "/cp1251": (200, {"Content-Type": "text/html; charset=windows-1251"},
+                PAGE.encode("cp1251")),
+    "/redirect": (302, {"Location": "/page"}, ""),
+    "/missing": (404, {}, "not found"),
+}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.connections.add(self.client_address)
+        if self.path == "/truncated":
+            #the connection is closed in the middle of the body
+            self.send_response(200)
+            self.send_header("Content-Length", "1000")
+            self.end_headers()
+            self.wfile.write(PAGE.encode("utf8"))
+            self.close_connection = 1
+            return
+        status, headers, body = RESPONSES.get(self.path, RESPONSES["/missing"])
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    """local stand-in server, a thread serves every keep-alive connection"""
+    daemon_threads = True
+
+
+@pytest.fixture
+def server():
+    server = Server(("127.0.0.1", 0), Handler)
+    server.connections = set()
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def get_url(server, path):
+    return "http://127.0.0.1:%d%s" % (server.server_address[1], path)
+
+
+def get_texts(tree):
+    return [tree[node_index].text for node_index in tree.get_text_nodes()]
+
+
+def test_keep_alive(server):
+    fetcher = Fetcher(max_connections = 1, max_per_host = 1)
+    for _ in xrange(5):
+        tree = HTMLTextBlocksTree(url = get_url(server, "/page"), fetcher = fetcher)
+        assert get_texts(tree) == [u"hello", u"привет"]
+    fetcher.close()
+    assert len(server.connections) == 1
+
+
+def test_compressed_bodies(server):
+    fetcher = Fetcher()
+    for path in ["/gzip", "/deflate", "/raw-deflate"]:
+        assert "".join(fetcher.iter_body(get_url(server, path))) == PAGE.encode("utf8")
+    fetcher.close()
+
+
+def test_charset(server):
+    fetcher = Fetcher()
+    tree = HTMLTextBlocksTree(url = get_url(server, "/cp1251"), fetcher = fetcher)
+    assert tree.encoding == "windows-1251"
+    assert get_texts(tree) == [u"hello", u"привет"]
+    fetcher.close()
+
+
+def test_redirect(server):
+    fetcher = Fetcher(max_connections = 1, max_per_host = 1)
+    tree = HTMLTextBlocksTree(url = get_url(server, "/redirect"), fetcher = fetcher)
+    assert get_texts(tree) == [u"hello", u"привет"]
+    fetcher.close()
+    assert len(server.connections) == 1
+
+
+def test_fetch_trees(server):
+    fetcher = Fetcher(max_connections = 4, max_per_host = 2)
+    urls = [get_url(server, path) for path in ["/page", "/missing", "/gzip"] * 4]
+    results = list(fetcher.fetch_trees(urls))
+    fetcher.close()
+    assert [url for url, _, _ in results] == urls
+    for url, tree, error in results:
+        if url.endswith("/missing"):
+            assert tree is None and isinstance(error, HTTPError) and error.code == 404
+        else:
+            assert error is None and len(get_texts(tree)) == 2
+    #connections are reused, at most max_per_host of them are open at once
+    assert len(server.connections) <= 2
+
+
+def test_network_errors(server):
+    fetcher = Fetcher()
+    with pytest.raises(URLError):
+        "".join(fetcher.iter_body(get_url(server, "/truncated")))
+    closed = socket.socket()
+    closed.bind(("127.0.0.1", 0))
+    closed_url = "http://127.0.0.1:%d/page" % closed.getsockname()[1]
+    closed.close()
+    with pytest.raises(URLError):
+        HTMLTextBlocksTree(url = closed_url, fetcher = fetcher)
+    results = list(fetcher.fetch_trees([closed_url, get_url(server, "/page")]))
+    assert isinstance(results[0][2], URLError) and results[0][1] is None
+    assert results[1][2] is None
+    fetcher.close()
+
+
+def test_min_delay_of_one_host_does_not_block_others(server):
+    fetcher = Fetcher(max_connections = 1, max_per_host = 1, min_delay = 1.0)
+    get_body = lambda url: "".join(fetcher.iter_body(url))
+    get_body(get_url(server, "/page"))
+    waiting = threading.Thread(target = get_body, args = (get_url(server, "/page"),))
+    waiting.start()
+    time.sleep(0.1)
+    started = time.time()
+    assert get_body("http://localhost:%d/page" % server.server_address[1]) == \
+                                                                    PAGE.encode("utf8")
+    assert time.time() - started < 0.5
+    waiting.join()
+    fetcher.close()
@@ -0,0 +1,788 @@
+# -*- encoding: utf8 -*-
+import csv
+import json
+import pickle
+from StringIO import StringIO
+
+import pytest
+
+from htmlparser import (HTMLTextBlocksTree, CorpusGrouper, ParseCache, SiteTemplate, 
+                        OPERATIONS, RECORD_FIELDS, iter_documents, iter_records, main, 
+                        parse_batch, write_records)
+
+
+def test_empty_html():
+    for tree in [HTMLTextBlocksTree(""), HTMLTextBlocksTree(u""), 
+                 HTMLTextBlocksTree(stream = iter([]))]:
+        assert len(tree) == 1
+        assert tree.get_text_nodes() == []
+
+
+def test_operations_on_empty_trees():
+    for empty in [HTMLTextBlocksTree, lambda: HTMLTextBlocksTree("")]:
+        assert empty().get_text_signatures() == {}
+        for operation in ["substract_tree", "cross_tree"]:
+            tree = empty()
+            getattr(tree, operation)(HTMLTextBlocksTree("<p>x</p>"))
+            assert tree.get_text_nodes() == []
+            tree = HTMLTextBlocksTree("<p>x</p>")
+            getattr(tree, operation)(empty())
+            assert get_texts(tree) == (operation == "substract_tree" and ["x"] or [])
+        template = SiteTemplate()
+        template.add_tree(empty())
+        template.add_tree(empty())
+        tree = empty()
+        tree.substract_template(template)
+        assert tree.get_text_nodes() == []
+
+
+def test_default_url():
+    tree = HTMLTextBlocksTree("<p>x</p>")
+    assert tree.url == ""
+    tree.update("<p>y</p>")
+    assert tree.url == ""
+    assert HTMLTextBlocksTree("<p>x</p>", url = "http://example.com/").url == "http://example.com/"
+
+
+def test_empty_file(tmpdir):
+    filename = str(tmpdir.join("empty.html"))
+    open(filename, "wb").close()
+    assert len(HTMLTextBlocksTree(filename = filename)) == 1
+    results = list(parse_batch(iter_documents(str(tmpdir)), processes = 1))
+    assert results == [{"id": filename, "error": None, "text_nodes": []}]
+
+
+DOCUMENTS = [{"id": "list", "html": "<ul><li>one</li><li>two</li></ul><p>x</p>"}, 
+             {"id": "link", "html": '<p><a href="/y">y</a></p>', "url": "http://example.com/"}, 
+             {"id": "broken"}]
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_parse_batch(processes):
+    results = list(parse_batch(DOCUMENTS, OPERATIONS, processes = processes, chunksize = 1))
+    assert [result["id"] for result in results] == ["list", "link", "broken"]
+    listed, linked, broken = results
+    assert listed["error"] is None and listed["text_nodes"] == ["one", "two", "x"]
+    assert listed["similar_sense_texts"] == [["one", "two"]]
+    assert [record["group"] for record in listed["records"]] == [0, 0, None]
+    assert linked["records"][0]["mark_zones"][0]["link"] == "/y"
+    assert listed["stats"]["counters"]["nodes_created"] > 0
+    assert broken["error"] == "KeyError: 'url'"
+    unordered = parse_batch(DOCUMENTS, processes = processes, ordered = False)
+    assert sorted([result["id"] for result in unordered]) == ["broken", "link", "list"]
+    with pytest.raises(ValueError):
+        list(parse_batch(DOCUMENTS, ("no such operation",)))
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_parse_batch_settings(processes):
+    template = SiteTemplate()
+    for title in ["first", "second", "third"]:
+        template.add_tree(HTMLTextBlocksTree(get_site_page(title)))
+    documents = [{"id": title, "html": get_site_page(title)} for title in ["fourth", "fifth"]]
+    results = parse_batch(documents, template = template, processes = processes)
+    assert [result["text_nodes"] for result in results] == [["fourth"], ["fifth"]]
+    limits = HTMLTextBlocksTree.Limits(max_nodes = 6)
+    results = list(parse_batch(DOCUMENTS, processes = processes, limits = limits))
+    assert results[0]["limits_hit"] == ["max_nodes"] and results[0]["text_nodes"] == ["one"]
+    assert results[1]["limits_hit"] == [] and results[2]["limits_hit"] == []
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_parse_batch_reads_ahead_max_pending(processes):
+    read = []
+    def iter_source():
+        for document in xrange(100):
+            read.append(document)
+            yield {"id": document, "html": "<p>%d</p>" % document}
+    results = parse_batch(iter_source(), processes = processes, chunksize = 1, 
+                          max_pending = 4)
+    assert next(results)["text_nodes"] == ["0"]
+    #the source is not read to the end before the first result
+    assert len(read) <= 5
+    assert [result["id"] for result in results] == range(1, 100)
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_iter_records(processes):
+    records = list(iter_records(DOCUMENTS, processes = processes))
+    assert [(record["document"], record.get("text"), record.get("group")) 
+            for record in records] == [("list", "one", 0), ("list", "two", 0), 
+                                       ("list", "x", None), ("link", "y", None), 
+                                       ("broken", None, None)]
+    assert records[0]["path"] == "html/body/ul/li"
+    assert records[-1] == {"document": "broken", "error": "KeyError: 'url'"}
+    #texts of groups are not sent with records
+    assert not [record for record in records if "similar_sense_texts" in record]
+    records = iter_records(DOCUMENTS[:1], processes = processes, groups = False)
+    assert [record["group"] for record in records] == [None] * 3
+
+
+def test_write_records():
+    records = list(iter_records(DOCUMENTS, processes = 1))
+    out = StringIO()
+    assert write_records(records, out) == 5
+    assert [json.loads(line) for line in out.getvalue().splitlines()] == records
+    out = StringIO()
+    assert write_records(records, out, format = "csv") == 5
+    rows = list(csv.reader(StringIO(out.getvalue())))
+    assert rows[0] == list(RECORD_FIELDS)
+    assert rows[1] == ["list", "5", "0", "html/body/ul/li", "one", "[]", ""]
+    assert json.loads(rows[4][RECORD_FIELDS.index("mark_zones")])[0]["tag"] == "a"
+    assert rows[5] == ["broken", "", "", "", "", "[]", "KeyError: 'url'"]
+    with pytest.raises(ValueError):
+        write_records(records, out, format = "xml")
+
+
+def test_main(tmpdir, capsys):
+    source = tmpdir.join("documents.jsonl")
+    source.write("\n".join([json.dumps(document) for document in DOCUMENTS]) + "\n")
+    assert main([str(source), "-p", "1", "-o", "text_nodes"]) == 1
+    results = [json.loads(line) for line in capsys.readouterr()[0].splitlines()]
+    assert [result["text_nodes"] for result in results[:2]] == [["one", "two", "x"], ["y"]]
+    assert results[2]["error"] == "KeyError: 'url'"
+    assert main([str(source), "-p", "2", "-r", "-f", "csv"]) == 1
+    rows = list(csv.reader(StringIO(capsys.readouterr()[0])))
+    assert [row[:3] for row in rows[1:]] == [["list", "5", "0"], ["list", "7", "0"], 
+                                             ["list", "9", ""], ["link", "4", ""], 
+                                             ["broken", "", ""]]
+    source.write(json.dumps(DOCUMENTS[0]) + "\n")
+    assert main([str(source), "-r", "--no-groups", "--max-nodes", "6"]) == 0
+    records = [json.loads(line) for line in capsys.readouterr()[0].splitlines()]
+    assert [(record["text"], record["group"]) for record in records] == [("one", None)]
+
+
+def get_texts(tree):
+    return [tree[node_index].text for node_index in tree.get_text_nodes()]
+
+
+def test_stray_end_tag_before_text():
+    tree = HTMLTextBlocksTree("</b>hello<p>x</p>")
+    assert get_texts(tree) == ["hello", "x"]
+
+
+def test_stray_end_tag_after_doctype():
+    tree = HTMLTextBlocksTree("<!DOCTYPE html>\n</div><p>x</p>")
+    assert get_texts(tree) == ["x"]
+
+
+def test_stray_end_tag_before_html():
+    tree = HTMLTextBlocksTree("</p>\n<html><body><p>x</p></body></html>")
+    assert str(tree) == str(HTMLTextBlocksTree("<html><body><p>x</p></body></html>"))
+
+
+def test_stray_end_tags_fed_in_chunks():
+    tree = HTMLTextBlocksTree()
+    for chunk in ["<!-- </p> -->", "</b", "></td>  hel", "lo<span>y", "</span>", 
+                  "<p>x</p>" * 1000]:
+        tree.feed(chunk)
+    tree.close()
+    assert get_texts(tree) == ["hello y"] + ["x"] * 1000
+
+
+def test_scripts_fed_in_chunks():
+    closed = "<p>a</p><script>if (a < b) s = '</p>';</SCRIPT ><p>b</p><style>p {}</style>c"
+    unclosed = "<p>a</p><script>var s = 1;<p>b</p></body></html>"
+    for html, texts in [(closed, ["a", "b", "c"]), (unclosed, ["a"])]:
+        assert get_texts(HTMLTextBlocksTree(html)) == texts
+        for size in [1, 3, 7]:
+            tree = HTMLTextBlocksTree()
+            for start in xrange(0, len(html), size):
+                tree.feed(html[start:start + size])
+            tree.close()
+            assert get_texts(tree) == texts
+
+
+def test_only_end_tags():
+    assert len(HTMLTextBlocksTree("</b></p>")) == 1
+
+
+def test_end_tags_after_text_are_kept():
+    #libxml2 makes an empty paragraph of </p>, it cuts the text
+    tree = HTMLTextBlocksTree("word</p>hello")
+    assert get_texts(tree) == ["word", "hello"]
+
+
+def test_text_after_doctype():
+    tree = HTMLTextBlocksTree("<!DOCTYPE html>\nhello")
+    assert get_texts(tree) == ["hello"]
+
+
+def test_node_lists_write_through():
+    tree = HTMLTextBlocksTree()
+    tree.append(HTMLTextBlocksTree.Node(tag = "div"))
+    tree.append(HTMLTextBlocksTree.Node(parent_index = 0, text = "hello"))
+    tree[0].child_indices.append(1)
+    tree[0].style_classes.append("post")
+    tree[1].mark_zones.append(HTMLTextBlocksTree.MarkZone(0, 5, "b"))
+    assert tree[0].child_indices == [1]
+    assert tree[0].style_classes == ["post"]
+    assert [zone.tag for zone in tree[1].mark_zones] == ["b"]
+    assert tree.find_by_class("post") == [0]
+    children = tree[0].child_indices
+    children.remove(1)
+    assert tree[0].child_indices == []
+    children += [1]
+    assert tree[0].child_indices == [1]
+    assert pickle.loads(pickle.dumps(children)) == [1]
+
+
+def get_group_texts(tree):
+    return [[tree[node_index].text for node_index in group] 
+            for group in tree.get_similar_sense_texts()]
+
+
+def test_similar_sense_texts_of_table_rows():
+    rows = "".join(['<tr class="%s">%s</tr>' % (row % 2 and "odd" or "even", 
+                                              "".join(["<td>%d.%d</td>" % (row, cell) 
+                                                       for cell in xrange(6)]))
+                    for row in xrange(3)])
+    tree = HTMLTextBlocksTree("<table>%s</table>" % rows)
+    assert get_group_texts(tree) == [["%d.%d" % (row, cell) for cell in xrange(6)] 
+                                     for row in xrange(3)]
+
+
+def test_similar_sense_texts_of_list():
+    items = "".join(["<li><b>%d</b> item</li>" % item for item in xrange(5)])
+    tree = HTMLTextBlocksTree("<h1>title</h1><ul>%s</ul><p>footer</p>" % items)
+    assert get_group_texts(tree) == [["%d item" % item for item in xrange(5)]]
+
+
+def test_similar_sense_texts_with_structural_index():
+    items = "".join(["<li><b>%d</b> item</li>" % item for item in xrange(5)])
+    tree = HTMLTextBlocksTree("<ul>%s</ul>" % items)
+    groups = tree.get_similar_sense_texts()
+    tree.index_structure()
+    assert tree.get_similar_sense_texts() == groups
+
+
+def get_page(items):
+    menu = "".join(["<li>section %d</li>" % item for item in xrange(5)])
+    return "<ul>%s</ul><div>%s</div>" % (menu, "".join(["<p>%s</p>" % item for item in items]))
+
+
+def test_substract_tree():
+    tree = HTMLTextBlocksTree(get_page(["first", "second"]))
+    tree.substract_tree(HTMLTextBlocksTree(get_page(["third", "fourth", "fifth"])))
+    assert get_texts(tree) == ["first", "second"]
+
+
+def test_compact_removed_nodes():
+    tree = HTMLTextBlocksTree(get_page(["first", "second"]))
+    size = len(tree)
+    texts = dict((node_index, tree[node_index].text) for node_index in tree.get_text_nodes())
+    tree.substract_tree(HTMLTextBlocksTree(get_page(["third", "fourth", "fifth"])))
+    #removed nodes stay as tombstones, lists of children skip them
+    assert len(tree) == size
+    live = list(tree.iter_dfs())
+    assert len(live) < size
+    assert not [child for node_index in live for child in tree[node_index].child_indices 
+                if not child in live]
+    dump = unicode(tree)
+    mapping = tree.compact()
+    assert len(tree) == len(live) and list(tree.iter_dfs()) == range(len(tree))
+    assert [mapping[node_index] for node_index in live] == range(len(live))
+    assert len([new_index for new_index in mapping if new_index == -1]) == size - len(live)
+    assert unicode(tree) == dump and get_texts(tree) == ["first", "second"]
+    for node_index, text in texts.items():
+        assert mapping[node_index] == -1 or tree[mapping[node_index]].text == text
+    assert [tree[child].parent_index for child in tree[0].child_indices] == [0]
+
+
+def test_cross_tree():
+    tree = HTMLTextBlocksTree(get_page(["first", "second"]))
+    tree.cross_tree(HTMLTextBlocksTree(get_page(["third", "second"])))
+    assert get_texts(tree) == ["section %d" % item for item in xrange(5)] + ["second"]
+
+
+def test_substract_deep_trees():
+    get_deep_page = lambda word: "%s%s" % ("".join(["<div>%s %d" % (word, level) 
+                                                    for level in xrange(5000)]), 
+                                           "</div>" * 5000)
+    tree = HTMLTextBlocksTree(get_deep_page("first"))
+    tree.substract_tree(HTMLTextBlocksTree(get_deep_page("second")))
+    assert len(tree.get_text_nodes()) == 5000
+
+
+def test_group_deep_trees():
+    html = ("".join(["<div>level %d" % level for level in xrange(5000)]) + 
+            "<ul>%s</ul>" % ("<li>item</li>" * 3) + "</div>" * 5000)
+    for structure_indexed in [False, True]:
+        tree = HTMLTextBlocksTree(html)
+        if structure_indexed:
+            tree.index_structure()
+        assert get_group_texts(tree) == [["item"] * 3]
+
+
+def test_group_reordered_tree():
+    tree = HTMLTextBlocksTree("<div><p>a</p>x<p>b</p>y</div>")
+    div = tree.find_by_tag("div")[0]
+    tree[div].child_indices = list(reversed(tree[div].child_indices))
+    compacted = tree.copy()
+    compacted.compact()
+    assert get_group_texts(tree) == get_group_texts(compacted) == []
+
+
+def test_find_inline_classes():
+    tree = HTMLTextBlocksTree('<div class="item">tea <span class="price">3$</span></div>'
+                              '<p class="price">cheap</p><p>coffee</p>')
+    text_index = tree.find_by_class("item")[0] + 1
+    paragraph_index = tree.find_by_tag("p")[0]
+    assert tree.find_by_class("price") == [text_index, paragraph_index]
+    assert tree.select(".price") == [text_index, paragraph_index]
+    assert tree.select("span.price") == [text_index]
+    assert tree.select("div.item > .price") == [text_index]
+    assert tree.select("p.price") == [paragraph_index]
+
+
+def test_select():
+    tree = HTMLTextBlocksTree('<ul class="menu"><li>Price 3</li>'
+                              '<li>Other <a href="http://news.example.com/a">news</a></li></ul>'
+                              '<div class="post"><p>Price 5</p></div><p><a href="/x">x</a></p>', 
+                              url = "http://example.com/")
+    price, other, post_price, link = tree.get_text_nodes()
+    first_item, second_item = tree.find_by_tag("li")
+    post_paragraph, paragraph = tree.find_by_tag("p")
+    assert tree.select("body > ul > li") == tree.select("body li") == [first_item, second_item]
+    assert tree.select("* > li") == [first_item, second_item]
+    assert tree.select("div.post > p") == tree.select("div.post p") == [post_paragraph]
+    assert tree.select("ul > p") == [] and tree.select("body > li") == []
+    assert tree.select("li > [text^=Price]") == [price]
+    assert tree.select("[text$=5]") == [post_price]
+    assert tree.select("ul.menu [text*=Other]") == [other]
+    assert tree.select("ul.menu a[href*=news]") == [other]
+    assert tree.select("a[href]") == [other, link]
+    assert tree.select("p > a[href$=x]") == [link]
+    for selector in ["li[text^=Price]", "a > li", "> li", "li >", "li > > p"]:
+        with pytest.raises(ValueError):
+            tree.select(selector)
+
+
+def test_selectors_cache_is_bounded():
+    tree = HTMLTextBlocksTree("<p>1</p>")
+    for number in xrange(2000):
+        tree.select("[text=%d]" % number)
+    assert len(HTMLTextBlocksTree._HTMLTextBlocksTree__SELECTORS) <= 1024
+    assert tree.select("[text=1]") == tree.get_text_nodes()
+
+
+def test_find_by_link_domain():
+    tree = HTMLTextBlocksTree('<p>a <a href="http://News.Example.com/a">news</a></p>'
+                              '<p><a href="/x">x</a> <b>b</b> <a href="/y">y</a></p>', 
+                              url = "http://example.com/")
+    news, links = tree.get_text_nodes()
+    assert tree.find_by_link_domain("news.example.com") == [(news, 0)]
+    #relative links are resolved against tree.url
+    assert tree.find_by_link_domain("EXAMPLE.com") == [(links, 0), (links, 2)]
+    assert tree.find_by_link_domain("other.com") == []
+
+
+def test_traversal():
+    tree = HTMLTextBlocksTree("<div><p>a</p><table><tr><td>b</td></tr></table></div><p>c</p>")
+    assert list(tree.iter_dfs()) == range(len(tree))
+    bfs = list(tree.iter_bfs())
+    assert sorted(bfs) == range(len(tree))
+    assert [tree.get_depth(node_index) for node_index in bfs] == \
+                sorted(tree.get_depth(node_index) for node_index in bfs)
+    table = tree.find_by_tag("table")[0]
+    is_table = lambda tree, node_index: tree[node_index].tag == "table"
+    for iterate in [tree.iter_dfs, tree.iter_bfs]:
+        pruned = list(iterate(prune = is_table))
+        assert table in pruned and not table + 1 in pruned
+        assert list(iterate(table, prune = is_table)) == [table]
+    assert [tree[node_index].text for node_index in tree.iter_text_nodes(prune = is_table)] \
+                == ["a", "c"]
+    visited = []
+    tree.iterate_DFS(table, lambda tree, node_index: visited.append(node_index))
+    assert visited == list(tree.iter_dfs(table))
+    assert list(HTMLTextBlocksTree().iter_dfs()) == list(HTMLTextBlocksTree().iter_bfs()) == []
+
+
+def test_dump():
+    tree = HTMLTextBlocksTree(u"<div><p>привет</p><table><tr><td>b</td></tr></table></div>")
+    out = StringIO()
+    tree.dump(out)
+    assert out.getvalue() == unicode(tree)
+    assert unicode(tree).splitlines()[:2] == ["<root>", " <html>"]
+    table = tree.find_by_tag("table")[0]
+    out = StringIO()
+    tree.dump(out, table, 2)
+    assert out.getvalue() == tree.__str__(table, 2)
+    assert out.getvalue().splitlines()[0] == "  <table>"
+    #deep pages are dumped without recursion
+    deep = HTMLTextBlocksTree("<div>" * 5000 + "x" + "</div>" * 5000)
+    assert str(deep).count("<div>") == 5000
+
+
+def test_text_buffer():
+    tree = HTMLTextBlocksTree(u"<p>привет <b>мир</b> и <i>x</i></p><p>two</p>")
+    first, second = tree.get_text_nodes()
+    assert get_texts(tree) == [u"привет мир и x", u"two"]
+    #mark zones are measured in characters of the text, not in bytes of the buffer
+    text = tree[first].text
+    assert [text[zone.start:zone.start + zone.length].strip() 
+            for zone in tree[first].mark_zones] == [u"мир", u"x"]
+    copied = tree.copy()
+    copied[second].text = u"второй"
+    copied[first].text = u"hi"
+    assert get_texts(tree) == [u"привет мир и x", u"two"]
+    assert get_texts(copied) == [u"hi", u"второй"]
+    #one text is open at a time, inline elements continue it
+    words = ["w%d" % word for word in xrange(20000)]
+    tree = HTMLTextBlocksTree("<p>%s</p>" % " ".join(["<b>%s</b>" % word for word in words]))
+    text_index = tree.get_text_nodes()[0]
+    text = tree[text_index].text
+    assert text == " ".join(words)
+    assert [text[zone.start:zone.start + zone.length].strip() 
+            for zone in tree[text_index].mark_zones] == words
+
+
+def test_move_node_between_parents():
+    tree = HTMLTextBlocksTree("<div><p>x</p>b</div><div>c</div>")
+    first_div, second_div = tree.find_by_tag("div")
+    paragraph = tree.find_by_tag("p")[0]
+    tree[second_div].child_indices.append(paragraph)
+    assert [tree[node_index].text for node_index in tree.iter_text_nodes()] == ["b", "c", "x"]
+    assert tree[paragraph].parent_index == second_div
+    tree[first_div].child_indices = [paragraph] + tree[first_div].child_indices
+    assert tree[second_div].child_indices == [second_div + 1]
+    assert [tree[node_index].text for node_index in tree.iter_text_nodes()] == ["x", "b", "c"]
+    with pytest.raises(ValueError):
+        tree[second_div].child_indices = [second_div + 1, second_div + 1]
+
+
+def test_assign_again_reuses_storage(tmpdir):
+    tree = HTMLTextBlocksTree("<div><p>hello <b>big</b> world</p><p>bye <i>x</i></p></div>")
+    first, second = [node_index for node_index in tree.iter_text_nodes()]
+    compacted = str(tmpdir.join("compacted.tree"))
+    tree.copy().save(compacted)
+    for _ in xrange(100):
+        for node_index in [first, second]:
+            tree[node_index].mark_zones = tree[node_index].mark_zones
+            tree[node_index].text = tree[node_index].text
+    changed = str(tmpdir.join("changed.tree"))
+    tree.save(changed)
+    assert len(open(changed, "rb").read()) == len(open(compacted, "rb").read())
+    tree[first].mark_zones = tree[first].mark_zones * 2
+    tree[first].text = "hi"
+    assert [zone.tag for zone in tree[first].mark_zones] == ["b", "b"]
+    assert [zone.tag for zone in tree[second].mark_zones] == ["i"]
+    assert get_texts(tree) == ["hi", "bye x"]
+
+
+def test_iterate_tree_with_removed_nodes():
+    tree = HTMLTextBlocksTree("<div><p>a</p><p>b</p></div>")
+    div = tree.find_by_tag("div")[0]
+    first = tree.find_by_tag("p")[0]
+    tree[div].child_indices.remove(first)
+    live = list(tree.iter_dfs())
+    assert [node.tag for node in tree] == [tree[node_index].tag for node_index in sorted(live)]
+    assert not first in live and len(list(tree)) == len(live) < len(tree)
+    tree.compact()
+    assert [node.text for node in tree][-1] == "b" and len(list(tree)) == len(tree)
+
+
+def test_structural_index():
+    tree = HTMLTextBlocksTree("<div><p>a</p><p>b <i>c</i></p></div><div>d</div>")
+    tree.index_structure()
+    first_div, second_div = tree.find_by_tag("div")
+    first_paragraph, second_paragraph = tree.find_by_tag("p")
+    text_index = tree[second_paragraph].child_indices[0]
+    body = tree.find_by_tag("body")[0]
+    assert [tree.get_depth(node_index) for node_index in [0, body, first_div, text_index]] == [0, 2, 3, 5]
+    assert tree.is_ancestor(first_div, text_index) and tree.is_ancestor(text_index, text_index)
+    assert not tree.is_ancestor(second_div, text_index)
+    assert not tree.is_ancestor(text_index, first_div)
+    assert tree.get_common_ancestor(text_index, first_paragraph) == first_div
+    assert tree.get_common_ancestor(text_index, second_div) == body
+    assert tree.get_common_ancestor(first_div, text_index) == first_div
+    assert [tree.get_sibling_position(node_index) 
+            for node_index in [first_div, second_div, first_paragraph, second_paragraph]] == [0, 1, 0, 1]
+    #the index is rebuilt after the tree is changed
+    tree[second_div].child_indices.insert(0, second_paragraph)
+    assert tree.get_depth(text_index) == 5
+    assert tree.get_common_ancestor(text_index, first_paragraph) == body
+    assert tree.is_ancestor(second_div, text_index)
+    assert tree.get_sibling_position(second_paragraph) == 0
+    assert tree.get_sibling_position(second_div + 1) == 1
+
+
+def test_feature_matrices():
+    numpy = pytest.importorskip("numpy")
+    first = HTMLTextBlocksTree('<ul><li>one two</li><li><a href="/x">four</a></li></ul>')
+    second = HTMLTextBlocksTree('<p class="x">five</p>')
+    matrices = HTMLTextBlocksTree.get_feature_matrices([first, second], hashed_dimension = 64)
+    assert matrices["documents"].tolist() == [0, 0, 1]
+    assert matrices["nodes"].tolist() == first.get_text_nodes() + second.get_text_nodes()
+    dense = matrices["dense"]
+    assert dense.shape == (3, len(HTMLTextBlocksTree.FEATURES))
+    features = dict(zip(HTMLTextBlocksTree.FEATURES, dense[1]))
+    assert features["depth"] == 5 and features["text_length"] == 4
+    assert features["link_length"] == 4 and features["link_density"] == 1
+    assert features["mark_zones_count"] == 1 and features["parent_text_nodes_count"] == 1
+    groups = dense[:, HTMLTextBlocksTree.FEATURES.index("group")]
+    assert groups.tolist() == [0, 0, -1]
+    indices, indptr = matrices["hashed_indices"], matrices["hashed_indptr"]
+    assert indptr.tolist()[0] == 0 and indptr.tolist()[-1] == len(indices) and len(indptr) == 4
+    rows = [indices[indptr[row]:indptr[row + 1]].tolist() for row in xrange(3)]
+    for row in rows:
+        assert row == sorted(set(row)) and 0 <= row[0] and row[-1] < 64
+    #the link zone adds features to the same tag path
+    assert set(rows[0]) < set(rows[1])
+    assert numpy.array_equal(first.get_features(hashed_dimension = 64)["dense"], dense[:2])
+    not_grouped = first.get_features(similar_sense = False)["dense"]
+    assert not_grouped[:, HTMLTextBlocksTree.FEATURES.index("group")].tolist() == [-1, -1]
+
+
+def test_stats():
+    phases = []
+    stats = HTMLTextBlocksTree.Stats(callback = lambda phase, seconds, stats: 
+                                                        phases.append(phase))
+    first = HTMLTextBlocksTree("<ul><li>one</li><li>two</li></ul>", stats = stats)
+    second = HTMLTextBlocksTree("<ul><li>one</li><li>three</li></ul>", stats = stats)
+    #one object sums up the work of both trees
+    assert stats.counters == {"nodes_created": len(first) + len(second)}
+    assert set(phases) == set(stats.times) == set(["parse", "count_texts", 
+                                                   "unlink_text_free_nodes"])
+    first.get_similar_sense_texts()
+    first.substract_tree(second)
+    assert phases[-1] == "substract_tree" and "get_similar_sense_texts" in phases
+    assert stats.counters["aligned_pairs"] > 0
+    assert sorted(stats.as_dict()) == ["counters", "times"]
+    assert min(stats.times.values()) >= 0
+    assert HTMLTextBlocksTree("<p>x</p>").stats is None
+
+
+def test_limit_max_nodes():
+    tree = HTMLTextBlocksTree("<p>a</p><p>b</p><p>c</p><p>d</p>", 
+                              limits = HTMLTextBlocksTree.Limits(max_nodes = 6))
+    assert tree.limits_hit == ["max_nodes"]
+    assert get_texts(tree) == ["a", "b"]
+
+
+def test_limit_max_depth():
+    tree = HTMLTextBlocksTree("<div>a<div>b<div>c<div>d</div></div></div></div>", 
+                              limits = HTMLTextBlocksTree.Limits(max_depth = 4))
+    assert tree.limits_hit == ["max_depth"]
+    assert get_texts(tree) == ["a", "b c d"]
+
+
+def test_limit_max_text_bytes():
+    limits = HTMLTextBlocksTree.Limits(max_text_bytes = 9)
+    tree = HTMLTextBlocksTree("<p>hello</p><p>world</p><p>again</p>", limits = limits)
+    assert tree.limits_hit == ["max_text_bytes"]
+    assert get_texts(tree) == ["hello", "worl"]
+    #texts are cut at utf8 character boundaries
+    tree = HTMLTextBlocksTree(u"<p>привет мир</p>", limits = limits)
+    assert get_texts(tree) == [u"прив"]
+    assert HTMLTextBlocksTree("<p>hello</p>", limits = limits).limits_hit == []
+
+
+def test_limit_max_zones_per_node():
+    tree = HTMLTextBlocksTree("<p>a <b>b</b> <i>c</i> <u>d</u></p>", 
+                              limits = HTMLTextBlocksTree.Limits(max_zones_per_node = 2))
+    assert tree.limits_hit == ["max_zones_per_node"]
+    text_index = tree.get_text_nodes()[0]
+    assert tree[text_index].text == "a b c d"
+    assert [zone.tag for zone in tree[text_index].mark_zones] == ["b", "i"]
+
+
+def test_limit_max_seconds():
+    limits = HTMLTextBlocksTree.Limits(max_seconds = 0)
+    tree = HTMLTextBlocksTree("<p>a</p>" * 1000, limits = limits)
+    assert tree.limits_hit == ["max_seconds"]
+    assert len(get_texts(tree)) < 1000
+    get_items = lambda word: "".join(["<div><p>a%d</p><p>%s</p></div>" % (item, word) 
+                                      for item in xrange(50)])
+    tree = HTMLTextBlocksTree(get_items("x"))
+    tree.limits = limits
+    assert tree.get_similar_sense_texts() == []
+    assert tree.limits_hit == ["max_seconds"]
+    #nothing is aligned in time, so nothing is substracted
+    tree = HTMLTextBlocksTree(get_items("x"))
+    tree.limits = limits
+    tree.substract_tree(HTMLTextBlocksTree(get_items("y")))
+    assert tree.limits_hit == ["max_seconds"]
+    assert len(get_texts(tree)) == 100
+
+
+def test_update():
+    old_html = ('<div class="menu"><p>home</p><p>news</p></div>'
+                '<ul><li>one</li><li>two</li></ul><p>footer</p>')
+    new_html = ('<div class="menu"><p>home</p><p>news</p></div>'
+                '<ul><li>one</li><li>2</li><li>three</li></ul>')
+    tree = HTMLTextBlocksTree(old_html)
+    menu = tree.find_by_class("menu")[0]
+    menu_texts = list(tree.iter_text_nodes(menu))
+    home, news, one, two, footer = tree.get_text_nodes()
+    diff = tree.update(new_html)
+    fresh = HTMLTextBlocksTree(new_html)
+    assert unicode(tree) == unicode(fresh)
+    assert get_texts(tree) == get_texts(fresh)
+    assert get_group_texts(tree) == get_group_texts(fresh)
+    #unchanged subtrees keep their indices
+    assert tree.find_by_class("menu") == [menu]
+    assert list(tree.iter_text_nodes(menu)) == menu_texts
+    assert tree.get_text_nodes()[:4] == [home, news, one, two]
+    assert diff["changed"] == [two] and tree[two].text == "2"
+    assert diff["removed"] == [footer] and tree[footer].text == "footer"
+    assert [tree[node_index].text for node_index in diff["added"]] == ["three"]
+    assert tree.update(new_html) == {"added": [], "removed": [], "changed": []}
+
+
+def test_update_reordered_texts():
+    tree = HTMLTextBlocksTree("<div>hello<p>a</p>hello<p>b</p></div>")
+    new_html = "<div>bye<p>a</p>hello<p>b</p></div>"
+    tree.update(new_html)
+    fresh = HTMLTextBlocksTree(new_html)
+    assert unicode(tree) == unicode(fresh)
+    assert get_group_texts(tree) == get_group_texts(fresh)
+    tree = HTMLTextBlocksTree("")
+    assert tree.update("<p>x</p>")["added"] == tree.get_text_nodes()
+    assert get_texts(tree) == ["x"]
+
+
+def get_site_page(title):
+    return ('<div class="menu"><p>home</p><p>news</p></div>'
+            '<div class="post"><p>%s</p></div>' % title)
+
+
+def test_site_template(tmpdir):
+    template = SiteTemplate()
+    for title in ["first", "second", "third"]:
+        template.add_tree(HTMLTextBlocksTree(get_site_page(title)))
+    assert template.pages_count == 3
+    assert sorted(template.frequencies.values()) == [1, 1, 1, 3, 3]
+    filename = str(tmpdir.join("site.template"))
+    template.save(filename)
+    loaded = SiteTemplate.load(filename)
+    assert (loaded.pages_count, loaded.min_part) == (3, 0.5)
+    assert loaded.frequencies == template.frequencies
+    tree = HTMLTextBlocksTree(get_site_page("fourth"))
+    tree.substract_template(loaded)
+    assert get_texts(tree) == ["fourth"]
+    with open(filename, "wb") as template_file:
+        template_file.write("something else\n")
+    with pytest.raises(ValueError):
+        SiteTemplate.load(filename)
+
+
+def test_site_template_eviction():
+    template = SiteTemplate(max_signatures = 3)
+    template.add_tree(HTMLTextBlocksTree(get_site_page("first")))
+    template.add_tree(HTMLTextBlocksTree(get_site_page("second")))
+    #only the title of the earlier page is forgotten
+    assert sorted(template.frequencies.values()) == [1, 2, 2]
+    tree = HTMLTextBlocksTree(get_site_page("second"))
+    template.add_tree(tree)
+    assert sorted(template.frequencies.values()) == [2, 3, 3]
+    assert template.is_boilerplate(tree.get_text_signatures()[tree.get_text_nodes()[-1]])
+
+
+def test_corpus_grouper():
+    grouper = CorpusGrouper(max_members = 3)
+    for document in xrange(4):
+        items = "".join(["<li>%d.%d</li>" % (document, item) for item in xrange(2)])
+        grouper.add_tree(HTMLTextBlocksTree('<div class="menu"><p>home</p></div>'
+                                            '<ul class="items">%s</ul>' % items), 
+                         "page%d" % document)
+    grouper.add_tree(HTMLTextBlocksTree("<h1>other</h1>"))
+    assert grouper.documents_count == 5
+    items, menu = list(grouper.iter_groups())
+    assert (items["documents_count"], items["nodes_count"]) == (4, 8)
+    assert [(document_id, text) for document_id, _, text in items["members"]] == \
+                                    [("page0", "0.0"), ("page0", "0.1"), ("page1", "1.0")]
+    assert (menu["documents_count"], menu["nodes_count"]) == (4, 4)
+    assert [group["signature"] for group in grouper.iter_groups(min_nodes = 5)] == \
+                                                                [items["signature"]]
+    groups = list(grouper.iter_groups(min_documents = 1))
+    assert len(groups) == 3
+    #the number of the tree is the default document id
+    assert [(document_id, text) for document_id, _, text in groups[-1]["members"]] == \
+                                                                [(4, "other")]
+
+
+def test_corpus_grouper_eviction():
+    grouper = CorpusGrouper(max_groups = 2)
+    for html in ["<p>a</p>", "<h1>b</h1>", "<p>a</p>"]:
+        grouper.add_tree(HTMLTextBlocksTree(html))
+    assert sorted([group[1] for group in grouper.groups.values()]) == [1, 2]
+    #groups of the current page are kept, groups seen on one earlier page are not
+    grouper.add_tree(HTMLTextBlocksTree("<h2>c</h2><h3>d</h3><h4>e</h4>"))
+    assert sorted([group[1] for group in grouper.groups.values()]) == [1, 1, 1, 2]
+    assert [group["documents_count"] for group in grouper.iter_groups()] == [2]
+
+
+def test_save_load(tmpdir):
+    tree = HTMLTextBlocksTree(u'<div class="post">привет <a href="/x">link</a></div><p>x</p>', 
+                              url = "http://example.com/")
+    filename = str(tmpdir.join("page.tree"))
+    tree.save(filename)
+    loaded = HTMLTextBlocksTree.load(filename)
+    assert loaded.url == tree.url
+    assert unicode(loaded) == unicode(tree)
+    assert loaded.find_by_link_domain("example.com") == tree.find_by_link_domain("example.com")
+
+
+def test_load_truncated_file(tmpdir):
+    filename = str(tmpdir.join("page.tree"))
+    HTMLTextBlocksTree("<p>hello</p><p>world</p>").save(filename)
+    data = open(filename, "rb").read()
+    for length in [0, 5, 20, len(data) // 2, len(data) - 3]:
+        with open(filename, "wb") as tree_file:
+            tree_file.write(data[:length])
+        with pytest.raises(ValueError):
+            HTMLTextBlocksTree.load(filename)
+
+
+def test_parse_cache_hits(tmpdir):
+    cache = ParseCache(max_trees = 1, directory = str(tmpdir))
+    first = cache.get_tree("<p>first</p>")
+    assert get_texts(cache.get_tree("<p>first</p>")) == get_texts(first) == ["first"]
+    cache.get_tree("<p>second</p>")
+    #the first tree is evicted from memory, it is loaded from disk
+    assert get_texts(cache.get_tree("<p>first</p>")) == ["first"]
+    stats = cache.get_stats()
+    assert (stats["hits"], stats["disk_hits"], stats["misses"]) == (1, 1, 2)
+    assert stats["trees_in_memory"] == 1 and stats["trees_on_disk"] == 2
+
+
+def test_parse_cache_disk_eviction(tmpdir):
+    cache = ParseCache(max_trees = 1, directory = str(tmpdir), max_disk_bytes = 1)
+    cache.get_tree("<p>first</p>")
+    cache.get_tree("<p>second</p>")
+    assert len(tmpdir.listdir()) == 1
+    assert cache.get_stats()["trees_on_disk"] == 1
+    cache.get_tree("<p>first</p>")
+    assert cache.get_stats()["misses"] == 3
+
+
+def test_parse_cache_copy_on_write():
+    cache = ParseCache()
+    html = "<div><p>menu</p><p>first</p></div>"
+    tree = cache.get_tree(html)
+    tree.substract_tree(HTMLTextBlocksTree("<div><p>menu</p><p>second</p></div>"))
+    assert get_texts(tree) == ["first"]
+    assert get_texts(cache.get_tree(html)) == ["menu", "first"]
+
+
+def test_parse_cache_corrupt_file(tmpdir):
+    cache = ParseCache(max_trees = 1, directory = str(tmpdir))
+    cache.get_tree("<p>first</p>")
+    cache.get_tree("<p>second</p>")
+    filename = str(tmpdir.join(cache.get_key("<p>first</p>") + ".tree"))
+    with open(filename, "r+b") as tree_file:
+        tree_file.write("garbage")
+    assert get_texts(cache.get_tree("<p>first</p>")) == ["first"]
+    assert cache.get_stats()["misses"] == 3
+    assert get_texts(HTMLTextBlocksTree.load(filename)) == ["first"]
+
+
+def test_parse_cache_write_errors(tmpdir):
+    directory = tmpdir.join("trees")
+    cache = ParseCache(directory = str(directory))
+    directory.remove()
+    assert get_texts(cache.get_tree("<p>first</p>")) == ["first"]
+    assert get_texts(cache.get_tree("<p>first</p>")) == ["first"]
+    stats = cache.get_stats()
+    assert (stats["write_errors"], stats["hits"], stats["trees_on_disk"]) == (1, 1, 0)